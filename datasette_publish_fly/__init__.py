@@ -1,47 +1,10 @@
-from sys import stdout
 from datasette import hookimpl
-from datasette.publish.common import (
-    add_common_publish_arguments_and_options,
-    fail_if_publish_binary_not_installed,
-)
-from datasette.utils import (
-    temporary_docker_directory,
-    value_as_boolean,
-    ValueAsBooleanError,
-)
-from subprocess import run, PIPE
+from datasette.publish.common import add_common_publish_arguments_and_options
 import click
 from click.types import CompositeParamType
-import httpx
-import json
-import os
-import pathlib
-import shutil
 
-
-FLY_TOML = """
-app = "{app}"
-{mounts}
-[[services]]
-  internal_port = 8080
-  protocol = "tcp"
-
-  [services.concurrency]
-    hard_limit = 25
-    soft_limit = 20
-
-  [[services.ports]]
-    handlers = ["http"]
-    port = 80
-
-  [[services.ports]]
-    handlers = ["tls", "http"]
-    port = 443
-
-  [[services.tcp_checks]]
-    interval = 10000
-    timeout = 2000
-"""
+# Only the command definition lives here: this module is imported by every
+# "datasette" command, so the implementation is imported when it is used
 
 
 class Setting(CompositeParamType):
@@ -50,6 +13,7 @@ class Setting(CompositeParamType):
 
     def convert(self, config, param, ctx):
         from datasette.app import DEFAULT_SETTINGS
+        from datasette.utils import value_as_boolean, ValueAsBooleanError
 
         name, value = config
         if name not in DEFAULT_SETTINGS:
@@ -79,6 +43,24 @@ class Setting(CompositeParamType):
             self.fail("Invalid option")
 
 
+class IntegerOrAuto(click.ParamType):
+    name = "integer|auto"
+
+    def __init__(self, min=1):
+        self.min = min
+
+    def convert(self, value, param, ctx):
+        if value == "auto" or isinstance(value, int):
+            return value
+        try:
+            number = int(value)
+        except ValueError:
+            self.fail("{!r} should be an integer or 'auto'".format(value), param, ctx)
+        if number < self.min:
+            self.fail("{} is less than {}".format(number, self.min), param, ctx)
+        return number
+
+
 @hookimpl
 def publish_subcommand(publish):
     @publish.command()
@@ -86,12 +68,44 @@ def publish_subcommand(publish):
     @click.option("--spatialite", is_flag=True, help="Enable SpatialLite extension")
     @click.option(
         "--region",
-        help="Fly region to deploy to, e.g sjc - see https://fly.io/docs/reference/regions/",
+        help=(
+            "Fly region to deploy to, e.g sjc - see https://fly.io/docs/reference/regions/"
+            " - or 'auto' to pick based on --client-location or --region-probes"
+        ),
     )
     @click.option(
-        "--create-volume",
+        "--client-location",
+        "client_locations",
+        multiple=True,
+        help="Sample client location as LAT,LON for --region auto",
+    )
+    @click.option(
+        "--region-probes",
+        type=click.Path(exists=True, dir_okay=False),
+        help="CSV or JSON file of client,region,latency_ms for --region auto",
+    )
+    @click.option(
+        "--region-count",
         type=click.IntRange(min=1),
-        help="Create and attach volume of this size in GB",
+        default=1,
+        help="Number of regions to run in for --region auto",
+    )
+    @click.option(
+        "--create-volume",
+        type=IntegerOrAuto(min=1),
+        help="Create and attach volume of this size in GB, or 'auto' to size it based on the databases",
+    )
+    @click.option(
+        "--expected-growth",
+        type=click.FloatRange(min=1),
+        default=2.0,
+        show_default=True,
+        help="Expected growth of volume databases, for --create-volume auto",
+    )
+    @click.option(
+        "--vm-memory",
+        type=IntegerOrAuto(min=256),
+        help="VM memory in MB, or 'auto' to fit the databases in memory",
     )
     @click.option(
         "--create-db",
@@ -100,6 +114,22 @@ def publish_subcommand(publish):
         help="Names of read-write database files to create",
     )
     @click.option("--volume-name", default="datasette", help="Volume name to use")
+    @click.option(
+        "--upload-to-volume",
+        is_flag=True,
+        help="Upload database files to the volume instead of including them in the image",
+    )
+    @click.option(
+        "--sync-db",
+        multiple=True,
+        type=click.Path(exists=True, dir_okay=False),
+        help="Sync changed pages of this database file to the volume after deploying",
+    )
+    @click.option(
+        "--replicas",
+        type=click.IntRange(min=1),
+        help="Number of read-only replica machines for the --create-db databases, using LiteFS",
+    )
     @click.option(
         "-a",
         "--app",
@@ -130,37 +160,104 @@ def publish_subcommand(publish):
         multiple=True,
     )
     @click.option("--crossdb", is_flag=True, help="Enable cross-database SQL queries")
-    def fly(
-        files,
-        metadata,
-        extra_options,
-        branch,
-        template_dir,
-        plugins_dir,
-        static,
-        install,
-        plugin_secret,
-        version_note,
-        secret,
-        title,
-        license,
-        license_url,
-        source,
-        source_url,
-        about,
-        about_url,
-        spatialite,
-        region,
-        create_volume,
-        create_db,
-        volume_name,
-        app,
-        org,
-        generate_dir,
-        show_files,
-        settings,
-        crossdb,
-    ):
+    @click.option(
+        "--strategy",
+        type=click.Choice(["rolling", "bluegreen", "canary", "immediate"]),
+        help="Fly deployment strategy",
+    )
+    @click.option(
+        "--max-unavailable",
+        type=float,
+        callback=validate_max_unavailable,
+        help="Machines (or fraction of machines) that can be unavailable during a rolling deploy",
+    )
+    @click.option(
+        "--check-databases",
+        type=click.Choice(["quick", "full"]),
+        help="Check database files with PRAGMA quick_check or integrity_check before publishing",
+    )
+    @click.option(
+        "--pipeline",
+        is_flag=True,
+        help="Prepare the build context while talking to Fly, instead of afterwards",
+    )
+    @click.option(
+        "--compress",
+        type=click.Choice(["gzip", "zstd"]),
+        help="Compress database files for upload, decompressing them during the build",
+    )
+    @click.option(
+        "--chunk-size",
+        type=click.IntRange(min=1),
+        help="Split database files bigger than this many MB into chunks, each its own image layer, reassembled at start-up",
+    )
+    @click.option(
+        "--build",
+        type=click.Choice(["remote", "local"]),
+        default="remote",
+        show_default=True,
+        help="Build the image on Fly's remote builder or locally with Docker BuildKit",
+    )
+    @click.option(
+        "--build-cache",
+        help="Directory or BuildKit cache spec such as type=registry,ref=... for --build local",
+    )
+    @click.option(
+        "--base-image-app",
+        help="Fly app whose registry holds a reusable base image with Datasette, plugins and SpatiaLite",
+    )
+    @click.option(
+        "--metrics",
+        is_flag=True,
+        help="Serve Prometheus metrics at /-/metrics and have Fly scrape them",
+    )
+    @click.option(
+        "--slow-query-ms",
+        type=click.IntRange(min=0),
+        help="Log SQL queries slower than this and serve them at /-/slow-queries.json",
+    )
+    @click.option(
+        "--index",
+        multiple=True,
+        help="Index to create on a table converted from CSV, TSV or NDJSON, as table.column",
+    )
+    @click.option(
+        "--wal",
+        is_flag=True,
+        help="Run the databases on the volume in WAL mode, with background checkpoints",
+    )
+    @click.option(
+        "--wal-checkpoint-interval",
+        type=click.IntRange(min=0),
+        help="Seconds between --wal background checkpoints, default 60, 0 to disable",
+    )
+    @click.option(
+        "--target-rps",
+        type=float,
+        callback=validate_target_rps,
+        help="Benchmark locally, then choose a VM size and machine count to serve this many requests a second",
+    )
+    @click.option(
+        "--inspect-volume",
+        is_flag=True,
+        help="Precompute table counts for databases on the volume in the background",
+    )
+    @click.option(
+        "--resume",
+        is_flag=True,
+        help="Skip the steps that finished in the last failed attempt at this publish",
+    )
+    @click.option(
+        "--watch",
+        is_flag=True,
+        help="Keep running, republishing whenever the published files change",
+    )
+    @click.option(
+        "--plan",
+        is_flag=True,
+        help="Show what the publish would do and how long it should take, without changing anything",
+    )
+    def fly(**kwargs):
         """
         Deploy an application to Fly that runs Datasette against the provided database files.
 
@@ -170,286 +267,26 @@ def publish_subcommand(publish):
 
         Full documentation: https://datasette.io/plugins/datasette-publish-fly
         """
-        fly_token = None
-
-        # Ensure generate_dir is an absolute, not relative path
-        if generate_dir:
-            generate_dir = str(pathlib.Path(generate_dir).absolute())
+        from .publish import publish_to_fly
 
-        if not generate_dir:
-            # They must have flyctl installed
-            fail_if_publish_binary_not_installed(
-                "flyctl",
-                "Fly",
-                "https://fly.io/docs/getting-started/installing-flyctl/",
-            )
-            # And they need to be logged in
-            token_result = run(
-                [
-                    "flyctl",
-                    "auth",
-                    "token",
-                    "--json",
-                ],
-                stderr=PIPE,
-                stdout=PIPE,
-            )
-            if token_result.returncode:
-                raise click.ClickException(
-                    "Error calling 'flyctl auth token':\n\n{}".format(
-                        token_result.stderr.decode("utf-8").strip()
-                    )
-                )
-            else:
-                fly_token = json.loads(token_result.stdout)["token"]
-
-            # If they didn't specify a region, use fly_token to find the nearest
-            if not region:
-                response = httpx.post(
-                    "https://api.fly.io/graphql",
-                    json={"query": "{ nearestRegion { code } }"},
-                    headers={
-                        "accept": "application/json",
-                        "Authorization": "Bearer {}".format(fly_token),
-                    },
-                )
-                if response.status_code == 200 and "errors" not in response.json():
-                    # {'data': {'nearestRegion': {'code': 'sjc'}}}
-                    region = response.json()["data"]["nearestRegion"]["code"]
-                else:
-                    raise click.ClickException(
-                        "Could not resolve nearest region, specify --region"
-                    )
-
-        extra_metadata = {
-            "title": title,
-            "license": license,
-            "license_url": license_url,
-            "source": source,
-            "source_url": source_url,
-            "about": about,
-            "about_url": about_url,
-        }
-
-        if not generate_dir:
-            apps = existing_apps()
-            if app not in apps:
-                # Attempt to create the app
-                args = [
-                    "flyctl",
-                    "apps",
-                    "create",
-                    "--name",
-                    app,
-                    "--json",
-                ]
-                if org:
-                    args.extend(["--org", org])
-                result = run(args, stderr=PIPE, stdout=PIPE)
-                if result.returncode:
-                    raise click.ClickException(
-                        "Error calling 'flyctl apps create':\n\n{}".format(
-                            # Don't include Usage: - could be confused for usage
-                            # instructions for datasette publish fly
-                            result.stderr.decode("utf-8")
-                            .split("Usage:")[0]
-                            .strip()
-                        )
-                    )
-
-        volume_to_mount = None
-
-        if create_volume and not generate_dir:
-            # Ensure the volume has not been previousy created
-            if volume_name not in existing_volumes(app):
-                create_volume_result = run(
-                    [
-                        "flyctl",
-                        "volumes",
-                        "create",
-                        volume_name,
-                        "--region",
-                        region,
-                        "--size",
-                        str(create_volume),
-                        "-a",
-                        app,
-                        "--json",
-                    ],
-                    stderr=PIPE,
-                    stdout=PIPE,
-                )
-                if create_volume_result.returncode:
-                    raise click.ClickException(
-                        "Error calling 'flyctl volumes create':\n\n{}".format(
-                            create_volume_result.stderr.decode("utf-8")
-                            .split("Usage:")[0]
-                            .strip()
-                        )
-                    )
-
-        if create_volume:
-            volume_to_mount = volume_name
-
-        if not create_volume and not generate_dir:
-            # Does the previous app have mounted volumes?
-            volumes = existing_volumes(app)
-            if volumes:
-                volume_to_mount = volumes[0]
-
-        extra_options = extra_options or ""
-        if settings:
-            extra_options += " ".join(
-                "--setting {} {}".format(*setting) for setting in settings
-            )
-        if crossdb:
-            extra_options += " --crossdb"
-        if volume_to_mount:
-            for database_name in create_db:
-                if not database_name.endswith(".db"):
-                    database_name += ".db"
-                extra_options += " /data/{}".format(database_name)
-            extra_options += " --create"
-
-        environment_variables = {}
-        secrets_to_set = {}
-        if plugin_secret:
-            extra_metadata["plugins"] = {}
-            for plugin_name, plugin_setting, setting_value in plugin_secret:
-                environment_variable = (
-                    "{}_{}".format(plugin_name, plugin_setting)
-                    .upper()
-                    .replace("-", "_")
-                )
-                secrets_to_set[environment_variable] = setting_value
-                extra_metadata["plugins"].setdefault(plugin_name, {})[
-                    plugin_setting
-                ] = {"$env": environment_variable}
-        with temporary_docker_directory(
-            files,
-            app,
-            metadata,
-            extra_options,
-            branch,
-            template_dir,
-            plugins_dir,
-            static,
-            install,
-            spatialite,
-            version_note,
-            secret,
-            extra_metadata,
-            environment_variables,
-            port=8080,
-        ):
-            if volume_to_mount:
-                # Modify CMD line of Dockerfile to use bash and add /data/*.db to end of it
-                dockerfile_content = open("Dockerfile").read().strip()
-                lines = dockerfile_content.split("\n")
-                assert lines[-1].startswith("CMD ")
-                new_line = lines[-1][len("CMD ") :] + " /data/*.db"
-                # Convert that to CMD ["/bin/bash","-c","shopt -s nullglob &&
-                # See https://github.com/simonw/datasette-publish-fly/issues/17
-                new_line = (
-                    'CMD ["/bin/bash", "-c", "shopt -s nullglob && ' + new_line + '"]\n'
-                )
-                lines[-1] = new_line
-                open("Dockerfile", "w").write("\n".join(lines))
-
-            if secrets_to_set and not generate_dir:
-                secrets_args = ["flyctl", "secrets", "set"]
-                for pair in secrets_to_set.items():
-                    secrets_args.append("{}={}".format(*pair))
-                secrets_args.extend(["-a", app])
-                secrets_result = run(
-                    secrets_args,
-                    stderr=PIPE,
-                    stdout=PIPE,
-                )
-                if secrets_result.returncode:
-                    # Ignore "No change detected to secrets" but raise anything else
-                    error_message = secrets_result.stderr.decode("utf-8").strip()
-                    if "No change detected to secrets" not in error_message:
-                        raise click.ClickException(
-                            "Error calling 'flyctl secrets set':\n\n{}".format(
-                                error_message
-                            )
-                        )
+        publish_to_fly(**kwargs)
 
-            mounts = ""
-            if volume_to_mount:
-                mounts = (
-                    "\n[[mounts]]\n"
-                    '  destination = "/data"\n'
-                    '  source = "{}"\n'.format(volume_to_mount)
-                )
 
-            fly_toml = FLY_TOML.format(app=app, mounts=mounts)
-
-            if generate_dir:
-                dir = pathlib.Path(generate_dir)
-                if not dir.exists():
-                    dir.mkdir()
-
-                # Copy files from current directory to dir
-                for file in pathlib.Path(".").glob("*"):
-                    if file.is_dir():
-                        shutil.copytree(str(file), str(dir / file.name))
-                    else:
-                        shutil.copy(str(file), str(dir / file.name))
-                (dir / "fly.toml").write_text(fly_toml, "utf-8")
-                return
-
-            elif show_files:
-                click.echo("fly.toml")
-                click.echo("----")
-                click.echo(fly_toml)
-                click.echo("----")
-                click.echo("Dockerfile")
-                click.echo("----")
-                click.echo(open("Dockerfile").read())
-                if os.path.exists("metadata.json"):
-                    click.echo("----")
-                    click.echo("metadata.json")
-                    click.echo("----")
-                    click.echo(open("metadata.json").read())
-                    click.echo("----")
-
-            open("fly.toml", "w").write(fly_toml)
-            # Now deploy it
-            deploy_result = run(
-                [
-                    "flyctl",
-                    "deploy",
-                    ".",
-                    "--app",
-                    app,
-                    "--config",
-                    "fly.toml",
-                    "--remote-only",
-                ]
-            )
-            if deploy_result.returncode:
-                raise click.ClickException("Error calling 'flyctl deploy'")
-
-
-def existing_apps():
-    process = run(["flyctl", "apps", "list", "--json"], stdout=PIPE, stderr=PIPE)
-    return [app["Name"] for app in json.loads(process.stdout)]
+def validate_max_unavailable(ctx, param, value):
+    if value is None:
+        return value
+    if value <= 0 or (value > 1 and value != int(value)):
+        raise click.BadParameter(
+            "Must be a fraction between 0 and 1 or a whole number of machines"
+        )
+    return value
 
 
-def existing_volumes(app):
-    process = run(
-        ["flyctl", "volumes", "list", "-a", app, "--json"], stdout=PIPE, stderr=PIPE
-    )
-    if process.returncode == 1:
-        if b"Could not resolve App" in process.stderr:
-            return []
-        else:
-            assert False, "flyctl volumes list error: {}".format(
-                process.stderr.decode("utf-8")
-            )
-    return [volume["Name"] for volume in json.loads(process.stdout)]
+def validate_target_rps(ctx, param, value):
+    # Not FloatRange(min_open=True), which needs Click 8
+    if value is not None and value <= 0:
+        raise click.BadParameter("Must be greater than 0")
+    return value
 
 
 def validate_database_name(ctx, param, value):
@@ -0,0 +1,71 @@
+"""
+Reusable base images holding Datasette, the --install plugins and SpatiaLite
+
+Base images are tagged with a hash of their Dockerfile, so every app
+published with the same plugins shares one image and a publish only
+rebuilds the layers holding the data and metadata.
+"""
+from .container import dockerfile_steps
+from datasette.version import __version__
+import hashlib
+import httpx
+
+REGISTRY = "registry.fly.io"
+
+# Steps from the generated Dockerfile that don't depend on the data
+BASE_STEPS = ("RUN apt-get update", "RUN pip install")
+
+MANIFEST_TYPES = ", ".join(
+    (
+        "application/vnd.docker.distribution.manifest.v2+json",
+        "application/vnd.docker.distribution.manifest.list.v2+json",
+        "application/vnd.oci.image.manifest.v1+json",
+        "application/vnd.oci.image.index.v1+json",
+    )
+)
+
+
+def pin_datasette(line):
+    # Otherwise the image would be stuck on whichever release was current
+    # when it was built - pinning makes the version part of the hash
+    return " ".join(
+        "datasette=={}".format(__version__) if bit == "datasette" else bit
+        for bit in line.split(" ")
+    )
+
+
+def split_dockerfile(base_app):
+    """
+    Move the Datasette-generated Dockerfile's install steps into a base
+    image, returns (image, base_dockerfile)
+    """
+    lines = open("Dockerfile").read().split("\n")
+    base_lines = [lines[0]]
+    app_lines = []
+    for step in dockerfile_steps(lines[1:]):
+        if step[0].startswith(BASE_STEPS):
+            base_lines.extend(pin_datasette(line) for line in step)
+        else:
+            app_lines.extend(step)
+    base_dockerfile = "\n".join(base_lines) + "\n"
+    image = "{}/{}:base-{}".format(
+        REGISTRY,
+        base_app,
+        hashlib.sha256(base_dockerfile.encode("utf-8")).hexdigest()[:16],
+    )
+    open("Dockerfile", "w").write("\n".join(["FROM {}".format(image)] + app_lines))
+    return image, base_dockerfile
+
+
+def image_exists(image, token):
+    repository, tag = image[len(REGISTRY) + 1 :].split(":")
+    try:
+        response = httpx.head(
+            "https://{}/v2/{}/manifests/{}".format(REGISTRY, repository, tag),
+            auth=("x", token),
+            headers={"accept": MANIFEST_TYPES},
+        )
+    except httpx.HTTPError:
+        # Building it again is slow but harmless
+        return False
+    return response.status_code == 200
@@ -0,0 +1,249 @@
+"""
+Chooses a VM size and machine count for --target-rps
+
+The generated Datasette configuration is served locally and loaded with
+as many concurrent requests as Fly will send a single machine, so the
+measured throughput already reflects the services.concurrency limits.
+That is then scaled by how much CPU each Fly VM size gets.
+"""
+from datasette.utils import tilde_encode
+import asyncio
+import click
+import httpx
+import itertools
+import math
+import shlex
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+
+BENCHMARK_SECONDS = 10
+STARTUP_TIMEOUT = 30
+# Tables per database to request, largest first
+MAX_TABLES = 5
+
+# Run each machine at this fraction of its measured capacity
+TARGET_UTILIZATION = 0.7
+
+# VM sizes that would be slower than this at the benchmark's concurrency
+# are not considered
+MAX_P95_MS = 1000
+
+PERFORMANCE_MIN_MEMORY_MB = 2048
+
+# Throughput is measured for one Datasette process on this machine, which
+# is treated as one dedicated CPU. Shared CPUs are guaranteed 1/16 of a
+# core each once their burst balance runs out, and a single Datasette
+# process can't make use of much more than one and a half cores.
+DATASETTE_MAX_CORES = 1.5
+VM_SIZES = (
+    # name, CPU cores available, approximate US$ per month
+    ("shared-cpu-1x", 1 / 16, 1.94),
+    ("shared-cpu-2x", 2 / 16, 3.89),
+    ("shared-cpu-4x", 4 / 16, 7.78),
+    ("shared-cpu-8x", 8 / 16, 15.55),
+    ("performance-1x", 1, 31.0),
+    ("performance-2x", 2, 62.0),
+)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def serve_args(port):
+    "The datasette serve command from the Dockerfile's CMD, for running locally"
+    cmd = open("Dockerfile").read().strip().split("\n")[-1]
+    args = shlex.split(cmd[len("CMD ") :])
+    local_args = []
+    skip = False
+    for arg in args:
+        if skip:
+            skip = False
+        elif arg == "--inspect-file":
+            # Only exists once the image has been built
+            skip = True
+        elif arg == "--host":
+            local_args += ["--host", "127.0.0.1"]
+            skip = True
+        elif arg == "$PORT":
+            local_args.append(str(port))
+        else:
+            local_args.append(arg)
+    return [sys.executable, "-m"] + local_args
+
+
+def wait_until_ready(client, process, stderr):
+    start = time.monotonic()
+    while time.monotonic() - start < STARTUP_TIMEOUT:
+        if process.poll() is not None:
+            stderr.seek(0)
+            raise click.ClickException(
+                "Datasette exited while starting up for the benchmark:\n\n{}".format(
+                    stderr.read().decode("utf-8", "replace").strip()
+                )
+            )
+        try:
+            if client.get("/-/versions.json").status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        time.sleep(0.1)
+    raise click.ClickException("Datasette did not start for the benchmark")
+
+
+def representative_paths(client):
+    "The index, then database, table and SQL query pages for the largest tables"
+    paths = ["/"]
+    for database in client.get("/-/databases.json").json():
+        route = "/" + tilde_encode(database["route"])
+        paths.append(route)
+        tables = [
+            table
+            for table in client.get(route + ".json").json()["tables"]
+            if not table["hidden"]
+        ]
+        tables.sort(key=lambda table: -(table["count"] or 0))
+        for table in tables[:MAX_TABLES]:
+            table_path = route + "/" + tilde_encode(table["name"])
+            sql = "select count(*) from [{}]".format(table["name"])
+            paths += [
+                table_path,
+                table_path + ".json",
+                route + ".json?" + urllib.parse.urlencode({"sql": sql}),
+            ]
+    return paths
+
+
+async def load(base_url, paths, concurrency, seconds):
+    "Returns (latencies of successful requests, error count, elapsed seconds)"
+    latencies = []
+    errors = 0
+    next_path = itertools.cycle(paths)
+    limits = httpx.Limits(max_connections=concurrency)
+
+    async with httpx.AsyncClient(
+        base_url=base_url, limits=limits, timeout=30
+    ) as client:
+        start = time.perf_counter()
+        deadline = start + seconds
+
+        async def worker():
+            nonlocal errors
+            while time.perf_counter() < deadline:
+                request_start = time.perf_counter()
+                try:
+                    response = await client.get(next(next_path))
+                except httpx.HTTPError:
+                    errors += 1
+                    continue
+                if response.status_code >= 500:
+                    errors += 1
+                else:
+                    latencies.append(time.perf_counter() - request_start)
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        return latencies, errors, time.perf_counter() - start
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run_benchmark(concurrency, seconds=BENCHMARK_SECONDS):
+    """
+    Serve the build context in the current directory and load it with
+    concurrency simultaneous requests. Returns a dictionary of results.
+    """
+    port = free_port()
+    # Not a pipe, which nothing reads once it has started - a full one
+    # would stall it part way through the benchmark
+    stderr = tempfile.TemporaryFile()
+    process = subprocess.Popen(
+        serve_args(port), stdout=subprocess.DEVNULL, stderr=stderr
+    )
+    base_url = "http://127.0.0.1:{}".format(port)
+    try:
+        with httpx.Client(base_url=base_url, timeout=30) as client:
+            wait_until_ready(client, process, stderr)
+            paths = representative_paths(client)
+        latencies, errors, elapsed = asyncio.run(
+            load(base_url, paths, concurrency, seconds)
+        )
+    finally:
+        process.terminate()
+        process.wait()
+        stderr.close()
+    if not latencies:
+        raise click.ClickException("Every request in the benchmark failed")
+    return {
+        "paths": len(paths),
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 0.5) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+    }
+
+
+def choose_machines(benchmark, target_rps, max_machines=None):
+    "Returns (vm_size, machine_count, list_of_reasons)"
+    reasons = [
+        "Local benchmark: {:.0f} requests/second across {} URLs with {} concurrent"
+        " requests, p50 {:.0f}ms, p95 {:.0f}ms, {} errors".format(
+            benchmark["rps"],
+            benchmark["paths"],
+            benchmark["concurrency"],
+            benchmark["p50_ms"],
+            benchmark["p95_ms"],
+            benchmark["errors"],
+        )
+    ]
+    options = []
+    for name, cores, cost in VM_SIZES:
+        speed = min(cores, DATASETTE_MAX_CORES)
+        machine_rps = benchmark["rps"] * speed * TARGET_UTILIZATION
+        count = max(1, math.ceil(target_rps / machine_rps))
+        if max_machines:
+            count = min(count, max_machines)
+        p95_ms = benchmark["p95_ms"] / speed
+        options.append((count * cost, count, name, machine_rps, p95_ms))
+    suitable = [
+        option
+        for option in options
+        if option[4] <= MAX_P95_MS and option[1] * option[3] >= target_rps
+    ]
+    if not suitable:
+        # Nothing is big enough - make do with the fastest
+        suitable = options[-1:]
+        reasons.append(
+            "Warning: no VM size can serve {:.0f} requests/second with a p95 under"
+            " {}ms{}".format(
+                target_rps,
+                MAX_P95_MS,
+                " on {} machine(s)".format(max_machines) if max_machines else "",
+            )
+        )
+    # The cheapest, then the fewest machines
+    cost, count, name, machine_rps, p95_ms = min(suitable)
+    reasons += [
+        "{}: about {:.0f} requests/second per machine at {:.0%} utilization,"
+        " p95 around {:.0f}ms".format(name, machine_rps, TARGET_UTILIZATION, p95_ms),
+        "{:.0f} requests/second / {:.0f} per machine = {} machine{},"
+        " about ${:.2f}/month".format(
+            target_rps,
+            machine_rps,
+            count,
+            "" if count == 1 else "s",
+            cost,
+        ),
+        "VM size: {}, machines: {}".format(name, count),
+    ]
+    return name, count, reasons
@@ -0,0 +1,65 @@
+"""
+Splits large databases into chunks for --chunk-size
+
+Each chunk becomes a layer of its own, so the image is pushed and pulled
+in parallel rather than as one huge layer. The chunks are put back together
+by chunks.py before Datasette starts.
+"""
+from . import chunks
+import click
+import json
+import os
+import shutil
+import time
+
+CHUNKS_DIR = "chunks"
+ASSEMBLE = "python3 {}/assemble.py".format(CHUNKS_DIR)
+INSPECT_FILE = " --inspect-file inspect-data.json"
+
+
+def files_to_chunk(paths, chunk_size):
+    return [path for path in paths if os.path.getsize(path) > chunk_size]
+
+
+def chunk_databases(filenames, chunk_size):
+    """
+    Split the files in the current directory bigger than chunk_size bytes
+    and reassemble them at start-up. Returns the names of the files split.
+    """
+    large = files_to_chunk(filenames, chunk_size)
+    if not large:
+        return []
+    os.makedirs(CHUNKS_DIR)
+    entries = []
+    for name in large:
+        start = time.perf_counter()
+        entry = chunks.split_file(name, CHUNKS_DIR, chunk_size)
+        os.remove(name)
+        click.echo(
+            "Split {} into {} chunks in {:.2f}s".format(
+                name, len(entry["chunks"]), time.perf_counter() - start
+            ),
+            err=True,
+        )
+        entries.append(entry)
+    with open(os.path.join(CHUNKS_DIR, chunks.MANIFEST), "w") as fp:
+        json.dump(entries, fp, indent=2)
+    shutil.copy(chunks.__file__, os.path.join(CHUNKS_DIR, "assemble.py"))
+
+    lines = open("Dockerfile").read().split("\n")
+    for index, line in enumerate(lines):
+        if line.startswith("RUN datasette inspect "):
+            # The files don't exist until start-up, Datasette can count
+            # their rows then instead
+            remaining = [bit for bit in line.split(" ") if bit not in large]
+            if remaining[3:4] == ["--inspect-file"]:
+                del lines[index]
+                lines[-1] = lines[-1].replace(INSPECT_FILE, "")
+            else:
+                lines[index] = " ".join(remaining)
+            break
+    lines[-1] = lines[-1].replace(
+        "datasette serve", "{} && datasette serve".format(ASSEMBLE), 1
+    )
+    open("Dockerfile", "w").write("\n".join(lines))
+    return large
@@ -0,0 +1,148 @@
+"""
+Splits database files into fixed-size chunks and puts them back together
+
+This module only uses the standard library: it is also copied into the
+image as chunks/assemble.py and run before Datasette starts, to reassemble
+the databases - onto the volume if there is one, so that later restarts
+can skip it.
+"""
+import hashlib
+import json
+import os
+import sys
+import time
+
+MANIFEST = "manifest.json"
+BLOCK_SIZE = 1024 * 1024
+VOLUME = os.environ.get("DATASETTE_PUBLISH_FLY_VOLUME", "/data")
+# Hidden from the /data/*.db glob that serves the volume's databases
+VOLUME_DIRECTORY = ".chunked-databases"
+
+
+def split_file(path, directory, chunk_size):
+    "Split path into files of chunk_size bytes in directory, returns its manifest entry"
+    name = os.path.basename(path)
+    total = hashlib.sha256()
+    chunks = []
+    with open(path, "rb") as source:
+        while True:
+            chunk_name = "{}.{:03d}".format(name, len(chunks))
+            chunk_path = os.path.join(directory, chunk_name)
+            chunk_hash = hashlib.sha256()
+            written = 0
+            with open(chunk_path, "wb") as target:
+                while written < chunk_size:
+                    block = source.read(min(BLOCK_SIZE, chunk_size - written))
+                    if not block:
+                        break
+                    target.write(block)
+                    chunk_hash.update(block)
+                    total.update(block)
+                    written += len(block)
+            if not written:
+                os.remove(chunk_path)
+                break
+            chunks.append(
+                {"file": chunk_name, "size": written, "sha256": chunk_hash.hexdigest()}
+            )
+            if written < chunk_size:
+                break
+    return {
+        "name": name,
+        "size": sum(chunk["size"] for chunk in chunks),
+        "sha256": total.hexdigest(),
+        "chunks": chunks,
+    }
+
+
+def assemble(directory, entry, destination):
+    "Join the chunks of a manifest entry into destination, checking every checksum"
+    partial = destination + ".partial"
+    total = hashlib.sha256()
+    try:
+        with open(partial, "wb") as target:
+            for chunk in entry["chunks"]:
+                chunk_hash = hashlib.sha256()
+                with open(os.path.join(directory, chunk["file"]), "rb") as source:
+                    for block in iter(lambda: source.read(BLOCK_SIZE), b""):
+                        chunk_hash.update(block)
+                        total.update(block)
+                        target.write(block)
+                if chunk_hash.hexdigest() != chunk["sha256"]:
+                    raise ValueError(
+                        "Checksum mismatch in chunk {}".format(chunk["file"])
+                    )
+            target.flush()
+            os.fsync(target.fileno())
+        if total.hexdigest() != entry["sha256"]:
+            raise ValueError("Checksum mismatch reassembling {}".format(entry["name"]))
+        os.replace(partial, destination)
+    except BaseException:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+
+
+def destination_directory(directory):
+    "Where to reassemble the databases from the chunks in directory"
+    if os.path.ismount(VOLUME):
+        return os.path.join(VOLUME, VOLUME_DIRECTORY)
+    # Next to the chunks directory, where the whole files would have been
+    return os.path.dirname(os.path.abspath(directory))
+
+
+def assemble_all(directory):
+    "Reassemble every database in the manifest, yields (name, chunks or None if skipped)"
+    with open(os.path.join(directory, MANIFEST)) as fp:
+        entries = json.load(fp)
+    app_directory = os.path.dirname(os.path.abspath(directory))
+    target_directory = destination_directory(directory)
+    os.makedirs(target_directory, exist_ok=True)
+    for entry in entries:
+        destination = os.path.join(target_directory, entry["name"])
+        stamp = destination + ".sha256"
+        if os.path.exists(destination) and os.path.exists(stamp):
+            with open(stamp) as fp:
+                assembled = fp.read().strip() == entry["sha256"]
+        else:
+            assembled = False
+        if not assembled:
+            assemble(directory, entry, destination)
+            with open(stamp, "w") as fp:
+                fp.write(entry["sha256"])
+        link = os.path.join(app_directory, entry["name"])
+        if link != destination:
+            if os.path.lexists(link):
+                os.remove(link)
+            os.symlink(destination, link)
+        yield entry["name"], None if assembled else len(entry["chunks"])
+    if target_directory != app_directory:
+        # Databases from previous deploys that are no longer published
+        names = {entry["name"] for entry in entries}
+        names |= {name + ".sha256" for name in names}
+        for name in os.listdir(target_directory):
+            if name not in names:
+                os.remove(os.path.join(target_directory, name))
+
+
+def main(argv):
+    directory = os.path.dirname(os.path.abspath(argv[0]))
+    start = time.perf_counter()
+    try:
+        for name, chunks in assemble_all(directory):
+            if chunks is None:
+                print("{} is already reassembled".format(name), file=sys.stderr)
+            else:
+                print(
+                    "Reassembled {} from {} chunks in {:.1f}s".format(
+                        name, chunks, time.perf_counter() - start
+                    ),
+                    file=sys.stderr,
+                )
+            start = time.perf_counter()
+    except (OSError, ValueError) as e:
+        sys.exit("Could not reassemble databases: {}".format(e))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
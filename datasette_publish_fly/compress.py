@@ -0,0 +1,109 @@
+from concurrent.futures import ProcessPoolExecutor
+import click
+import gzip
+import json
+import os
+import shlex
+import shutil
+import time
+
+EXTENSIONS = {"gzip": ".gz", "zstd": ".zst"}
+
+# The files are decompressed in a stage of their own, so only the
+# decompressed copies end up in the image
+DECOMPRESS_STAGE = "decompress"
+DECOMPRESS_IMAGE = "debian:bullseye-slim"
+DECOMPRESS_INSTALL = {
+    # Ahead of the files, so this layer stays cached when they change
+    "zstd": (
+        "RUN apt-get update && apt-get install -y --no-install-recommends "
+        "zstd && rm -rf /var/lib/apt/lists/*"
+    ),
+}
+DECOMPRESS_DOCKERFILE = {
+    "gzip": "RUN gunzip {files}",
+    "zstd": "RUN zstd -d --rm -q {files}",
+}
+
+
+def check_compression_available(method):
+    if method == "zstd":
+        try:
+            import zstandard  # noqa
+        except ImportError:
+            raise click.ClickException(
+                "--compress zstd requires the zstandard package: "
+                "pip install zstandard"
+            )
+
+
+def compress_file(path, method):
+    start = time.perf_counter()
+    destination = path + EXTENSIONS[method]
+    with open(path, "rb") as source:
+        if method == "zstd":
+            import zstandard
+
+            with open(destination, "wb") as target:
+                zstandard.ZstdCompressor(threads=-1).copy_stream(source, target)
+        else:
+            # No timestamp, so the same file always compresses the same
+            with open(destination, "wb") as fp, gzip.GzipFile(
+                fileobj=fp, mode="wb", compresslevel=6, mtime=0
+            ) as target:
+                shutil.copyfileobj(source, target, 1024 * 1024)
+    original_size = os.path.getsize(path)
+    os.remove(path)
+    return (
+        os.path.basename(path),
+        original_size,
+        os.path.getsize(destination),
+        time.perf_counter() - start,
+    )
+
+
+def compress_databases(filenames, method):
+    """
+    Compress files in the current directory and add a Dockerfile stage to
+    restore them. Returns the names of the compressed files, which must be
+    left out of COPY . /app.
+    """
+    if not filenames:
+        return []
+    with ProcessPoolExecutor() as executor:
+        results = list(
+            executor.map(compress_file, filenames, [method] * len(filenames))
+        )
+    for name, original_size, compressed_size, duration in results:
+        click.echo(
+            "Compressed {} with {}: {:,} -> {:,} bytes ({:.1f}x) in {:.2f}s".format(
+                name,
+                method,
+                original_size,
+                compressed_size,
+                original_size / compressed_size if compressed_size else 0,
+                duration,
+            ),
+            err=True,
+        )
+    compressed = [name + EXTENSIONS[method] for name in filenames]
+    stage = [
+        "FROM {} AS {}".format(DECOMPRESS_IMAGE, DECOMPRESS_STAGE),
+        "WORKDIR /decompress",
+    ]
+    if method in DECOMPRESS_INSTALL:
+        stage.append(DECOMPRESS_INSTALL[method])
+    stage += [
+        "COPY {}".format(json.dumps(compressed + ["./"])),
+        DECOMPRESS_DOCKERFILE[method].format(
+            files=" ".join(shlex.quote(name) for name in compressed)
+        ),
+    ]
+    lines = open("Dockerfile").read().split("\n")
+    # Before the "datasette inspect" step needs the files
+    lines.insert(
+        lines.index("WORKDIR /app") + 1,
+        "COPY --from={} /decompress/ /app/".format(DECOMPRESS_STAGE),
+    )
+    open("Dockerfile", "w").write("\n".join(stage + [""] + lines))
+    return compressed
@@ -0,0 +1,41 @@
+import os
+import pathlib
+import shlex
+import shutil
+
+CONTAINER_PLUGINS = pathlib.Path(__file__).parent / "container_plugins"
+
+
+def dockerfile_steps(lines):
+    "Group lines ending in \\ with the lines that continue them"
+    steps = []
+    continued = False
+    for line in lines:
+        if continued:
+            steps[-1].append(line)
+        else:
+            steps.append([line])
+        continued = line.endswith("\\")
+    return steps
+
+
+def add_serve_options(options):
+    "Add options to the 'datasette serve' CMD line of the Dockerfile"
+    lines = open("Dockerfile").read().split("\n")
+    assert lines[-1].startswith("CMD ")
+    lines[-1] = lines[-1].replace(
+        " --port $PORT",
+        "".join(" " + shlex.quote(option) for option in options) + " --port $PORT",
+    )
+    open("Dockerfile", "w").write("\n".join(lines))
+
+
+def add_container_plugin(name):
+    "Copy one of the plugins in container_plugins/ into the build context"
+    os.makedirs("plugins", exist_ok=True)
+    shutil.copy(
+        str(CONTAINER_PLUGINS / "{}.py".format(name)),
+        os.path.join("plugins", "datasette_publish_fly_{}.py".format(name)),
+    )
+    if " --plugins-dir plugins/ " not in open("Dockerfile").read():
+        add_serve_options(["--plugins-dir", "plugins/"])
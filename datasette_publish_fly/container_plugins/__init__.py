@@ -0,0 +1,2 @@
+# Datasette plugins that are copied into the plugins/ directory of the
+# generated application. Each one has to work as a standalone module.
@@ -0,0 +1,181 @@
+"""
+Prometheus metrics for Datasette, served at /-/metrics
+
+Records request latency by route type, SQL execution time by database
+and the state of the SQL thread pool. Instrumentation costs a few
+microseconds per request and per query.
+"""
+from datasette import hookimpl
+from datasette.database import Database
+from datasette.utils.asgi import Response
+import bisect
+import threading
+import time
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    def __init__(self, name, help, label):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, label_value, seconds):
+        index = bisect.bisect_left(BUCKETS, seconds)
+        with self.lock:
+            series = self.series.get(label_value)
+            if series is None:
+                series = self.series[label_value] = [[0] * len(BUCKETS), 0, 0.0]
+            if index < len(BUCKETS):
+                series[0][index] += 1
+            series[1] += 1
+            series[2] += seconds
+
+    def render(self):
+        lines = [
+            "# HELP {} {}".format(self.name, self.help),
+            "# TYPE {} histogram".format(self.name),
+        ]
+        with self.lock:
+            series = {key: (list(b), c, s) for key, (b, c, s) in self.series.items()}
+        for label_value, (buckets, count, total) in sorted(series.items()):
+            label = '{}="{}"'.format(self.label, escape(label_value))
+            cumulative = 0
+            for bound, bucket_count in zip(BUCKETS, buckets):
+                cumulative += bucket_count
+                lines.append(
+                    '{}_bucket{{{},le="{}"}} {}'.format(
+                        self.name, label, bound, cumulative
+                    )
+                )
+            lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(self.name, label, count))
+            lines.append("{}_count{{{}}} {}".format(self.name, label, count))
+            lines.append("{}_sum{{{}}} {}".format(self.name, label, total))
+        return lines
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+REQUESTS = Histogram(
+    "datasette_request_duration_seconds", "HTTP request latency", "route"
+)
+QUERIES = Histogram(
+    "datasette_sql_duration_seconds", "SQL execution time", "database"
+)
+IN_FLIGHT = [0]
+
+
+def route_type(path, query_string):
+    if path.startswith("/-/static"):
+        return "static"
+    if b"sql=" in query_string:
+        return "query"
+    if "/-/" in path:
+        return "special"
+    depth = len([bit for bit in path.split("/") if bit])
+    return ("index", "database", "table", "row")[min(depth, 3)]
+
+
+@hookimpl
+def asgi_wrapper(datasette):
+    def wrap(app):
+        async def timed_app(scope, receive, send):
+            if scope["type"] != "http":
+                return await app(scope, receive, send)
+            start = time.perf_counter()
+            IN_FLIGHT[0] += 1
+            try:
+                await app(scope, receive, send)
+            finally:
+                IN_FLIGHT[0] -= 1
+                REQUESTS.observe(
+                    route_type(scope["path"], scope.get("query_string") or b""),
+                    time.perf_counter() - start,
+                )
+
+        return timed_app
+
+    return wrap
+
+
+def is_instrumented():
+    # Other plugins, like slow_queries, may have wrapped it since
+    execute = Database.execute
+    while execute is not None:
+        if getattr(execute, "_publish_fly_metrics", False):
+            return True
+        execute = getattr(execute, "__wrapped__", None)
+    return False
+
+
+def instrument_database_execute():
+    if is_instrumented():
+        return
+    original = Database.execute
+
+    async def execute(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await original(self, *args, **kwargs)
+        finally:
+            QUERIES.observe(self.name, time.perf_counter() - start)
+
+    execute._publish_fly_metrics = True
+    execute.__wrapped__ = original
+    Database.execute = execute
+
+
+@hookimpl
+def startup(datasette):
+    instrument_database_execute()
+
+
+def render_metrics(datasette):
+    lines = REQUESTS.render() + QUERIES.render()
+    executor = datasette.executor
+    gauges = [
+        ("datasette_requests_in_flight", "Requests being handled", IN_FLIGHT[0]),
+        (
+            "datasette_sql_threads",
+            "Size of the SQL thread pool",
+            executor._max_workers if executor else 0,
+        ),
+        (
+            "datasette_sql_queue_depth",
+            "SQL operations waiting for a thread",
+            executor._work_queue.qsize() if executor else 0,
+        ),
+        (
+            "datasette_sql_connections",
+            "Open SQLite connections",
+            sum(
+                len(getattr(db, "_all_file_connections", []))
+                for db in datasette.databases.values()
+            ),
+        ),
+    ]
+    for name, help, value in gauges:
+        lines.extend(
+            [
+                "# HELP {} {}".format(name, help),
+                "# TYPE {} gauge".format(name),
+                "{} {}".format(name, value),
+            ]
+        )
+    return "\n".join(lines) + "\n"
+
+
+@hookimpl
+def register_routes():
+    async def metrics(datasette):
+        return Response.text(
+            render_metrics(datasette),
+            headers={"content-type": "text/plain; version=0.0.4"},
+        )
+
+    return [(r"^/-/metrics$", metrics)]
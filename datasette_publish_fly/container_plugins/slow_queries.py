@@ -0,0 +1,120 @@
+"""
+Records slow SQL queries, served as JSON at /-/slow-queries.json
+
+Queries that take longer than DATASETTE_PUBLISH_FLY_SLOW_QUERY_MS are kept
+in a bounded in-memory buffer along with their EXPLAIN QUERY PLAN. If the
+/data volume is mounted they are also appended to a JSON lines file there,
+so they survive restarts.
+"""
+from datasette import hookimpl
+from datasette.database import Database
+from datasette.utils.asgi import Response
+import collections
+import datetime
+import json
+import os
+import threading
+import time
+
+THRESHOLD_MS = float(os.environ.get("DATASETTE_PUBLISH_FLY_SLOW_QUERY_MS", "1000"))
+BUFFER_SIZE = int(os.environ.get("DATASETTE_PUBLISH_FLY_SLOW_QUERY_BUFFER", "100"))
+VOLUME = os.path.abspath(os.environ.get("DATASETTE_PUBLISH_FLY_VOLUME", "/data"))
+# The log file is rotated to .1 once it grows past this size
+LOG_MAX_BYTES = 10 * 1024 * 1024
+
+SLOW_QUERIES = collections.deque(maxlen=BUFFER_SIZE)
+log_lock = threading.Lock()
+
+
+def log_path():
+    return os.path.join(VOLUME, ".datasette-slow-queries.jsonl")
+
+
+def append_to_log(entry):
+    if not os.path.isdir(VOLUME):
+        return
+    line = json.dumps(entry, default=repr) + "\n"
+    path = log_path()
+    with log_lock:
+        try:
+            if os.path.exists(path) and os.path.getsize(path) > LOG_MAX_BYTES:
+                os.replace(path, path + ".1")
+            with open(path, "a") as fp:
+                fp.write(line)
+        except OSError:
+            pass
+
+
+async def query_plan(database, sql, params):
+    def explain(conn):
+        return [
+            {"id": row[0], "parent": row[1], "detail": row[3]}
+            for row in conn.execute("explain query plan " + sql, params or [])
+        ]
+
+    try:
+        return await database.execute_fn(explain)
+    except Exception:
+        # Not everything can be explained, e.g. PRAGMA statements
+        return None
+
+
+async def record(database, sql, params, duration_ms):
+    entry = {
+        "time": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "database": database.name,
+        "sql": sql,
+        "params": params,
+        "duration_ms": round(duration_ms, 2),
+        "query_plan": await query_plan(database, sql, params),
+    }
+    SLOW_QUERIES.append(entry)
+    append_to_log(entry)
+
+
+def is_instrumented():
+    execute = Database.execute
+    while execute is not None:
+        if getattr(execute, "_publish_fly_slow_queries", False):
+            return True
+        execute = getattr(execute, "__wrapped__", None)
+    return False
+
+
+def instrument_database_execute():
+    if is_instrumented():
+        return
+    original = Database.execute
+
+    async def execute(self, sql, params=None, *args, **kwargs):
+        start = time.perf_counter()
+        results = await original(self, sql, params, *args, **kwargs)
+        duration_ms = (time.perf_counter() - start) * 1000
+        if duration_ms >= THRESHOLD_MS:
+            await record(self, sql, params, duration_ms)
+        return results
+
+    execute._publish_fly_slow_queries = True
+    execute.__wrapped__ = original
+    Database.execute = execute
+
+
+@hookimpl
+def startup(datasette):
+    instrument_database_execute()
+
+
+@hookimpl
+def register_routes():
+    async def slow_queries(datasette, request):
+        await datasette.ensure_permissions(request.actor, ["view-instance"])
+        return Response.json(
+            {
+                "threshold_ms": THRESHOLD_MS,
+                "buffer_size": BUFFER_SIZE,
+                "queries": list(reversed(SLOW_QUERIES)),
+            },
+            default=repr,
+        )
+
+    return [(r"^/-/slow-queries\.json$", slow_queries)]
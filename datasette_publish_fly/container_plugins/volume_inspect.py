@@ -0,0 +1,131 @@
+"""
+Precomputes table counts for the mutable databases on the /data volume
+
+Counts are calculated in a background thread, cached on the volume in
+.datasette-inspect.json and only recalculated for databases that have
+been modified since they were last counted.
+"""
+
+from datasette import hookimpl
+import json
+import os
+import sqlite3
+import threading
+
+VOLUME = os.path.abspath(os.environ.get("DATASETTE_PUBLISH_FLY_VOLUME", "/data"))
+INTERVAL = float(os.environ.get("DATASETTE_PUBLISH_FLY_INSPECT_INTERVAL", "60"))
+
+
+def cache_path():
+    return os.path.join(VOLUME, ".datasette-inspect.json")
+
+
+def modified_ns(path):
+    # WAL-mode writes only touch the -wal file until a checkpoint
+    times = [os.stat(path).st_mtime_ns]
+    if os.path.exists(path + "-wal"):
+        times.append(os.stat(path + "-wal").st_mtime_ns)
+    return max(times)
+
+
+def read_cache():
+    try:
+        with open(cache_path()) as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_cache(cache):
+    tmp_path = cache_path() + ".tmp"
+    with open(tmp_path, "w") as fp:
+        json.dump(cache, fp)
+    os.replace(tmp_path, cache_path())
+
+
+def count_tables(path):
+    conn = sqlite3.connect("file:{}?mode=ro".format(path), uri=True)
+    try:
+        tables = [
+            row[0]
+            for row in conn.execute(
+                "select name from sqlite_master where type = 'table'"
+            )
+        ]
+        return {
+            table: conn.execute(
+                "select count(*) from [{}]".format(table.replace("]", "]]"))
+            ).fetchone()[0]
+            for table in tables
+        }
+    finally:
+        conn.close()
+
+
+def volume_databases(datasette):
+    for database in datasette.databases.values():
+        if (
+            database.path
+            and database.is_mutable
+            and os.path.dirname(os.path.abspath(database.path)) == VOLUME
+        ):
+            yield database
+
+
+def refresh(datasette):
+    "Recount any volume database modified since it was last counted"
+    cache = read_cache()
+    changed = False
+    for database in volume_databases(datasette):
+        name = os.path.basename(database.path)
+        try:
+            mtime_ns = modified_ns(database.path)
+            entry = cache.get(name)
+            if entry and entry["mtime_ns"] == mtime_ns:
+                continue
+            cache[name] = {"mtime_ns": mtime_ns, "tables": count_tables(database.path)}
+            changed = True
+        except (OSError, sqlite3.Error):
+            continue
+    if changed:
+        write_cache(cache)
+    return cache
+
+
+def use_cached_counts(database, state):
+    original = database.table_counts
+    name = os.path.basename(database.path)
+
+    async def table_counts(limit=10):
+        entry = state["cache"].get(name)
+        if entry and entry["mtime_ns"] == modified_ns(database.path):
+            return dict(entry["tables"])
+        return await original(limit)
+
+    database.table_counts = table_counts
+
+
+def run_forever(datasette, state, stop):
+    while True:
+        try:
+            state["cache"] = refresh(datasette)
+        except Exception:
+            # A failed refresh just means slower counts - try again later
+            pass
+        if stop.wait(INTERVAL):
+            break
+
+
+@hookimpl
+def startup(datasette):
+    async def inner():
+        state = {"cache": read_cache()}
+        for database in volume_databases(datasette):
+            use_cached_counts(database, state)
+        stop = threading.Event()
+        datasette._publish_fly_inspect_stop = stop
+        threading.Thread(
+            target=run_forever, args=(datasette, state, stop), daemon=True
+        ).start()
+
+    return inner
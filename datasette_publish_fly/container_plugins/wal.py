@@ -0,0 +1,93 @@
+"""
+Runs the writable databases on the /data volume in WAL mode
+
+On startup each mutable database on the volume is switched to WAL mode, so
+writes no longer block readers. Every connection gets the synchronous and
+wal_autocheckpoint settings, and a background thread runs a passive
+checkpoint every DATASETTE_PUBLISH_FLY_WAL_CHECKPOINT_INTERVAL seconds so
+the -wal file doesn't grow between the automatic ones.
+"""
+
+from datasette import hookimpl
+import os
+import sqlite3
+import sys
+import threading
+
+VOLUME = os.path.abspath(os.environ.get("DATASETTE_PUBLISH_FLY_VOLUME", "/data"))
+SYNCHRONOUS = os.environ.get("DATASETTE_PUBLISH_FLY_WAL_SYNCHRONOUS", "NORMAL")
+AUTOCHECKPOINT = int(os.environ.get("DATASETTE_PUBLISH_FLY_WAL_AUTOCHECKPOINT", "1000"))
+INTERVAL = float(os.environ.get("DATASETTE_PUBLISH_FLY_WAL_CHECKPOINT_INTERVAL", "60"))
+# The -wal file is truncated back to this size after a checkpoint
+JOURNAL_SIZE_LIMIT = 64 * 1024 * 1024
+
+
+def is_on_volume(database):
+    return bool(
+        database.path
+        and database.is_mutable
+        and os.path.dirname(os.path.abspath(database.path)) == VOLUME
+    )
+
+
+def volume_databases(datasette):
+    return [db for db in datasette.databases.values() if is_on_volume(db)]
+
+
+def enable_wal(path):
+    conn = sqlite3.connect(path, timeout=5)
+    try:
+        return conn.execute("PRAGMA journal_mode = WAL").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def checkpoint(path):
+    "Returns (busy, wal pages, checkpointed pages)"
+    conn = sqlite3.connect(path, timeout=1)
+    try:
+        # PASSIVE never waits for readers or writers
+        return conn.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+    finally:
+        conn.close()
+
+
+def run_forever(paths, stop):
+    while not stop.wait(INTERVAL):
+        for path in paths:
+            try:
+                checkpoint(path)
+            except sqlite3.Error:
+                # Try again next time
+                pass
+
+
+@hookimpl
+def prepare_connection(conn, database, datasette):
+    db = datasette.databases.get(database)
+    if db is None or not is_on_volume(db):
+        return
+    conn.execute("PRAGMA synchronous = {}".format(SYNCHRONOUS))
+    conn.execute("PRAGMA wal_autocheckpoint = {}".format(AUTOCHECKPOINT))
+    conn.execute("PRAGMA journal_size_limit = {}".format(JOURNAL_SIZE_LIMIT))
+
+
+@hookimpl
+def startup(datasette):
+    paths = []
+    for database in volume_databases(datasette):
+        try:
+            mode = enable_wal(database.path)
+        except sqlite3.Error as e:
+            mode = str(e)
+        if mode == "wal":
+            paths.append(database.path)
+        else:
+            print(
+                "Could not switch {} to WAL mode: {}".format(database.path, mode),
+                file=sys.stderr,
+            )
+    stop = threading.Event()
+    datasette._publish_fly_wal_stop = stop
+    if paths and INTERVAL:
+        threading.Thread(target=run_forever, args=(paths, stop), daemon=True).start()
@@ -0,0 +1,112 @@
+import click
+import fnmatch
+import os
+import pathlib
+
+# Written to .dockerignore as **/{name} so they match at any depth
+IGNORED_NAMES = (
+    ".git",
+    ".hg",
+    ".svn",
+    "__pycache__",
+    "*.pyc",
+    "*.pyo",
+    ".DS_Store",
+    "Thumbs.db",
+    ".ipynb_checkpoints",
+    "*.db-journal",
+    "*.db-wal",
+    "*.db-shm",
+    "*.swp",
+    "*~",
+)
+
+DATABASE_EXTENSIONS = (".db", ".sqlite", ".sqlite3", ".gz", ".zst")
+
+# Anything other than a database bigger than this is probably a mistake
+LARGE_FILE_BYTES = 10 * 1024 * 1024
+
+
+def write_dockerignore():
+    with open(".dockerignore", "w") as fp:
+        fp.write("".join("**/{}\n".format(name) for name in IGNORED_NAMES))
+
+
+def is_ignored(relative_path):
+    return any(
+        fnmatch.fnmatch(part, name)
+        for part in pathlib.PurePath(relative_path).parts
+        for name in IGNORED_NAMES
+    )
+
+
+def categorize(relative_path, static_mounts):
+    parts = pathlib.PurePath(relative_path).parts
+    if len(parts) > 1:
+        if parts[0] == "templates":
+            return "templates"
+        if parts[0] == "plugins":
+            return "plugins"
+        if parts[0] in static_mounts:
+            return "static"
+    elif relative_path.endswith(DATABASE_EXTENSIONS):
+        return "databases"
+    return "other"
+
+
+def context_files(static_mounts=()):
+    "Yields (relative_path, category, size) for files that will be sent to the builder"
+    for root, dirs, files in os.walk("."):
+        for filename in files:
+            relative_path = os.path.relpath(os.path.join(root, filename), ".")
+            if is_ignored(relative_path):
+                continue
+            yield (
+                relative_path,
+                categorize(relative_path, static_mounts),
+                os.path.getsize(relative_path),
+            )
+
+
+def context_sizes(static_mounts=()):
+    sizes = {}
+    large_files = []
+    for relative_path, category, size in context_files(static_mounts):
+        sizes[category] = sizes.get(category, 0) + size
+        if category != "databases" and size > LARGE_FILE_BYTES:
+            large_files.append((relative_path, size))
+    return sizes, large_files
+
+
+def echo_context_report(static_mounts=()):
+    "Reports the size of the build context, returns it in bytes"
+    sizes, large_files = context_sizes(static_mounts)
+    click.echo(
+        "Build context: {}".format(
+            ", ".join(
+                "{} {}".format(category, format_bytes(size))
+                for category, size in sorted(sizes.items(), key=lambda p: -p[1])
+            )
+            + " (total {})".format(format_bytes(sum(sizes.values())))
+        ),
+        err=True,
+    )
+    for relative_path, size in large_files:
+        click.secho(
+            "Warning: {} is {} - is it meant to be deployed?".format(
+                relative_path, format_bytes(size)
+            ),
+            fg="yellow",
+            err=True,
+        )
+    return sum(sizes.values())
+
+
+def format_bytes(size):
+    for unit in ("bytes", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            break
+        size /= 1024
+    if unit == "bytes":
+        return "{} bytes".format(size)
+    return "{:.1f} {}".format(size, unit)
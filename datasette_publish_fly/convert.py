@@ -0,0 +1,317 @@
+"""
+Converts CSV, TSV and newline-delimited JSON files to SQLite for publishing
+
+Rows are streamed into the database in batches, so memory use doesn't
+grow with the size of the file. Column types are inferred from a sample
+of the first rows and indexes are created once all of the rows are in.
+"""
+from .utils import cache_dir
+from concurrent.futures import ProcessPoolExecutor
+import click
+import csv
+import hashlib
+import itertools
+import json
+import os
+import re
+import sqlite3
+import sys
+import time
+
+FORMATS = {".csv": "csv", ".tsv": "tsv", ".ndjson": "ndjson", ".jsonl": "ndjson"}
+
+SAMPLE_SIZE = 1000
+BATCH_SIZE = 10000
+
+INTEGER_RE = re.compile(r"^-?[0-9]+$")
+# Leading zeros mean an identifier, like a ZIP code, not a number
+LEADING_ZERO_RE = re.compile(r"^-?0[0-9]")
+FLOAT_RE = re.compile(r"^-?([0-9]+\.[0-9]*|\.[0-9]+|[0-9]+)([eE][-+]?[0-9]+)?$")
+
+# Bump this to invalidate previously converted files
+CONVERT_VERSION = 1
+
+
+def is_convertible(path):
+    return os.path.splitext(path)[1].lower() in FORMATS
+
+
+def iter_csv(path, delimiter):
+    "Yields the column names, then each row as a list"
+    # Big fields are common in exports, the default limit is 128KB
+    csv.field_size_limit(min(sys.maxsize, 2**31 - 1))
+    with open(path, newline="", encoding="utf-8-sig") as fp:
+        reader = csv.reader(fp, delimiter=delimiter)
+        try:
+            yield unique_columns(next(reader, []))
+            yield from reader
+        except UnicodeDecodeError:
+            raise invalid_line(path, first_undecodable_line(path), "is not UTF-8 text")
+
+
+def iter_ndjson(path):
+    with open(path, encoding="utf-8") as fp:
+        try:
+            for number, line in enumerate(fp, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    row = json.loads(line)
+                except ValueError as e:
+                    raise invalid_line(
+                        path, number, "is not valid JSON: {}".format(e.msg)
+                    )
+                if not isinstance(row, dict):
+                    raise invalid_line(path, number, "is not a JSON object")
+                yield row
+        except UnicodeDecodeError:
+            raise invalid_line(path, first_undecodable_line(path), "is not UTF-8 text")
+
+
+def invalid_line(path, number, problem):
+    return click.ClickException(
+        "{} line {} {}".format(os.path.basename(path), number, problem)
+    )
+
+
+def first_undecodable_line(path):
+    # Text files are decoded a block at a time, so the error doesn't say
+    # which line it was in
+    with open(path, "rb") as fp:
+        for number, line in enumerate(fp, 1):
+            try:
+                line.decode("utf-8")
+            except UnicodeDecodeError:
+                return number
+
+
+def unique_columns(headers):
+    columns = []
+    for i, header in enumerate(headers):
+        column = header.strip() or "column_{}".format(i + 1)
+        while column in columns:
+            column += "_"
+        columns.append(column)
+    return columns
+
+
+def infer_type(values):
+    "SQLite column type that fits every value in the sample"
+    values = [value for value in values if value not in (None, "")]
+    if not values:
+        return "TEXT"
+    if all(isinstance(value, (bool, int)) for value in values):
+        return "INTEGER"
+    if all(isinstance(value, (bool, int, float)) for value in values):
+        return "REAL"
+    if all(isinstance(value, str) for value in values):
+        if any(LEADING_ZERO_RE.match(value) for value in values):
+            return "TEXT"
+        if all(
+            INTEGER_RE.match(value) and -(2**63) <= int(value) < 2**63
+            for value in values
+        ):
+            return "INTEGER"
+        if all(FLOAT_RE.match(value) for value in values):
+            return "REAL"
+    return "TEXT"
+
+
+def convert_value(value, column_type):
+    if value is None or value == "":
+        return None
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    if isinstance(value, str) and column_type != "TEXT":
+        try:
+            return int(value) if column_type == "INTEGER" else float(value)
+        except ValueError:
+            # The sample was wrong about this column - keep the text
+            return value
+    return value
+
+
+def quote(identifier):
+    return '"{}"'.format(identifier.replace('"', '""'))
+
+
+def convert_file(path, database_path, indexes=()):
+    "Load path into a table in a new database, returns (table, row count)"
+    table = os.path.splitext(os.path.basename(path))[0]
+    format = FORMATS[os.path.splitext(path)[1].lower()]
+    if format == "ndjson":
+        rows = iter_ndjson(path)
+        sample = list(itertools.islice(rows, SAMPLE_SIZE))
+        columns = unique_columns(list(dict.fromkeys(k for row in sample for k in row)))
+        types = [infer_type([row.get(c) for row in sample]) for c in columns]
+    else:
+        rows = iter_csv(path, "\t" if format == "tsv" else ",")
+        columns = next(rows)
+        sample = list(itertools.islice(rows, SAMPLE_SIZE))
+        types = [
+            infer_type([row[i] for row in sample if i < len(row)])
+            for i in range(len(columns))
+        ]
+    missing = [column for column in indexes if column not in columns]
+    if missing:
+        raise click.ClickException(
+            "Cannot index {}, it has no column {}".format(table, ", ".join(missing))
+        )
+    if os.path.exists(database_path):
+        os.remove(database_path)
+    conn = sqlite3.connect(database_path, isolation_level=None)
+    # A failed conversion is thrown away, so durability doesn't matter yet
+    conn.execute("PRAGMA journal_mode = OFF")
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.execute(
+        "CREATE TABLE {} ({})".format(
+            quote(table),
+            ", ".join("{} {}".format(quote(c), t) for c, t in zip(columns, types)),
+        )
+    )
+    count = 0
+    for batch in batches(itertools.chain(sample, rows), BATCH_SIZE):
+        if format == "ndjson":
+            for column in dict.fromkeys(k for row in batch for k in row):
+                if column not in columns:
+                    column_type = infer_type([row.get(column) for row in batch])
+                    conn.execute(
+                        "ALTER TABLE {} ADD COLUMN {} {}".format(
+                            quote(table), quote(column), column_type
+                        )
+                    )
+                    columns.append(column)
+                    types.append(column_type)
+            batch = [[row.get(c) for c in columns] for row in batch]
+        width = len(columns)
+        conn.execute("BEGIN")
+        conn.executemany(
+            "INSERT INTO {} VALUES ({})".format(
+                quote(table), ", ".join("?" for _ in columns)
+            ),
+            (
+                # Short CSV rows are padded with nulls, long ones truncated
+                [
+                    convert_value(value, column_type)
+                    for value, column_type in zip(
+                        row + [None] * (width - len(row)), types
+                    )
+                ]
+                for row in batch
+            ),
+        )
+        conn.execute("COMMIT")
+        count += len(batch)
+    for column in indexes:
+        conn.execute(
+            "CREATE INDEX {} ON {} ({})".format(
+                quote("idx_{}_{}".format(table, column)), quote(table), quote(column)
+            )
+        )
+    # Statistics for the query planner, now the indexes exist
+    conn.execute("ANALYZE")
+    conn.execute("PRAGMA journal_mode = DELETE")
+    conn.close()
+    return table, count
+
+
+def batches(rows, size):
+    while True:
+        batch = list(itertools.islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+def source_info(path, indexes):
+    stat = os.stat(path)
+    return {
+        "version": CONVERT_VERSION,
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "indexes": sorted(indexes),
+    }
+
+
+def timed_convert(path, database_path, indexes):
+    start = time.perf_counter()
+    table, count = convert_file(path, database_path, indexes)
+    return table, count, time.perf_counter() - start
+
+
+def convert_files(files, indexes=()):
+    """
+    Replace CSV, TSV and newline-delimited JSON files in files with SQLite
+    databases, converting them in parallel. Conversions are kept in the
+    cache directory and reused until the source file changes.
+    """
+    table_indexes = {}
+    for index in indexes:
+        table, _, column = index.partition(".")
+        table_indexes.setdefault(table, []).append(column)
+    stems = [os.path.splitext(os.path.basename(path))[0] for path in files]
+    duplicates = {stem for stem in stems if stems.count(stem) > 1}
+    if duplicates:
+        raise click.ClickException(
+            "Files would be published with the same name: {}".format(
+                ", ".join(sorted(duplicates))
+            )
+        )
+    unknown = set(table_indexes) - {
+        stem for stem, path in zip(stems, files) if is_convertible(path)
+    }
+    if unknown:
+        raise click.ClickException(
+            "--index refers to tables that are not being converted: {}".format(
+                ", ".join(sorted(unknown))
+            )
+        )
+    converted = []
+    to_convert = []
+    for path, stem in zip(files, stems):
+        if not is_convertible(path):
+            converted.append(path)
+            continue
+        directory = (
+            cache_dir()
+            / "converted"
+            / hashlib.sha256(os.path.abspath(path).encode("utf-8")).hexdigest()[:16]
+        )
+        directory.mkdir(parents=True, exist_ok=True)
+        database_path = str(directory / "{}.db".format(stem))
+        converted.append(database_path)
+        table_index_columns = table_indexes.get(stem, [])
+        info = source_info(path, table_index_columns)
+        info_path = directory / "source.json"
+        if (
+            os.path.exists(database_path)
+            and info_path.exists()
+            and json.loads(info_path.read_text("utf-8")) == info
+        ):
+            click.echo(
+                "Using previous conversion of {}".format(os.path.basename(path)),
+                err=True,
+            )
+            continue
+        if info_path.exists():
+            info_path.unlink()
+        to_convert.append((path, database_path, table_index_columns, info_path, info))
+    if to_convert:
+        with ProcessPoolExecutor() as executor:
+            results = list(executor.map(timed_convert, *list(zip(*to_convert))[:3]))
+        for (path, database_path, _, info_path, info), result in zip(
+            to_convert, results
+        ):
+            table, count, duration = result
+            info_path.write_text(json.dumps(info), "utf-8")
+            click.echo(
+                "Converted {} to {}: {:,} rows in {:.1f}s".format(
+                    os.path.basename(path),
+                    os.path.basename(database_path),
+                    count,
+                    duration,
+                ),
+                err=True,
+            )
+    return converted
@@ -0,0 +1,109 @@
+from concurrent.futures import ProcessPoolExecutor
+from .context import format_bytes
+import click
+import os
+import sqlite3
+
+# Warn if more than this fraction of the file is unused pages
+FREELIST_WARNING = 0.25
+
+
+def row_estimate(conn, table, stats):
+    if table in stats:
+        # First number in sqlite_stat1.stat is the approximate row count
+        return int(stats[table].split()[0])
+    try:
+        return conn.execute(
+            "select max(_rowid_) from [{}]".format(table.replace("]", "]]"))
+        ).fetchone()[0] or 0
+    except sqlite3.Error:
+        # e.g. WITHOUT ROWID tables and virtual tables
+        return None
+
+
+def scan_database(path, full=False):
+    result = {
+        "path": path,
+        "size": os.path.getsize(path),
+        "errors": [],
+        "warnings": [],
+        "tables": {},
+    }
+    if os.path.exists(path + "-wal") and os.path.getsize(path + "-wal"):
+        result["warnings"].append(
+            "has a -wal file - changes that have not been checkpointed will not be published"
+        )
+    try:
+        conn = sqlite3.connect("file:{}?mode=ro".format(path), uri=True)
+        try:
+            check = "integrity_check" if full else "quick_check"
+            problems = [row[0] for row in conn.execute("PRAGMA {}".format(check))]
+            if problems != ["ok"]:
+                result["errors"].extend(problems)
+            result["page_size"] = conn.execute("PRAGMA page_size").fetchone()[0]
+            result["page_count"] = conn.execute("PRAGMA page_count").fetchone()[0]
+            result["freelist_count"] = conn.execute(
+                "PRAGMA freelist_count"
+            ).fetchone()[0]
+            stats = {}
+            if conn.execute(
+                "select 1 from sqlite_master where name = 'sqlite_stat1'"
+            ).fetchone():
+                stats = dict(
+                    conn.execute("select tbl, stat from sqlite_stat1").fetchall()
+                )
+            tables = [
+                row[0]
+                for row in conn.execute(
+                    "select name from sqlite_master where type = 'table'"
+                )
+            ]
+            for table in tables:
+                result["tables"][table] = row_estimate(conn, table, stats)
+        finally:
+            conn.close()
+    except sqlite3.DatabaseError as ex:
+        result["errors"].append(str(ex))
+        return result
+    if (
+        result["page_count"]
+        and result["freelist_count"] / result["page_count"] > FREELIST_WARNING
+    ):
+        result["warnings"].append(
+            "{} of free pages - run VACUUM to shrink it".format(
+                format_bytes(result["freelist_count"] * result["page_size"])
+            )
+        )
+    return result
+
+
+def scan_databases(paths, full=False):
+    with ProcessPoolExecutor() as executor:
+        return list(executor.map(scan_database, paths, [full] * len(paths)))
+
+
+def verify_databases(paths, full=False):
+    "Scan databases in parallel, raising ClickException if any are broken"
+    if not paths:
+        return []
+    results = scan_databases(paths, full)
+    failed = False
+    for result in results:
+        summary = "{}: {}".format(result["path"], format_bytes(result["size"]))
+        if "page_count" in result:
+            rows = [count for count in result["tables"].values() if count]
+            summary += ", {:,} pages, {:,} free, {} tables, ~{:,} rows".format(
+                result["page_count"],
+                result["freelist_count"],
+                len(result["tables"]),
+                sum(rows),
+            )
+        click.echo(summary, err=True)
+        for warning in result["warnings"]:
+            click.secho("  Warning: {}".format(warning), fg="yellow", err=True)
+        for error in result["errors"]:
+            failed = True
+            click.secho("  Error: {}".format(error), fg="red", err=True)
+    if failed:
+        raise click.ClickException("Database check failed, nothing was published")
+    return results
@@ -0,0 +1,76 @@
+"""
+Runs the --create-db databases under LiteFS so they can be replicated
+
+LiteFS mounts a FUSE filesystem at /litefs, keeps its own data on the
+volume and replicates changes from the primary machine to the others.
+Its proxy sits in front of Datasette and sends writes to the primary.
+"""
+import json
+import shlex
+
+LITEFS_IMAGE = "flyio/litefs:0.5"
+
+# The LiteFS proxy takes over the port Fly sends traffic to
+DATASETTE_PORT = 8081
+
+LITEFS_YML = """fuse:
+  dir: "/litefs"
+
+data:
+  dir: "/data/litefs"
+
+exit-on-error: false
+
+proxy:
+  addr: ":8080"
+  target: "localhost:{datasette_port}"
+  db: {db}
+  passthrough:
+    - "/-/static/*"
+
+exec:
+  - cmd: {cmd}
+
+lease:
+  type: "consul"
+  advertise-url: "http://${{HOSTNAME}}.vm.${{FLY_APP_NAME}}.internal:20202"
+  candidate: ${{FLY_REGION == PRIMARY_REGION}}
+  promote: true
+  consul:
+    url: "${{FLY_CONSUL_URL}}"
+    key: "litefs/${{FLY_APP_NAME}}"
+"""
+
+INSTALL_STEPS = [
+    "RUN apt-get update && apt-get install -y ca-certificates fuse3 && "
+    "rm -rf /var/lib/apt/lists/*",
+    "COPY --from={} /usr/local/bin/litefs /usr/local/bin/litefs".format(LITEFS_IMAGE),
+]
+
+
+def configure_litefs(primary_database):
+    """
+    Switch the Dockerfile in the current directory from serving /data to
+    running Datasette against /litefs under "litefs mount", and write litefs.yml
+    """
+    lines = open("Dockerfile").read().strip().split("\n")
+    # The volume CMD line: ["/bin/bash", "-c", "shopt -s nullglob && ..."]
+    command = json.loads(lines[-1][len("CMD ") :])
+    command[-1] = (
+        command[-1]
+        .replace("/data/", "/litefs/")
+        .replace("--port $PORT", "--port {}".format(DATASETTE_PORT))
+    )
+    lines[-1] = 'ENTRYPOINT ["litefs", "mount"]\n'
+    index = lines.index("WORKDIR /app") + 1
+    lines[index:index] = INSTALL_STEPS
+    open("Dockerfile", "w").write("\n".join(lines))
+    # JSON strings are valid double-quoted YAML strings
+    with open("litefs.yml", "w") as fp:
+        fp.write(
+            LITEFS_YML.format(
+                datasette_port=DATASETTE_PORT,
+                db=json.dumps(primary_database),
+                cmd=json.dumps(" ".join(shlex.quote(bit) for bit in command)),
+            )
+        )
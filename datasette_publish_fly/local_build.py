@@ -0,0 +1,82 @@
+"""
+Builds the image on this machine with Docker BuildKit, for --build local
+
+This can use a warm layer cache - a directory or a registry - rather than
+starting from nothing on Fly's remote builder.
+"""
+from .base_image import BASE_STEPS, REGISTRY
+from .container import dockerfile_steps
+from .runner import run, PIPE
+import click
+import os
+import shutil
+import time
+
+
+def install_before_copy():
+    """
+    Move the install steps of the Datasette-generated Dockerfile above
+    COPY . /app, so new data doesn't invalidate their cached layers
+    """
+    lines = open("Dockerfile").read().split("\n")
+    install_lines = []
+    other_lines = []
+    for step in dockerfile_steps(lines[1:]):
+        if step[0].startswith(BASE_STEPS):
+            install_lines.extend(step)
+        else:
+            other_lines.extend(step)
+    open("Dockerfile", "w").write("\n".join(lines[:1] + install_lines + other_lines))
+
+
+def cache_options(build_cache):
+    "Returns (buildx arguments, path of a new local cache to move into place)"
+    if not build_cache:
+        return [], None
+    if "=" in build_cache:
+        # A BuildKit cache spec, e.g. type=registry,ref=...
+        return [
+            "--cache-from",
+            build_cache,
+            "--cache-to",
+            build_cache + ",mode=max",
+        ], None
+    # Exporting into the directory being imported from grows it forever
+    new_cache = build_cache.rstrip(os.sep) + "-new"
+    return [
+        "--cache-from",
+        "type=local,src={}".format(build_cache),
+        "--cache-to",
+        "type=local,dest={},mode=max".format(new_cache),
+    ], new_cache
+
+
+def build_and_push(app, build_cache=None):
+    "Build the current directory and push it to Fly's registry, returns the image"
+    auth_result = run(["flyctl", "auth", "docker"], stdout=PIPE, stderr=PIPE)
+    if auth_result.returncode:
+        raise click.ClickException(
+            "Error calling 'flyctl auth docker':\n\n{}".format(
+                auth_result.stderr.decode("utf-8").strip()
+            )
+        )
+    image = "{}/{}:deployment-{}".format(REGISTRY, app, int(time.time()))
+    cache_args, new_cache = cache_options(build_cache)
+    start = time.perf_counter()
+    build_result = run(
+        ["docker", "buildx", "build", "--platform", "linux/amd64"]
+        + ["--tag", image, "--push"]
+        + cache_args
+        + ["."]
+    )
+    if build_result.returncode:
+        raise click.ClickException("Error calling 'docker buildx build'")
+    if new_cache:
+        if os.path.exists(build_cache):
+            shutil.rmtree(build_cache)
+        os.rename(new_cache, build_cache)
+    click.echo(
+        "Built and pushed {} in {:.1f}s".format(image, time.perf_counter() - start),
+        err=True,
+    )
+    return image
@@ -0,0 +1,264 @@
+"""
+A local stand-in for --replicas, for trying out replication without Fly
+
+    python -m datasette_publish_fly.local_replicas writes.db --replicas 2
+
+This runs a primary Datasette process that owns the databases, replica
+processes that each have their own copy - kept up to date by shipping
+changed pages, like LiteFS - and a proxy in front of them that sends
+writes to the primary and spreads reads across the replicas.
+"""
+from . import sqlite_pages
+import click
+import http.client
+import http.server
+import itertools
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+READ_METHODS = ("GET", "HEAD", "OPTIONS")
+
+# Not forwarded by the proxy, see RFC 7230 section 6.1
+HOP_BY_HOP_HEADERS = {
+    "connection",
+    "keep-alive",
+    "proxy-connection",
+    "te",
+    "trailer",
+    "transfer-encoding",
+    "upgrade",
+}
+
+
+def replicate(primary_path, replica_path):
+    "Copy changed pages of primary_path to replica_path, returns pages changed"
+    with tempfile.TemporaryDirectory() as tmp:
+        local = os.path.join(tmp, os.path.basename(primary_path))
+        sqlite_pages.snapshot(primary_path, local)
+        delta, changed, _ = sqlite_pages.make_delta(
+            local, sqlite_pages.database_hashes(replica_path)
+        )
+        if changed:
+            sqlite_pages.apply_to_database(
+                replica_path, delta, sqlite_pages.file_sha256(local)
+            )
+        elif os.path.exists(sqlite_pages.sync_path(replica_path)):
+            os.remove(sqlite_pages.sync_path(replica_path))
+    return changed
+
+
+def modified(path):
+    return tuple(
+        (os.stat(p).st_mtime_ns, os.stat(p).st_size)
+        for p in (path, path + "-wal")
+        if os.path.exists(p)
+    )
+
+
+def replicate_forever(primary_dir, replica_dirs, names, interval, stop):
+    last_seen = {}
+    while not stop.wait(interval):
+        for name in names:
+            primary_path = os.path.join(primary_dir, name)
+            if last_seen.get(name) == modified(primary_path):
+                continue
+            last_seen[name] = modified(primary_path)
+            for replica_dir in replica_dirs:
+                try:
+                    replicate(primary_path, os.path.join(replica_dir, name))
+                except Exception as e:
+                    # Try again on the next change
+                    last_seen.pop(name, None)
+                    click.echo("Replication of {} failed: {}".format(name, e), err=True)
+
+
+def upstream_for(method, replicas):
+    "Writes go to the primary, reads to the next replica"
+    if method in READ_METHODS:
+        return next(replicas)
+    return "primary"
+
+
+class ProxyHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def proxy(self):
+        name = upstream_for(self.command, self.server.replicas)
+        length = int(self.headers.get("content-length") or 0)
+        body = self.rfile.read(length) if length else None
+        headers = {
+            key: value
+            for key, value in self.headers.items()
+            if key.lower() not in HOP_BY_HOP_HEADERS
+        }
+        conn = http.client.HTTPConnection(
+            "127.0.0.1", self.server.ports[name], timeout=60
+        )
+        try:
+            conn.request(self.command, self.path, body=body, headers=headers)
+            response = conn.getresponse()
+            content = response.read()
+        finally:
+            conn.close()
+        self.send_response(response.status, response.reason)
+        for key, value in response.getheaders():
+            if key.lower() not in HOP_BY_HOP_HEADERS | {"content-length"}:
+                self.send_header(key, value)
+        self.send_header("content-length", str(len(content)))
+        self.send_header("x-datasette-replica", name)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(content)
+
+    do_GET = do_HEAD = do_OPTIONS = proxy
+    do_POST = do_PUT = do_PATCH = do_DELETE = proxy
+
+    def log_message(self, format, *args):
+        pass
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_datasette(paths, port, metadata, create=False):
+    args = [sys.executable, "-m", "datasette", "serve", *paths, "--port", str(port)]
+    if metadata:
+        args += ["--metadata", metadata]
+    if create:
+        args.append("--create")
+    return subprocess.Popen(args)
+
+
+def wait_until_serving(port, process, timeout=30):
+    start = time.monotonic()
+    while True:
+        if process.poll() is not None:
+            raise click.ClickException("Datasette on port {} exited".format(port))
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            conn.request("GET", "/-/versions.json")
+            if conn.getresponse().status == 200:
+                return
+        except OSError:
+            pass
+        if time.monotonic() - start > timeout:
+            raise click.ClickException(
+                "Datasette on port {} did not start".format(port)
+            )
+        time.sleep(0.1)
+
+
+@click.command()
+@click.argument("files", type=click.Path(dir_okay=False), nargs=-1, required=True)
+@click.option("--replicas", type=click.IntRange(min=1), default=2, show_default=True)
+@click.option(
+    "-p", "--port", type=int, default=8001, show_default=True, help="Port for the proxy"
+)
+@click.option(
+    "-m",
+    "--metadata",
+    type=click.Path(exists=True, dir_okay=False),
+    help="Metadata file for every Datasette process",
+)
+@click.option(
+    "--directory",
+    type=click.Path(file_okay=False),
+    help="Where to keep the primary and replica databases, defaults to a temporary directory",
+)
+@click.option(
+    "--interval",
+    type=float,
+    default=1.0,
+    show_default=True,
+    help="Seconds between checks for changes on the primary",
+)
+def cli(files, replicas, port, metadata, directory, interval):
+    "Run a primary, read-only replicas and a routing proxy on this machine"
+    if directory is None:
+        directory = tempfile.mkdtemp()
+    primary_dir = os.path.join(directory, "primary")
+    replica_dirs = [
+        os.path.join(directory, "replica-{}".format(i + 1)) for i in range(replicas)
+    ]
+    for path in [primary_dir] + replica_dirs:
+        os.makedirs(path, exist_ok=True)
+    names = []
+    for path in files:
+        name = os.path.basename(path)
+        if not name.endswith(".db"):
+            name += ".db"
+        if os.path.exists(path) and not os.path.exists(os.path.join(primary_dir, name)):
+            shutil.copy(path, os.path.join(primary_dir, name))
+        names.append(name)
+
+    # Stop cleanly, running the finally: block, when terminated
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    ports = {"primary": free_port()}
+    processes = []
+    stop = threading.Event()
+    try:
+        processes.append(
+            start_datasette(
+                [os.path.join(primary_dir, name) for name in names],
+                ports["primary"],
+                metadata,
+                create=True,
+            )
+        )
+        wait_until_serving(ports["primary"], processes[0])
+        # Replicas need their copies before they start
+        for name in names:
+            for replica_dir in replica_dirs:
+                replicate(
+                    os.path.join(primary_dir, name), os.path.join(replica_dir, name)
+                )
+        for i, replica_dir in enumerate(replica_dirs):
+            replica = "replica-{}".format(i + 1)
+            ports[replica] = free_port()
+            processes.append(
+                start_datasette(
+                    [os.path.join(replica_dir, name) for name in names],
+                    ports[replica],
+                    metadata,
+                )
+            )
+        for process, replica_port in zip(processes[1:], list(ports.values())[1:]):
+            wait_until_serving(replica_port, process)
+        threading.Thread(
+            target=replicate_forever,
+            args=(primary_dir, replica_dirs, names, interval, stop),
+            daemon=True,
+        ).start()
+
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", port), ProxyHandler)
+        server.ports = ports
+        server.replicas = itertools.cycle(
+            ["replica-{}".format(i + 1) for i in range(replicas)]
+        )
+        click.echo(
+            "Primary and {} replica(s) in {}, serving on http://127.0.0.1:{}/".format(
+                replicas, directory, port
+            ),
+            err=True,
+        )
+        server.serve_forever()
+    finally:
+        stop.set()
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+
+if __name__ == "__main__":
+    cli()
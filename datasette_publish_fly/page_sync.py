@@ -0,0 +1,67 @@
+from . import sqlite_pages
+from .volume_upload import ssh_or_fail
+import click
+import json
+import os
+import pathlib
+import shlex
+import tempfile
+
+REMOTE_SCRIPT = "/tmp/datasette_publish_fly_sqlite_pages.py"
+
+
+def sync_database(app, path):
+    "Sync local database to /data on the volume, sending only changed pages"
+    name = os.path.basename(path)
+    remote_path = "/data/" + name
+    with tempfile.TemporaryDirectory() as tmp:
+        local = os.path.join(tmp, name)
+        sqlite_pages.snapshot(path, local)
+        ssh_or_fail(
+            app,
+            "cat > {}".format(REMOTE_SCRIPT),
+            input=pathlib.Path(sqlite_pages.__file__).read_bytes(),
+        )
+        remote = json.loads(
+            ssh_or_fail(
+                app,
+                "python3 {} hashes {}".format(REMOTE_SCRIPT, shlex.quote(remote_path)),
+            )
+        )
+        delta, changed, page_count = sqlite_pages.make_delta(local, remote)
+        full_size = os.path.getsize(local)
+        if changed:
+            delta_path = "/data/.{}.delta".format(name)
+            ssh_or_fail(app, "cat > {}".format(shlex.quote(delta_path)), input=delta)
+            ssh_or_fail(
+                app,
+                "python3 {} apply {} {} {}".format(
+                    REMOTE_SCRIPT,
+                    shlex.quote(remote_path),
+                    shlex.quote(delta_path),
+                    sqlite_pages.file_sha256(local),
+                ),
+            )
+        else:
+            ssh_or_fail(
+                app, "rm -f {}".format(shlex.quote(sqlite_pages.sync_path(remote_path)))
+            )
+        sent = len(delta) if changed else 0
+    click.echo(
+        "Synced {}: {} of {} pages changed, sent {:,} bytes instead of {:,} ({:.1f}% saved)".format(
+            name,
+            changed,
+            page_count,
+            sent,
+            full_size,
+            100 * (1 - sent / full_size) if full_size else 0,
+        ),
+        err=True,
+    )
+    return {
+        "changed_pages": changed,
+        "sent": sent,
+        "full_size": full_size,
+        # Not on the volume before, so not yet served
+        "created": remote["page_size"] == 0,
+    }
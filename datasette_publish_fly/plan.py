@@ -0,0 +1,229 @@
+"""
+Works out what a publish would do without doing it, for --plan
+
+Layer cache hits are predicted the way the builder decides them: each
+step's cache key is a hash of the key before it, the instruction and the
+contents of any files it copies. The keys of the last deploy of each app
+are kept in the cache directory to compare against.
+"""
+from .chunk_layers import CHUNKS_DIR
+from .compress import EXTENSIONS
+from .container import dockerfile_steps
+from .context import context_files, format_bytes
+from .state import estimate_seconds
+from .utils import read_cache, write_cache
+from .volume_upload import file_sha256
+import click
+import hashlib
+import json
+import os
+import shlex
+
+DIGESTS_FILE = "digests.json"
+LAYERS_FILE = "layers.json"
+
+# Steps that add a layer to the image, the others only change its config
+LAYER_INSTRUCTIONS = ("ADD", "COPY", "RUN")
+
+
+def sha256(*parts):
+    return hashlib.sha256("\n".join(parts).encode("utf-8")).hexdigest()
+
+
+def stat_key(path):
+    stat = os.stat(path)
+    return "{}:{}:{}:{}".format(
+        stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns
+    )
+
+
+def source_keys(paths):
+    """
+    Digest cache keys for the files copied into the build context from
+    paths. The copies are new for every publish, so they are keyed on the
+    originals.
+    """
+    return {os.path.basename(path): stat_key(path) for path in paths}
+
+
+def derived_keys(keys, compress=None, chunked=(), chunk_size=None):
+    "source_keys() for the files --compress or --chunk-size made from them"
+    if compress:
+        keys = {
+            name + EXTENSIONS[compress]: key + ":" + compress
+            for name, key in keys.items()
+        }
+    else:
+        keys = dict(keys)
+    for name in chunked:
+        key = keys.pop(name)
+        for chunk in os.listdir(CHUNKS_DIR):
+            if chunk.rpartition(".")[0] == name:
+                keys[os.path.join(CHUNKS_DIR, chunk)] = "{}:{}:{}".format(
+                    key, chunk_size, chunk
+                )
+    return keys
+
+
+def context_digests(keys=None):
+    """
+    Returns {relative_path: (sha256, size)} for the build context. keys
+    are from source_keys(), other files are keyed on themselves.
+    """
+    # Hashing a large database is slow, so digests are cached until the
+    # file's inode, size or modification time changes
+    keys = keys or {}
+    cached = read_cache(DIGESTS_FILE)
+    digests = {}
+    used = {}
+    for relative_path, _, size in context_files():
+        key = keys.get(relative_path) or stat_key(relative_path)
+        used[key] = cached.get(key) or file_sha256(relative_path)
+        digests[relative_path] = (used[key], size)
+    if used != cached:
+        write_cache(DIGESTS_FILE, used)
+    return digests
+
+
+def copy_sources(step_text):
+    """
+    Returns (context paths copied, whether it is COPY --link, the stage or
+    image it copies from) for a COPY or ADD
+    """
+    args = step_text.split(None, 1)[1]
+    flags = []
+    while args.startswith("--"):
+        flag, _, args = args.partition(" ")
+        flags.append(flag)
+        args = args.lstrip()
+    for flag in flags:
+        if flag.startswith("--from="):
+            # Not from the build context
+            return [], "--link" in flags, flag.split("=", 1)[1]
+    if args.startswith("["):
+        sources = json.loads(args)[:-1]
+    else:
+        sources = shlex.split(args)[:-1]
+    return [os.path.normpath(source) for source in sources], "--link" in flags, None
+
+
+def copied_files(sources, digests):
+    return sorted(
+        relative_path
+        for relative_path in digests
+        if any(
+            source == "."
+            or relative_path == source
+            or relative_path.startswith(source + os.sep)
+            for source in sources
+        )
+    )
+
+
+def layer_keys(keys=None):
+    """
+    Cache keys for the layers of the Dockerfile in the current directory,
+    as a list of {"step", "key", "bytes"} dictionaries
+    """
+    digests = context_digests(keys)
+    steps = dockerfile_steps(open("Dockerfile").read().strip().split("\n"))
+    # The key each named stage ends with, for COPY --from
+    stages = {}
+    stage = parent = None
+    layers = []
+    for step in steps:
+        text = "\n".join(step)
+        if not text.strip() or text.startswith("#"):
+            continue
+        words = text.split()
+        instruction = words[0].upper()
+        if instruction == "FROM":
+            # A stage starts again from its image
+            parent = sha256(text)
+            stage = words[3] if len(words) == 4 and words[2].upper() == "AS" else None
+            if stage:
+                stages[stage] = parent
+            continue
+        size = 0
+        key = sha256(parent, text)
+        if instruction in ("ADD", "COPY"):
+            sources, link, source_stage = copy_sources(text)
+            paths = copied_files(sources, digests)
+            size = sum(digests[path][1] for path in paths)
+            contents = [path + ":" + digests[path][0] for path in paths]
+            if source_stage in stages:
+                contents.append(stages[source_stage])
+            # --link layers don't depend on the layers before them
+            key = sha256(*([text] if link else [parent, text]) + contents)
+        parent = key
+        if stage:
+            stages[stage] = parent
+        if instruction in LAYER_INSTRUCTIONS:
+            layers.append({"step": step[0], "key": key, "bytes": size})
+    return layers
+
+
+def record_layers(app, layers):
+    recorded = read_cache(LAYERS_FILE)
+    recorded[app] = [layer["key"] for layer in layers]
+    write_cache(LAYERS_FILE, recorded)
+
+
+def cached_layers(app, layers):
+    "Returns a list of (layer, expected to be cached) pairs"
+    previous = set(read_cache(LAYERS_FILE).get(app, []))
+    return [(layer, layer["key"] in previous) for layer in layers]
+
+
+def format_seconds(seconds):
+    if seconds < 60:
+        return "{:.0f}s".format(seconds)
+    return "{:.0f}m{:02.0f}s".format(*divmod(seconds, 60))
+
+
+def echo_plan(app, phases):
+    """
+    phases is a list of (phase, bytes or None, list of lines), with phase
+    being the name its timings are recorded under
+    """
+    click.echo('Plan for publishing "{}" - nothing has been changed\n'.format(app))
+    total = 0
+    unknown = []
+    for phase, size, lines in phases:
+        seconds = estimate_seconds(phase, size)
+        if seconds is None:
+            unknown.append(phase)
+            estimate = "no previous timings"
+        else:
+            total += seconds
+            estimate = "about " + format_seconds(seconds)
+        click.echo("{} ({})".format(phase, estimate))
+        for line in lines:
+            click.echo("  " + line)
+    click.echo(
+        "\nEstimated duration: {}{}".format(
+            format_seconds(total),
+            ", not counting {}".format(", ".join(unknown)) if unknown else "",
+        )
+    )
+
+
+def layer_lines(app, layers):
+    pairs = cached_layers(app, layers)
+    lines = [
+        "Layers: {} of {} expected to be cached".format(
+            sum(1 for _, cached in pairs if cached), len(pairs)
+        )
+    ]
+    for layer, cached in pairs:
+        step = layer["step"].rstrip("\\").strip()
+        if len(step) > 60:
+            step = step[:57] + "..."
+        lines.append(
+            "  {} {}{}".format(
+                "cached" if cached else "build ",
+                step,
+                " ({})".format(format_bytes(layer["bytes"])) if layer["bytes"] else "",
+            )
+        )
+    return lines
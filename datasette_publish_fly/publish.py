@@ -0,0 +1,1222 @@
+from datasette.publish.common import fail_if_publish_binary_not_installed
+from datasette.utils import temporary_docker_directory
+from .base_image import image_exists, split_dockerfile
+from .capacity import (
+    BENCHMARK_SECONDS,
+    PERFORMANCE_MIN_MEMORY_MB,
+    choose_machines,
+    run_benchmark,
+)
+from .chunk_layers import CHUNKS_DIR, chunk_databases, files_to_chunk
+from .compress import check_compression_available, compress_databases
+from .container import add_container_plugin, add_serve_options
+from .context import echo_context_report, format_bytes, write_dockerignore
+from .convert import convert_files, is_convertible
+from .integrity import verify_databases
+from .litefs import configure_litefs
+from .local_build import build_and_push, install_before_copy
+from .page_sync import sync_database
+from .plan import (
+    derived_keys,
+    echo_plan,
+    layer_keys,
+    layer_lines,
+    record_layers,
+    source_keys,
+)
+from .regions import choose_regions
+from .runner import kill_running, run, PIPE, RETRIES
+from .sizing import (
+    MB,
+    choose_volume_gb,
+    choose_vm_memory_mb,
+    echo_reasons,
+    total_size,
+)
+from .state import PublishState, state_key
+from .volume_upload import file_sha256, remote_manifest, upload_files_to_volume
+from .watch import split_copy_layers, stable_context, watch_and_publish, watched_paths
+from concurrent.futures import ThreadPoolExecutor
+import click
+import contextlib
+import hashlib
+import httpx
+import json
+import os
+import pathlib
+import shutil
+import tempfile
+import threading
+
+# Fly routes requests to other machines above the soft limit, and queues
+# them above the hard limit
+HARD_LIMIT = 25
+SOFT_LIMIT = 20
+
+FLY_TOML = """
+app = "{app}"
+{primary_region}{mounts}{deploy}{metrics}
+[[services]]
+  internal_port = 8080
+  protocol = "tcp"
+
+  [services.concurrency]
+    hard_limit = {hard_limit}
+    soft_limit = {soft_limit}
+
+  [[services.ports]]
+    handlers = ["http"]
+    port = 80
+
+  [[services.ports]]
+    handlers = ["tls", "http"]
+    port = 443
+
+  [[services.tcp_checks]]
+    interval = 10000
+    timeout = 2000
+{http_checks}"""
+
+METRICS = """
+[metrics]
+  port = 8080
+  path = "/-/metrics"
+"""
+
+# /-/versions.json runs SQLite queries, so passing it means Datasette is
+# ready to serve them
+HTTP_CHECKS = """
+  [[services.http_checks]]
+    interval = 10000
+    grace_period = "5s"
+    method = "get"
+    path = "/-/versions.json"
+    protocol = "http"
+    timeout = 2000
+"""
+
+
+def publish_to_fly(
+    files,
+    metadata,
+    extra_options,
+    branch,
+    template_dir,
+    plugins_dir,
+    static,
+    install,
+    plugin_secret,
+    version_note,
+    secret,
+    title,
+    license,
+    license_url,
+    source,
+    source_url,
+    about,
+    about_url,
+    spatialite,
+    region,
+    client_locations,
+    region_probes,
+    region_count,
+    create_volume,
+    expected_growth,
+    vm_memory,
+    create_db,
+    volume_name,
+    upload_to_volume,
+    sync_db,
+    replicas,
+    app,
+    org,
+    generate_dir,
+    show_files,
+    settings,
+    crossdb,
+    strategy,
+    max_unavailable,
+    check_databases,
+    pipeline,
+    compress,
+    chunk_size,
+    inspect_volume,
+    build,
+    build_cache,
+    base_image_app,
+    metrics,
+    slow_query_ms,
+    index,
+    wal,
+    wal_checkpoint_interval,
+    target_rps,
+    resume,
+    watch,
+    plan,
+    preflight_result=None,
+    incremental=False,
+):
+    arguments = dict(locals())
+    # Everything that affects the result, for the --resume state key -
+    # apart from the signing secret, which is random unless it is passed
+    options = dict(arguments)
+    for name in (
+        "resume",
+        "secret",
+        "watch",
+        "plan",
+        "preflight_result",
+        "incremental",
+    ):
+        del options[name]
+    extra_regions = []
+
+    if plan:
+        for option, value in (
+            ("--generate-dir", generate_dir),
+            ("--resume", resume),
+            ("--watch", watch),
+        ):
+            if value:
+                raise click.ClickException(
+                    "--plan cannot be used with {}".format(option)
+                )
+
+    if watch:
+        if generate_dir:
+            raise click.ClickException("--watch cannot be used with --generate-dir")
+        if resume:
+            raise click.ClickException("--watch cannot be used with --resume")
+
+        def republish(preflight_result):
+            # Reopened each time, the last publish read it to the end
+            with (
+                open(metadata.name) if metadata else contextlib.nullcontext()
+            ) as metadata_file:
+                return publish_to_fly(
+                    **dict(
+                        arguments,
+                        watch=False,
+                        metadata=metadata_file,
+                        preflight_result=preflight_result,
+                        incremental=True,
+                    )
+                )
+
+        watch_and_publish(
+            watched_paths(files, metadata, template_dir, plugins_dir, static, sync_db),
+            republish,
+        )
+        return
+
+    if max_unavailable is not None and strategy not in (None, "rolling"):
+        raise click.ClickException(
+            "--max-unavailable can only be used with the rolling strategy"
+        )
+
+    if compress:
+        check_compression_available(compress)
+        if chunk_size:
+            raise click.ClickException("--chunk-size cannot be used with --compress")
+
+    if wal_checkpoint_interval is not None and not wal:
+        raise click.ClickException("--wal-checkpoint-interval requires --wal")
+
+    if region != "auto":
+        unused = [
+            option
+            for option, value in (
+                ("--client-location", client_locations),
+                ("--region-probes", region_probes),
+                ("--region-count", region_count != 1),
+            )
+            if value
+        ]
+        if unused:
+            raise click.ClickException(
+                "{} requires --region auto".format(", ".join(unused))
+            )
+
+    if build_cache and build != "local":
+        raise click.ClickException("--build-cache requires --build local")
+    if build == "local" and not generate_dir:
+        fail_if_publish_binary_not_installed(
+            "docker", "Docker", "https://docs.docker.com/get-docker/"
+        )
+
+    if index or any(is_convertible(path) for path in files):
+        files = convert_files(files, index)
+
+    volume_files = []
+    if upload_to_volume:
+        if generate_dir:
+            raise click.ClickException(
+                "--upload-to-volume cannot be used with --generate-dir"
+            )
+        # These are served by the /data/*.db glob instead
+        volume_files, files = files, []
+
+    if check_databases:
+        # Before any network calls, so a broken file fails fast
+        verify_databases(
+            list(files) + list(volume_files) + list(sync_db),
+            full=check_databases == "full",
+        )
+
+    if region == "auto":
+        extra_regions = choose_regions(
+            app, client_locations, region_probes, region_count
+        )
+        region = extra_regions.pop(0)
+
+    if create_volume == "auto":
+        create_volume, reasons = choose_volume_gb(
+            total_size(list(volume_files) + list(sync_db)),
+            expected_growth,
+            # Reassembled into /data/.chunked-databases at start-up
+            total_size(files_to_chunk(files, chunk_size * MB)) if chunk_size else 0,
+        )
+        echo_reasons("Volume size", reasons)
+
+    if vm_memory == "auto":
+        vm_memory, reasons = choose_vm_memory_mb(
+            total_size(list(files) + list(volume_files) + list(sync_db)),
+            len(files) + len(volume_files) + len(sync_db) + len(create_db),
+            settings,
+        )
+        echo_reasons("VM memory", reasons)
+
+    # Ensure generate_dir is an absolute, not relative path
+    if generate_dir:
+        if resume:
+            raise click.ClickException("--resume cannot be used with --generate-dir")
+        generate_dir = str(pathlib.Path(generate_dir).absolute())
+
+    state = PublishState(
+        app,
+        state_key(app, list(files) + list(volume_files) + list(sync_db), options),
+        resume,
+    )
+
+    extra_metadata = {
+        "title": title,
+        "license": license,
+        "license_url": license_url,
+        "source": source,
+        "source_url": source_url,
+        "about": about,
+        "about_url": about_url,
+    }
+
+    extra_options = extra_options or ""
+    if settings:
+        extra_options += " ".join(
+            "--setting {} {}".format(*setting) for setting in settings
+        )
+    if crossdb:
+        extra_options += " --crossdb"
+
+    environment_variables = {}
+    if slow_query_ms is not None:
+        environment_variables["DATASETTE_PUBLISH_FLY_SLOW_QUERY_MS"] = slow_query_ms
+    if wal_checkpoint_interval is not None:
+        environment_variables["DATASETTE_PUBLISH_FLY_WAL_CHECKPOINT_INTERVAL"] = (
+            wal_checkpoint_interval
+        )
+    secrets_to_set = {}
+    if plugin_secret:
+        extra_metadata["plugins"] = {}
+        for plugin_name, plugin_setting, setting_value in plugin_secret:
+            environment_variable = (
+                "{}_{}".format(plugin_name, plugin_setting).upper().replace("-", "_")
+            )
+            secrets_to_set[environment_variable] = setting_value
+            extra_metadata["plugins"].setdefault(plugin_name, {})[plugin_setting] = {
+                "$env": environment_variable
+            }
+
+    if preflight_result and not state.done("preflight"):
+        # Republishing for --watch, the first publish did this
+        state.record("preflight", list(preflight_result), timed=False)
+
+    scale_to = state.get("capacity") if state.done("capacity") else None
+    if state.done("deploy"):
+        region, volume_to_mount = state.get("preflight")
+    else:
+        with contextlib.ExitStack() as stack:
+            cancelled = threading.Event()
+            preflight_future = None
+            if state.done("preflight"):
+                region, volume_to_mount = state.get("preflight")
+            elif plan:
+                region, volume_to_mount, preflight_lines = plan_preflight(
+                    app, org, region, create_volume, volume_name
+                )
+            elif pipeline and not generate_dir:
+                executor = stack.enter_context(ThreadPoolExecutor(max_workers=1))
+                # On the way out, stop preflight at its next step and kill
+                # whatever it is running before waiting for it - this only
+                # matters if something failed. Callbacks run last first
+                stack.callback(kill_running)
+                stack.callback(cancelled.set)
+                preflight_future = executor.submit(
+                    preflight,
+                    app,
+                    org,
+                    region,
+                    create_volume,
+                    volume_name,
+                    cancelled,
+                )
+            elif not generate_dir:
+                region, volume_to_mount = preflight(
+                    app, org, region, create_volume, volume_name, cancelled
+                )
+                state.record("preflight", [region, volume_to_mount])
+
+            # Before the files are copied, compressed or split
+            digest_keys = source_keys(files)
+            stack.enter_context(
+                temporary_docker_directory(
+                    files,
+                    app,
+                    metadata,
+                    extra_options,
+                    branch,
+                    template_dir,
+                    plugins_dir,
+                    static,
+                    install,
+                    spatialite,
+                    version_note,
+                    secret,
+                    extra_metadata,
+                    environment_variables,
+                    port=8080,
+                )
+            )
+            if target_rps and not scale_to:
+                click.echo(
+                    "Benchmarking locally for {} seconds".format(BENCHMARK_SECONDS),
+                    err=True,
+                )
+                # The most requests Fly will send to one machine at once
+                benchmark = run_benchmark(HARD_LIMIT)
+            if base_image_app:
+                base_image, base_dockerfile = split_dockerfile(base_image_app)
+                if generate_dir:
+                    open("base.Dockerfile", "w").write(base_dockerfile)
+            if build == "local" or incremental:
+                install_before_copy()
+            if preflight_future and preflight_future.done():
+                # Fail fast rather than compressing files we'll never deploy
+                preflight_future.result()
+            compressed = []
+            if compress:
+                compressed = compress_databases(
+                    [os.path.basename(f) for f in files], compress
+                )
+            chunked = []
+            if chunk_size:
+                chunked = chunk_databases(
+                    [os.path.basename(f) for f in files], chunk_size * MB
+                )
+            digest_keys = derived_keys(digest_keys, compress, chunked, chunk_size)
+            write_dockerignore()
+
+            if preflight_future:
+                region, volume_to_mount = preflight_future.result()
+                state.record("preflight", [region, volume_to_mount])
+            elif generate_dir:
+                volume_to_mount = volume_name if create_volume else None
+
+            if chunked and not volume_to_mount:
+                click.secho(
+                    "Warning: without a volume the chunked databases are reassembled"
+                    " on every start, needing disk space for them twice - use"
+                    " --create-volume",
+                    fg="yellow",
+                    err=True,
+                )
+            if volume_files and not volume_to_mount:
+                raise click.ClickException(
+                    "--upload-to-volume requires a volume, use --create-volume"
+                )
+            if sync_db and not generate_dir and not volume_to_mount:
+                raise click.ClickException(
+                    "--sync-db requires a volume, use --create-volume"
+                )
+
+            if replicas:
+                if not volume_to_mount:
+                    raise click.ClickException(
+                        "--replicas requires a volume, use --create-volume"
+                    )
+                if not create_db:
+                    raise click.ClickException(
+                        "--replicas requires at least one --create-db database"
+                    )
+                for option, value in (
+                    ("--upload-to-volume", volume_files),
+                    ("--sync-db", sync_db),
+                    ("--inspect-volume", inspect_volume),
+                ):
+                    if value:
+                        # These write to /data directly, bypassing replication
+                        raise click.ClickException(
+                            "--replicas cannot be used with {}".format(option)
+                        )
+                if wal:
+                    # LiteFS looks after the journal of the databases it replicates
+                    raise click.ClickException("--replicas cannot be used with --wal")
+                if target_rps:
+                    raise click.ClickException(
+                        "--replicas cannot be used with --target-rps"
+                    )
+                if not region:
+                    raise click.ClickException(
+                        "--replicas requires --region when used with --generate-dir"
+                    )
+
+            capacity_reasons = []
+            if target_rps and not scale_to:
+                # Each machine would need its own volume
+                vm_size, machine_count, capacity_reasons = choose_machines(
+                    benchmark, target_rps, max_machines=1 if volume_to_mount else None
+                )
+                if (
+                    vm_size.startswith("performance")
+                    and vm_memory
+                    and vm_memory < PERFORMANCE_MIN_MEMORY_MB
+                ):
+                    vm_memory = PERFORMANCE_MIN_MEMORY_MB
+                    capacity_reasons.append(
+                        "VM memory: {}MB, the minimum for {}".format(vm_memory, vm_size)
+                    )
+                echo_reasons("Capacity", capacity_reasons)
+                scale_to = [vm_size, machine_count]
+                if not generate_dir and not plan:
+                    state.record("capacity", scale_to)
+
+            if inspect_volume:
+                if not volume_to_mount:
+                    raise click.ClickException(
+                        "--inspect-volume requires a volume, use --create-volume"
+                    )
+                add_container_plugin("volume_inspect")
+
+            if wal:
+                if not volume_to_mount:
+                    raise click.ClickException(
+                        "--wal requires a volume, use --create-volume"
+                    )
+                add_container_plugin("wal")
+
+            if metrics:
+                add_container_plugin("metrics")
+
+            if slow_query_ms is not None:
+                add_container_plugin("slow_queries")
+
+            if volume_to_mount:
+                volume_options = []
+                for database_name in create_db:
+                    if not database_name.endswith(".db"):
+                        database_name += ".db"
+                    volume_options.append("/data/{}".format(database_name))
+                volume_options.append("--create")
+                add_serve_options(volume_options)
+                # Modify CMD line of Dockerfile to use bash and add /data/*.db to end of it
+                dockerfile_content = open("Dockerfile").read().strip()
+                lines = dockerfile_content.split("\n")
+                new_line = lines[-1][len("CMD ") :] + " /data/*.db"
+                # Convert that to CMD ["/bin/bash","-c","shopt -s nullglob &&
+                # See https://github.com/simonw/datasette-publish-fly/issues/17
+                new_line = (
+                    'CMD ["/bin/bash", "-c", "shopt -s nullglob && ' + new_line + '"]\n'
+                )
+                lines[-1] = new_line
+                open("Dockerfile", "w").write("\n".join(lines))
+                if replicas:
+                    primary_database = create_db[0]
+                    if not primary_database.endswith(".db"):
+                        primary_database += ".db"
+                    configure_litefs(primary_database)
+
+            if replicas and not generate_dir and not plan:
+                attach_consul(app)
+
+            if (
+                secrets_to_set
+                and not generate_dir
+                and not plan
+                and not state.done("secrets")
+            ):
+                set_secrets(app, secrets_to_set)
+                state.record("secrets")
+
+            mounts = ""
+            if volume_to_mount:
+                mounts = (
+                    "\n[[mounts]]\n"
+                    '  destination = "/data"\n'
+                    '  source = "{}"\n'.format(volume_to_mount)
+                )
+
+            deploy = ""
+            if strategy or max_unavailable is not None:
+                deploy = "\n[deploy]\n"
+                if strategy:
+                    deploy += '  strategy = "{}"\n'.format(strategy)
+                if max_unavailable is not None:
+                    deploy += "  max_unavailable = {}\n".format(
+                        int(max_unavailable)
+                        if max_unavailable >= 1
+                        else max_unavailable
+                    )
+
+            fly_toml = FLY_TOML.format(
+                app=app,
+                # LiteFS only lets machines in the primary region become primary
+                primary_region=(
+                    'primary_region = "{}"\n'.format(region) if replicas else ""
+                ),
+                mounts=mounts,
+                deploy=deploy,
+                metrics=METRICS if metrics else "",
+                hard_limit=HARD_LIMIT,
+                soft_limit=SOFT_LIMIT,
+                # Health checks gate traffic moving to the new machines
+                http_checks=HTTP_CHECKS if deploy else "",
+            )
+
+            if incremental or chunked or compressed:
+                # A layer for each chunk, so they are pushed in parallel.
+                # Compressed files are only copied into the decompress stage
+                split_copy_layers(expand=[CHUNKS_DIR], exclude=compressed)
+
+            if generate_dir:
+                dir = pathlib.Path(generate_dir)
+                if not dir.exists():
+                    dir.mkdir()
+
+                # Copy files from current directory to dir
+                for file in pathlib.Path(".").glob("*"):
+                    if file.is_dir():
+                        shutil.copytree(str(file), str(dir / file.name))
+                    else:
+                        shutil.copy(str(file), str(dir / file.name))
+                (dir / "fly.toml").write_text(fly_toml, "utf-8")
+                if base_image_app:
+                    click.echo(
+                        "Build the base image first with:\n\n"
+                        "    flyctl deploy --app {} --dockerfile base.Dockerfile "
+                        "--build-only --push --image-label {}".format(
+                            base_image_app, base_image.split(":")[-1]
+                        ),
+                        err=True,
+                    )
+                if scale_to:
+                    click.echo(
+                        "Scale the app after deploying with:\n\n"
+                        "    flyctl scale vm {0} --app {2}\n"
+                        "    flyctl scale count {1} --app {2}".format(*scale_to, app),
+                        err=True,
+                    )
+                return
+
+            elif show_files:
+                click.echo("fly.toml")
+                click.echo("----")
+                click.echo(fly_toml)
+                click.echo("----")
+                click.echo("Dockerfile")
+                click.echo("----")
+                click.echo(open("Dockerfile").read())
+                if os.path.exists("metadata.json"):
+                    click.echo("----")
+                    click.echo("metadata.json")
+                    click.echo("----")
+                    click.echo(open("metadata.json").read())
+                    click.echo("----")
+                if capacity_reasons:
+                    click.echo("----")
+                    click.echo("Capacity plan")
+                    click.echo("----")
+                    click.echo("\n".join(capacity_reasons))
+                    click.echo("----")
+
+            open("fly.toml", "w").write(fly_toml)
+            if incremental:
+                # Builders only upload the changes to a context they've seen
+                os.chdir(stable_context(app))
+            if plan:
+                echo_plan(
+                    app,
+                    plan_phases(
+                        app,
+                        region,
+                        extra_regions,
+                        preflight_lines,
+                        secrets_to_set,
+                        base_image if base_image_app else None,
+                        build,
+                        [mount_point for mount_point, _ in static],
+                        digest_keys,
+                        volume_to_mount,
+                        volume_files,
+                        sync_db,
+                        vm_memory,
+                        replicas,
+                        scale_to,
+                    ),
+                )
+                return region, volume_to_mount
+            if base_image_app:
+                ensure_base_image(base_image_app, org, base_image, base_dockerfile)
+            context_bytes = echo_context_report(
+                [mount_point for mount_point, _ in static]
+            )
+            # Now deploy it
+            if build == "local":
+                build_args = ["--image", build_and_push(app, build_cache)]
+            else:
+                build_args = ["--remote-only"]
+            deploy_result = run(
+                [
+                    "flyctl",
+                    "deploy",
+                    ".",
+                    "--app",
+                    app,
+                    "--config",
+                    "fly.toml",
+                ]
+                + build_args
+            )
+            if deploy_result.returncode:
+                raise click.ClickException("Error calling 'flyctl deploy'")
+            state.record("deploy", size=context_bytes)
+            # For --plan to compare the next publish against
+            record_layers(app, layer_keys(digest_keys))
+
+    after_deploy(
+        app,
+        region,
+        extra_regions,
+        volume_to_mount,
+        volume_files,
+        sync_db,
+        vm_memory,
+        replicas,
+        scale_to,
+        state,
+    )
+    state.finish()
+    return region, volume_to_mount
+
+
+def restart_app(app):
+    restart_result = run(["flyctl", "apps", "restart", app], stderr=PIPE, stdout=PIPE)
+    if restart_result.returncode:
+        raise click.ClickException(
+            "Error calling 'flyctl apps restart':\n\n{}".format(
+                restart_result.stderr.decode("utf-8").strip()
+            )
+        )
+
+
+def after_deploy(
+    app,
+    region,
+    extra_regions,
+    volume_to_mount,
+    volume_files,
+    sync_db,
+    vm_memory,
+    replicas,
+    scale_to,
+    state,
+):
+    "The steps after 'flyctl deploy', each recorded so --resume can skip it"
+    if volume_files and not state.done("upload"):
+        uploaded = upload_files_to_volume(app, volume_files)
+        if uploaded:
+            # Restart so Datasette picks up new and replaced files
+            restart_app(app)
+        state.record(
+            "upload",
+            size=sum(
+                os.path.getsize(path)
+                for path in volume_files
+                if os.path.basename(path) in uploaded
+            ),
+        )
+
+    for path in sync_db:
+        if not state.done("sync " + path):
+            created = sync_database(app, path)["created"]
+            state.record("sync " + path, created, size=os.path.getsize(path))
+    if any(state.get("sync " + path) for path in sync_db) and not state.done("restart"):
+        # The /data/*.db glob was expanded when Datasette started, so new
+        # databases aren't served until it restarts
+        restart_app(app)
+        state.record("restart")
+
+    if scale_to and not state.done("scale"):
+        vm_size, machine_count = scale_to
+        # Before memory, since changing the VM size resets it
+        for args in (
+            ["flyctl", "scale", "vm", vm_size, "--app", app],
+            ["flyctl", "scale", "count", str(machine_count), "--app", app, "--yes"],
+        ):
+            scale_result = run(args, stderr=PIPE, stdout=PIPE)
+            if scale_result.returncode:
+                raise click.ClickException(
+                    "Error calling '{}':\n\n{}".format(
+                        " ".join(args[:3]), scale_result.stderr.decode("utf-8").strip()
+                    )
+                )
+        state.record("scale")
+
+    if vm_memory and not state.done("memory"):
+        memory_result = run(
+            ["flyctl", "scale", "memory", str(vm_memory), "-a", app],
+            stderr=PIPE,
+            stdout=PIPE,
+        )
+        if memory_result.returncode:
+            raise click.ClickException(
+                "Error calling 'flyctl scale memory':\n\n{}".format(
+                    memory_result.stderr.decode("utf-8").strip()
+                )
+            )
+        state.record("memory")
+
+    if replicas:
+        scale_args = ["flyctl", "scale", "count", str(replicas + 1)]
+        if extra_regions:
+            # Put the replicas near the users in the other regions
+            scale_args += ["--region", ",".join([region] + extra_regions)]
+        scale_result = run(
+            scale_args + ["--app", app, "--yes"], stderr=PIPE, stdout=PIPE
+        )
+        if scale_result.returncode:
+            raise click.ClickException(
+                "Error calling 'flyctl scale count':\n\n{}".format(
+                    scale_result.stderr.decode("utf-8").strip()
+                )
+            )
+    elif extra_regions:
+        if volume_to_mount:
+            # Volumes live in a single region, so stay there
+            click.echo(
+                "Not adding regions {} since the app uses a volume".format(
+                    ", ".join(extra_regions)
+                ),
+                err=True,
+            )
+        else:
+            regions_result = run(
+                ["flyctl", "regions", "set", region] + extra_regions + ["-a", app],
+                stderr=PIPE,
+                stdout=PIPE,
+            )
+            if regions_result.returncode:
+                raise click.ClickException(
+                    "Error calling 'flyctl regions set':\n\n{}".format(
+                        regions_result.stderr.decode("utf-8").strip()
+                    )
+                )
+
+
+def preflight(app, org, region, create_volume, volume_name, cancelled):
+    "Network checks and setup, returns (region, volume_to_mount)"
+    # They must have flyctl installed
+    fail_if_publish_binary_not_installed(
+        "flyctl",
+        "Fly",
+        "https://fly.io/docs/getting-started/installing-flyctl/",
+    )
+    # And they need to be logged in
+    fly_token = auth_token()
+
+    # If they didn't specify a region, use fly_token to find the nearest
+    if not region and not cancelled.is_set():
+        region = nearest_region(fly_token)
+
+    if cancelled.is_set():
+        return region, None
+    apps = existing_apps()
+    if app not in apps and not cancelled.is_set():
+        create_app(app, org)
+
+    if cancelled.is_set():
+        return region, None
+    if create_volume:
+        # Ensure the volume has not been previousy created
+        if volume_name not in existing_volumes(app) and not cancelled.is_set():
+            create_volume_result = run(
+                [
+                    "flyctl",
+                    "volumes",
+                    "create",
+                    volume_name,
+                    "--region",
+                    region,
+                    "--size",
+                    str(create_volume),
+                    "-a",
+                    app,
+                    "--json",
+                ],
+                stderr=PIPE,
+                stdout=PIPE,
+                retries=RETRIES,
+                # It may have been created before the error
+                retry_if=lambda: volume_name not in existing_volumes(app),
+            )
+            if create_volume_result.returncode and (
+                volume_name not in existing_volumes(app)
+            ):
+                raise click.ClickException(
+                    "Error calling 'flyctl volumes create':\n\n{}".format(
+                        create_volume_result.stderr.decode("utf-8")
+                        .split("Usage:")[0]
+                        .strip()
+                    )
+                )
+        return region, volume_name
+
+    # Does the previous app have mounted volumes?
+    volumes = existing_volumes(app)
+    return region, volumes[0] if volumes else None
+
+
+def plan_preflight(app, org, region, create_volume, volume_name):
+    """
+    The read-only half of preflight(), returns (region, volume_to_mount,
+    lines describing what preflight() would do)
+    """
+    fail_if_publish_binary_not_installed(
+        "flyctl",
+        "Fly",
+        "https://fly.io/docs/getting-started/installing-flyctl/",
+    )
+    fly_token = auth_token()
+    if not region:
+        region = nearest_region(fly_token)
+    if app in existing_apps():
+        lines = ["Use existing app {}".format(app)]
+        volumes = existing_volumes(app)
+    else:
+        lines = [
+            "Create app {}{}".format(
+                app, " in organization {}".format(org) if org else ""
+            )
+        ]
+        volumes = []
+    if create_volume:
+        if volume_name in volumes:
+            lines.append("Use existing volume {}".format(volume_name))
+        else:
+            lines.append(
+                "Create {}GB volume {} in {}".format(create_volume, volume_name, region)
+            )
+        return region, volume_name, lines
+    if volumes:
+        lines.append("Mount existing volume {}".format(volumes[0]))
+    return region, volumes[0] if volumes else None, lines
+
+
+def plan_phases(
+    app,
+    region,
+    extra_regions,
+    preflight_lines,
+    secrets_to_set,
+    base_image,
+    build,
+    static_mounts,
+    digest_keys,
+    volume_to_mount,
+    volume_files,
+    sync_db,
+    vm_memory,
+    replicas,
+    scale_to,
+):
+    "What each phase would do, in the form echo_plan() takes"
+    phases = [("preflight", None, preflight_lines)]
+
+    if secrets_to_set:
+        changed, skipped = changed_secrets(app, secrets_to_set)
+        lines = ["Stage {}".format(name) for name in changed]
+        if skipped:
+            lines.append("{} unchanged".format(skipped))
+        phases.append(("secrets", None, lines))
+
+    lines = []
+    if base_image:
+        lines.append(
+            "{} base image {}".format(
+                "Use" if image_exists(base_image, auth_token()) else "Build",
+                base_image,
+            )
+        )
+    lines.append(
+        "Build with local Docker and push"
+        if build == "local"
+        else "Build on Fly's remote builder"
+    )
+    context_bytes = echo_context_report(static_mounts)
+    lines.append("Build context: {}".format(format_bytes(context_bytes)))
+    lines.extend(layer_lines(app, layer_keys(digest_keys)))
+    phases.append(("deploy", context_bytes, lines))
+
+    if volume_files:
+        manifest = remote_manifest(app)
+        lines = []
+        upload_bytes = 0
+        for path in volume_files:
+            name = os.path.basename(path)
+            if manifest.get(name) == file_sha256(path):
+                lines.append("{} is unchanged".format(name))
+            else:
+                upload_bytes += os.path.getsize(path)
+                lines.append(
+                    "Upload {} ({})".format(name, format_bytes(os.path.getsize(path)))
+                )
+        if upload_bytes:
+            lines.append("Restart the app")
+        phases.append(("upload", upload_bytes, lines))
+
+    for path in sync_db:
+        phases.append(
+            (
+                "sync",
+                os.path.getsize(path),
+                ["Sync {} to {}".format(path, volume_to_mount)],
+            )
+        )
+
+    if scale_to:
+        phases.append(("scale", None, ["VM size {}, {} machine(s)".format(*scale_to)]))
+
+    if vm_memory:
+        phases.append(("memory", None, ["Set memory to {}MB".format(vm_memory)]))
+
+    if replicas:
+        phases.append(
+            (
+                "replicas",
+                None,
+                [
+                    "Attach Consul",
+                    "Scale to {} machines in {}".format(
+                        replicas + 1, ", ".join([region] + extra_regions)
+                    ),
+                ],
+            )
+        )
+    elif extra_regions and not volume_to_mount:
+        phases.append(
+            (
+                "regions",
+                None,
+                ["Set regions {}".format(", ".join([region] + extra_regions))],
+            )
+        )
+    return phases
+
+
+def attach_consul(app):
+    "LiteFS uses Fly's Consul cluster to elect the primary"
+    result = run(["flyctl", "consul", "attach", "--app", app], stderr=PIPE, stdout=PIPE)
+    error_message = result.stderr.decode("utf-8").strip()
+    if result.returncode and "already" not in error_message:
+        raise click.ClickException(
+            "Error calling 'flyctl consul attach':\n\n{}".format(error_message)
+        )
+
+
+def changed_secrets(app, secrets_to_set):
+    "Returns ({name: value} of secrets that need setting, number unchanged)"
+    digests = existing_secret_digests(app)
+    changed = {
+        name: value
+        for name, value in secrets_to_set.items()
+        if not secret_matches_digest(value, digests.get(name))
+    }
+    return changed, len(secrets_to_set) - len(changed)
+
+
+def set_secrets(app, secrets_to_set):
+    # Secrets are staged, so they are applied by the deploy that follows
+    # rather than triggering a release of their own
+    changed, skipped = changed_secrets(app, secrets_to_set)
+    if skipped:
+        click.echo(
+            "Skipped {} unchanged secret{}".format(
+                skipped, "" if skipped == 1 else "s"
+            ),
+            err=True,
+        )
+    if not changed:
+        return
+    secrets_args = ["flyctl", "secrets", "set", "--stage"]
+    for pair in changed.items():
+        secrets_args.append("{}={}".format(*pair))
+    secrets_args.extend(["-a", app])
+    secrets_result = run(
+        secrets_args,
+        stderr=PIPE,
+        stdout=PIPE,
+    )
+    if secrets_result.returncode:
+        # Ignore "No change detected to secrets" but raise anything else
+        error_message = secrets_result.stderr.decode("utf-8").strip()
+        if "No change detected to secrets" not in error_message:
+            raise click.ClickException(
+                "Error calling 'flyctl secrets set':\n\n{}".format(error_message)
+            )
+
+
+def existing_secret_digests(app):
+    process = run(
+        ["flyctl", "secrets", "list", "-a", app, "--json"], stdout=PIPE, stderr=PIPE
+    )
+    if process.returncode:
+        # e.g. the app has only just been created - send everything
+        return {}
+    try:
+        return {
+            secret["Name"]: secret.get("Digest") or ""
+            for secret in json.loads(process.stdout)
+        }
+    except (ValueError, TypeError, KeyError):
+        return {}
+
+
+def secret_matches_digest(value, digest):
+    # Fly reports a (possibly truncated) hex SHA-256 digest of each value. If
+    # that ever changes nothing matches, and we fall back to sending them all
+    if not digest:
+        return False
+    return hashlib.sha256(value.encode("utf-8")).hexdigest().startswith(digest.lower())
+
+
+def auth_token():
+    token_result = run(
+        [
+            "flyctl",
+            "auth",
+            "token",
+            "--json",
+        ],
+        stderr=PIPE,
+        stdout=PIPE,
+    )
+    if token_result.returncode:
+        raise click.ClickException(
+            "Error calling 'flyctl auth token':\n\n{}".format(
+                token_result.stderr.decode("utf-8").strip()
+            )
+        )
+    return json.loads(token_result.stdout)["token"]
+
+
+def create_app(app, org):
+    args = [
+        "flyctl",
+        "apps",
+        "create",
+        "--name",
+        app,
+        "--json",
+    ]
+    if org:
+        args.extend(["--org", org])
+    result = run(args, stderr=PIPE, stdout=PIPE)
+    if result.returncode:
+        raise click.ClickException(
+            "Error calling 'flyctl apps create':\n\n{}".format(
+                # Don't include Usage: - could be confused for usage
+                # instructions for datasette publish fly
+                result.stderr.decode("utf-8")
+                .split("Usage:")[0]
+                .strip()
+            )
+        )
+
+
+def ensure_base_image(base_app, org, image, base_dockerfile):
+    "Build and push the base image, unless it is already in the registry"
+    if image_exists(image, auth_token()):
+        click.echo("Using base image {}".format(image), err=True)
+        return
+    if base_app not in existing_apps():
+        create_app(base_app, org)
+    click.echo("Building base image {}".format(image), err=True)
+    with tempfile.TemporaryDirectory() as tmp:
+        open(os.path.join(tmp, "Dockerfile"), "w").write(base_dockerfile)
+        open(os.path.join(tmp, "fly.toml"), "w").write('app = "{}"\n'.format(base_app))
+        result = run(
+            [
+                "flyctl",
+                "deploy",
+                tmp,
+                "--app",
+                base_app,
+                "--config",
+                os.path.join(tmp, "fly.toml"),
+                "--build-only",
+                "--push",
+                "--image-label",
+                image.split(":")[-1],
+                "--remote-only",
+            ]
+        )
+    if result.returncode:
+        raise click.ClickException("Error building base image {}".format(image))
+
+
+def nearest_region(fly_token):
+    response = httpx.post(
+        "https://api.fly.io/graphql",
+        json={"query": "{ nearestRegion { code } }"},
+        headers={
+            "accept": "application/json",
+            "Authorization": "Bearer {}".format(fly_token),
+        },
+    )
+    if response.status_code == 200 and "errors" not in response.json():
+        # {'data': {'nearestRegion': {'code': 'sjc'}}}
+        return response.json()["data"]["nearestRegion"]["code"]
+    raise click.ClickException("Could not resolve nearest region, specify --region")
+
+
+def existing_apps():
+    process = run(["flyctl", "apps", "list", "--json"], stdout=PIPE, stderr=PIPE)
+    if process.returncode:
+        raise click.ClickException(
+            "Error calling 'flyctl apps list':\n\n{}".format(
+                process.stderr.decode("utf-8").strip()
+            )
+        )
+    return [app["Name"] for app in json.loads(process.stdout)]
+
+
+def existing_volumes(app):
+    process = run(
+        ["flyctl", "volumes", "list", "-a", app, "--json"], stdout=PIPE, stderr=PIPE
+    )
+    if process.returncode:
+        if b"Could not resolve App" in process.stderr:
+            return []
+        raise click.ClickException(
+            "Error calling 'flyctl volumes list':\n\n{}".format(
+                process.stderr.decode("utf-8").strip()
+            )
+        )
+    return [volume["Name"] for volume in json.loads(process.stdout)]
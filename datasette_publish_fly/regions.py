@@ -0,0 +1,176 @@
+from .utils import read_cache, write_cache
+import click
+import csv
+import json
+import math
+
+# code: (city, latitude, longitude)
+# See https://fly.io/docs/reference/regions/
+FLY_REGIONS = {
+    "ams": ("Amsterdam, Netherlands", 52.37, 4.90),
+    "arn": ("Stockholm, Sweden", 59.65, 17.93),
+    "atl": ("Atlanta, Georgia (US)", 33.64, -84.43),
+    "bog": ("Bogotá, Colombia", 4.70, -74.14),
+    "bos": ("Boston, Massachusetts (US)", 42.36, -71.01),
+    "cdg": ("Paris, France", 48.86, 2.35),
+    "den": ("Denver, Colorado (US)", 39.74, -104.99),
+    "dfw": ("Dallas, Texas (US)", 32.90, -97.04),
+    "ewr": ("Secaucus, NJ (US)", 40.79, -74.06),
+    "eze": ("Ezeiza, Argentina", -34.82, -58.54),
+    "fra": ("Frankfurt, Germany", 50.11, 8.68),
+    "gdl": ("Guadalajara, Mexico", 20.67, -103.35),
+    "gig": ("Rio de Janeiro, Brazil", -22.81, -43.25),
+    "gru": ("Sao Paulo, Brazil", -23.55, -46.63),
+    "hkg": ("Hong Kong, Hong Kong", 22.32, 114.17),
+    "iad": ("Ashburn, Virginia (US)", 39.04, -77.49),
+    "jnb": ("Johannesburg, South Africa", -26.20, 28.05),
+    "lax": ("Los Angeles, California (US)", 33.94, -118.41),
+    "lhr": ("London, United Kingdom", 51.51, -0.13),
+    "mad": ("Madrid, Spain", 40.42, -3.70),
+    "mia": ("Miami, Florida (US)", 25.79, -80.29),
+    "nrt": ("Tokyo, Japan", 35.68, 139.69),
+    "ord": ("Chicago, Illinois (US)", 41.88, -87.63),
+    "otp": ("Bucharest, Romania", 44.43, 26.10),
+    "phx": ("Phoenix, Arizona (US)", 33.45, -112.07),
+    "qro": ("Querétaro, Mexico", 20.59, -100.39),
+    "scl": ("Santiago, Chile", -33.45, -70.67),
+    "sea": ("Seattle, Washington (US)", 47.61, -122.33),
+    "sin": ("Singapore, Singapore", 1.35, 103.82),
+    "sjc": ("San Jose, California (US)", 37.35, -121.96),
+    "syd": ("Sydney, Australia", -33.87, 151.21),
+    "waw": ("Warsaw, Poland", 52.23, 21.01),
+    "yul": ("Montreal, Canada", 45.50, -73.57),
+    "yyz": ("Toronto, Canada", 43.65, -79.38),
+}
+
+# Light in fibre covers roughly 100km per millisecond of round trip, and
+# real routes are rarely straight lines
+ROUTE_FACTOR = 1.5
+BASE_LATENCY_MS = 5
+
+CACHE_FILE = "regions.json"
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = (
+        math.sin((lat2 - lat1) / 2) ** 2
+        + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    )
+    return 6371 * 2 * math.asin(math.sqrt(a))
+
+
+def estimate_latency_ms(lat, lon, region):
+    _, region_lat, region_lon = FLY_REGIONS[region]
+    distance = haversine_km(lat, lon, region_lat, region_lon)
+    return BASE_LATENCY_MS + distance / 100 * ROUTE_FACTOR
+
+
+def parse_client_location(value):
+    try:
+        lat, lon = [float(bit) for bit in value.split(",")]
+    except ValueError:
+        raise click.ClickException(
+            "Invalid client location {!r}, expected LAT,LON".format(value)
+        )
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        raise click.ClickException(
+            "Invalid client location {!r}, out of range".format(value)
+        )
+    return lat, lon
+
+
+def load_probes(path):
+    # Either CSV/TSV with client,region,latency_ms columns or a JSON
+    # list of objects with those keys
+    with open(path, encoding="utf-8") as fp:
+        content = fp.read()
+    if content.lstrip().startswith("["):
+        rows = json.loads(content)
+    else:
+        dialect = csv.excel_tab if "\t" in content.split("\n")[0] else csv.excel
+        rows = list(csv.DictReader(content.splitlines(), dialect=dialect))
+    probes = []
+    for row in rows:
+        try:
+            probes.append(
+                [str(row["client"]), row["region"], float(row["latency_ms"])]
+            )
+        except (KeyError, TypeError, ValueError):
+            raise click.ClickException(
+                "Invalid probe row in {}: {}".format(path, json.dumps(row))
+            )
+    return probes
+
+
+def latency_matrix(client_locations, probes):
+    "Returns {client: {region: latency_ms}}"
+    matrix = {}
+    for lat, lon in client_locations:
+        matrix["{},{}".format(lat, lon)] = {
+            region: estimate_latency_ms(lat, lon, region) for region in FLY_REGIONS
+        }
+    for client, region, latency_ms in probes:
+        # Measured latency always beats an estimate
+        matrix.setdefault("probe:" + client, {})[region] = latency_ms
+    return matrix
+
+
+def score_regions(matrix, count=1):
+    "Greedily pick count regions minimizing the mean best-case latency"
+    clients = list(matrix.values())
+    candidates = set.intersection(*(set(latencies) for latencies in clients))
+    if not candidates:
+        raise click.ClickException(
+            "No region has latency data for every client location"
+        )
+    chosen = []
+    best = [math.inf] * len(clients)
+    for _ in range(min(count, len(candidates))):
+
+        def mean_with(region):
+            return sum(
+                min(current, latencies[region])
+                for current, latencies in zip(best, clients)
+            ) / len(clients)
+
+        region = min(sorted(candidates - set(chosen)), key=mean_with)
+        chosen.append(region)
+        best = [
+            min(current, latencies[region])
+            for current, latencies in zip(best, clients)
+        ]
+    return chosen, sum(best) / len(clients)
+
+
+def choose_regions(app, client_locations, probes_file, count):
+    cache = read_cache(CACHE_FILE)
+    if client_locations or probes_file:
+        inputs = {
+            "client_locations": [
+                list(parse_client_location(value)) for value in client_locations
+            ],
+            "probes": load_probes(probes_file) if probes_file else [],
+        }
+    elif app in cache:
+        inputs = cache[app]["inputs"]
+        click.echo("Using cached client locations for {}".format(app), err=True)
+    else:
+        raise click.ClickException(
+            "--region auto needs --client-location or --region-probes"
+        )
+    matrix = latency_matrix(inputs["client_locations"], inputs["probes"])
+    regions, mean_latency = score_regions(matrix, count)
+    cache[app] = {"inputs": inputs, "regions": regions, "mean_latency_ms": mean_latency}
+    write_cache(CACHE_FILE, cache)
+    click.echo(
+        "Selected region{} {} (expected mean latency {:.0f}ms across {} client{})".format(
+            "s" if len(regions) > 1 else "",
+            ", ".join(regions),
+            mean_latency,
+            len(matrix),
+            "s" if len(matrix) > 1 else "",
+        ),
+        err=True,
+    )
+    return regions
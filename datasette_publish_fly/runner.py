@@ -0,0 +1,317 @@
+"""
+Runs flyctl and other commands with a timeout, retrying transient failures
+
+A drop-in replacement for subprocess.run() as it is used by this plugin.
+Each attempt runs under asyncio - or threads, where asyncio can't start
+subprocesses - reading stdout and stderr as they arrive, captured or shown
+live, so a command that floods its output can't block on a full pipe.
+A command that times out or is cancelled is killed along with every
+process it started. Read-only commands that time out, or fail with an
+error that looks like a network problem rather than a real failure, are
+retried with exponential backoff.
+"""
+from subprocess import PIPE
+import asyncio
+import click
+import os
+import re
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+TIMEOUT = 300
+# Image builds and deploys can legitimately take a long time
+LONG_TIMEOUT = 1800
+# Reads that should never take long, so a hang is noticed quickly
+SHORT_TIMEOUT = 60
+TIMEOUTS = (
+    (["flyctl", "deploy"], LONG_TIMEOUT),
+    (["docker", "buildx"], LONG_TIMEOUT),
+    (["flyctl", "auth", "token"], SHORT_TIMEOUT),
+    (["flyctl", "apps", "list"], SHORT_TIMEOUT),
+    (["flyctl", "volumes", "list"], SHORT_TIMEOUT),
+    (["flyctl", "secrets", "list"], SHORT_TIMEOUT),
+)
+
+RETRIES = 3
+BACKOFF = 2.0
+# Only commands that are safe to run again are retried. One that creates
+# or deploys something may well have done it before the error
+RETRIED = (
+    ["flyctl", "auth", "token"],
+    ["flyctl", "apps", "list"],
+    ["flyctl", "volumes", "list"],
+    ["flyctl", "secrets", "list"],
+    # Staging the same values again changes nothing
+    ["flyctl", "secrets", "set", "--stage"],
+    ["flyctl", "status"],
+    ["flyctl", "regions"],
+)
+
+TRANSIENT_ERRORS = re.compile(
+    r"i/o timeout|TLS handshake timeout|context deadline exceeded|"
+    r"connection reset by peer|connection refused|unexpected EOF|no such host|"
+    r"temporarily unavailable|too many requests|rate limit|"
+    r"\b502 Bad Gateway|\b503 Service Unavailable|\b504 Gateway Timeout",
+    re.IGNORECASE,
+)
+
+# The end of each output stream, kept for spotting transient errors
+TAIL_BYTES = 8192
+READ_SIZE = 64 * 1024
+
+# Across all threads, for kill_running()
+RUNNING = set()
+
+
+class Result(subprocess.CompletedProcess):
+    """
+    A subprocess.CompletedProcess that also records how the command went.
+    stdout and stderr are None unless they were captured with PIPE.
+    """
+
+    def __init__(
+        self,
+        args,
+        returncode,
+        stdout=None,
+        stderr=None,
+        tail=b"",
+        duration=0.0,
+        timed_out=False,
+        attempts=1,
+    ):
+        super().__init__(args, returncode, stdout, stderr)
+        self.tail = tail
+        self.duration = duration
+        self.timed_out = timed_out
+        self.attempts = attempts
+
+
+def default_timeout(args):
+    for prefix, timeout in TIMEOUTS:
+        if args[: len(prefix)] == prefix:
+            return timeout
+    return TIMEOUT
+
+
+def default_retries(args):
+    if any(args[: len(prefix)] == prefix for prefix in RETRIED):
+        return RETRIES
+    return 0
+
+
+def kill_tree(process):
+    "Kill process and everything it started"
+    try:
+        if os.name == "nt":
+            process.kill()
+        else:
+            # It leads its own process group, see run_async()
+            os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def kill_running():
+    """
+    Kill every command still running, in any thread. They are in process
+    groups of their own, so Ctrl+C doesn't reach them directly.
+    """
+    for process in list(RUNNING):
+        kill_tree(process)
+
+
+class Output:
+    "Captures or copies a command's stdout and stderr, keeping their tails"
+
+    def __init__(self, stdout, stderr):
+        self.capture = {"stdout": stdout == PIPE, "stderr": stderr == PIPE}
+        self.captured = {"stdout": bytearray(), "stderr": bytearray()}
+        self.tails = {"stdout": b"", "stderr": b""}
+
+    def add(self, name, chunk):
+        if self.capture[name]:
+            self.captured[name] += chunk
+        else:
+            output = getattr(sys, name).buffer
+            output.write(chunk)
+            output.flush()
+        self.tails[name] = (self.tails[name] + chunk)[-TAIL_BYTES:]
+
+    def result(self, args, returncode, start, timed_out):
+        return Result(
+            args,
+            returncode,
+            bytes(self.captured["stdout"]) if self.capture["stdout"] else None,
+            bytes(self.captured["stderr"]) if self.capture["stderr"] else None,
+            # Errors are most likely on stderr, so that comes first
+            tail=self.tails["stderr"] + self.tails["stdout"],
+            duration=time.monotonic() - start,
+            timed_out=timed_out,
+        )
+
+
+async def run_async(args, input=None, stdout=None, stderr=None, timeout=TIMEOUT):
+    """
+    Run args once, returning a Result. Streams that aren't captured with
+    PIPE are copied to this process's stdout and stderr as they arrive.
+    """
+    start = time.monotonic()
+    process = await asyncio.create_subprocess_exec(
+        *args,
+        stdin=None if input is None else PIPE,
+        stdout=PIPE,
+        stderr=PIPE,
+        # So the whole tree can be killed at once
+        start_new_session=True,
+    )
+    RUNNING.add(process)
+    output = Output(stdout, stderr)
+
+    async def copy(name, reader):
+        while True:
+            chunk = await reader.read(READ_SIZE)
+            if not chunk:
+                return
+            output.add(name, chunk)
+
+    async def write_input():
+        try:
+            process.stdin.write(input)
+            await process.stdin.drain()
+            process.stdin.close()
+        except (BrokenPipeError, ConnectionResetError):
+            # It exited without reading everything, its exit code says why
+            pass
+
+    tasks = [
+        asyncio.ensure_future(copy("stdout", process.stdout)),
+        asyncio.ensure_future(copy("stderr", process.stderr)),
+    ]
+    if input is not None:
+        tasks.append(asyncio.ensure_future(write_input()))
+    timed_out = False
+    try:
+        await asyncio.wait_for(asyncio.gather(process.wait(), *tasks), timeout)
+    except asyncio.TimeoutError:
+        timed_out = True
+    finally:
+        # On a timeout, or if this was cancelled. Something it started may
+        # still be holding its output open even if it has exited itself
+        if timed_out or process.returncode is None:
+            kill_tree(process)
+            await process.wait()
+        RUNNING.discard(process)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    return output.result(args, process.returncode, start, timed_out)
+
+
+def run_threaded(args, input=None, stdout=None, stderr=None, timeout=TIMEOUT):
+    """
+    run_async() using threads instead, for threads other than the main one
+    on Python 3.7 - its asyncio can only start subprocesses from there
+    """
+    start = time.monotonic()
+    process = subprocess.Popen(
+        args,
+        stdin=None if input is None else PIPE,
+        stdout=PIPE,
+        stderr=PIPE,
+        start_new_session=True,
+    )
+    RUNNING.add(process)
+    output = Output(stdout, stderr)
+
+    def copy(name, reader):
+        for chunk in iter(lambda: reader.read1(READ_SIZE), b""):
+            output.add(name, chunk)
+
+    def write_input():
+        try:
+            process.stdin.write(input)
+            process.stdin.close()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    threads = [
+        threading.Thread(target=copy, args=("stdout", process.stdout), daemon=True),
+        threading.Thread(target=copy, args=("stderr", process.stderr), daemon=True),
+        # A blocking wait, Popen.wait(timeout) polls with time.sleep()
+        threading.Thread(target=process.wait, daemon=True),
+    ]
+    if input is not None:
+        threads.append(threading.Thread(target=write_input, daemon=True))
+    for thread in threads:
+        thread.start()
+    deadline = start + timeout
+    for thread in threads:
+        thread.join(max(deadline - time.monotonic(), 0))
+    timed_out = any(thread.is_alive() for thread in threads)
+    if timed_out:
+        kill_tree(process)
+        process.wait()
+    RUNNING.discard(process)
+    # Killing the tree closed the pipes, so these finish
+    for thread in threads:
+        thread.join()
+    for stream in (process.stdout, process.stderr):
+        stream.close()
+    return output.result(args, process.returncode, start, timed_out)
+
+
+def run_once(args, input, stdout, stderr, timeout):
+    if sys.version_info < (3, 8) and (
+        threading.current_thread() is not threading.main_thread()
+    ):
+        return run_threaded(args, input, stdout, stderr, timeout)
+    return asyncio.run(run_async(args, input, stdout, stderr, timeout))
+
+
+def run(
+    args,
+    input=None,
+    stdout=None,
+    stderr=None,
+    timeout=None,
+    retries=None,
+    retry_if=None,
+):
+    """
+    retry_if is for commands that aren't safe to simply run again: it is
+    called before each retry, and if it returns False the command took
+    effect after all and its last result is returned as it is.
+    """
+    timeout = timeout or default_timeout(args)
+    if retries is None:
+        retries = default_retries(args)
+    command = " ".join(args[:3])
+    for attempt in range(retries + 1):
+        result = run_once(args, input, stdout, stderr, timeout)
+        result.attempts = attempt + 1
+        if result.timed_out:
+            problem = "timed out after {}s".format(timeout)
+        else:
+            match = result.returncode and TRANSIENT_ERRORS.search(
+                result.tail.decode("utf-8", "replace")
+            )
+            if not match:
+                return result
+            problem = match.group(0)
+        if attempt == retries:
+            break
+        if retry_if and not retry_if():
+            return result
+        delay = BACKOFF * 2**attempt
+        click.echo(
+            "'{}' failed ({}), retrying in {:.0f}s".format(command, problem, delay),
+            err=True,
+        )
+        time.sleep(delay)
+    if result.timed_out:
+        raise click.ClickException("'{}' {}".format(command, problem))
+    return result
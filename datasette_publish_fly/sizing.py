@@ -0,0 +1,87 @@
+import click
+import math
+import os
+
+GB = 1024 * 1024 * 1024
+MB = 1024 * 1024
+
+# Memory options for the default shared-cpu-1x VM, which can't have more
+VM_MEMORY_MB = (256, 512, 1024, 2048)
+
+# Python, Datasette and its plugins before any data is loaded
+BASE_MEMORY_MB = 160
+
+# SQLite uses a 2MB page cache per connection unless cache_size_kb is set
+DEFAULT_SQLITE_CACHE_KB = 2000
+
+DEFAULT_NUM_SQL_THREADS = 3
+
+# Leave room for request handling and the occasional big query
+HEADROOM = 1.25
+
+
+def total_size(paths):
+    return sum(os.path.getsize(path) for path in paths)
+
+
+def choose_volume_gb(volume_bytes, growth, chunked_bytes=0):
+    "Returns (size_in_gb, list_of_reasons)"
+    needed = volume_bytes * growth
+    reasons = [
+        "{:.2f}GB of databases on the volume x {} expected growth = {:.2f}GB".format(
+            volume_bytes / GB, growth, needed / GB
+        )
+    ]
+    if chunked_bytes:
+        # They are read-only, so won't grow
+        needed += chunked_bytes
+        reasons.append(
+            "+ {:.2f}GB of chunked databases reassembled on the volume = {:.2f}GB".format(
+                chunked_bytes / GB, needed / GB
+            )
+        )
+    size = max(1, math.ceil(needed / GB))
+    reasons.append("Volume size: {}GB".format(size))
+    return size, reasons
+
+
+def choose_vm_memory_mb(database_bytes, database_count, settings):
+    "Returns (memory_mb, list_of_reasons)"
+    settings = dict(settings or ())
+    cache_size_kb = settings.get("cache_size_kb") or DEFAULT_SQLITE_CACHE_KB
+    num_sql_threads = settings.get("num_sql_threads") or DEFAULT_NUM_SQL_THREADS
+    # Each SQL thread holds its own connection to every database
+    sqlite_cache_mb = cache_size_kb * 1024 * num_sql_threads * database_count / MB
+    page_cache_mb = database_bytes / MB
+    needed = (BASE_MEMORY_MB + sqlite_cache_mb + page_cache_mb) * HEADROOM
+    reasons = [
+        "{}MB base + {:.0f}MB SQLite caches ({}KB x {} threads x {} databases)"
+        " + {:.0f}MB for databases in the page cache, plus {:.0%} headroom"
+        " = {:.0f}MB".format(
+            BASE_MEMORY_MB,
+            sqlite_cache_mb,
+            cache_size_kb,
+            num_sql_threads,
+            database_count,
+            page_cache_mb,
+            HEADROOM - 1,
+            needed,
+        )
+    ]
+    for memory_mb in VM_MEMORY_MB:
+        if memory_mb >= needed:
+            break
+    else:
+        reasons.append(
+            "Warning: the databases will not fit in the page cache of a"
+            " shared-cpu-1x VM, which can have at most {}MB - use --target-rps"
+            " to choose a bigger VM size".format(memory_mb)
+        )
+    reasons.append("VM memory: {}MB".format(memory_mb))
+    return memory_mb, reasons
+
+
+def echo_reasons(heading, reasons):
+    click.echo("{}:".format(heading), err=True)
+    for reason in reasons:
+        click.echo("  {}".format(reason), err=True)
@@ -0,0 +1,151 @@
+"""
+Page-level diffing for SQLite database files
+
+This module only uses the standard library: it is also copied into the
+running container and executed there with "python3 sqlite_pages.py ..."
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import zlib
+
+MAGIC = b"SQLITE-PAGE-DELTA-1\n"
+
+
+def snapshot(path, destination):
+    # The backup API gives us a consistent copy even if the database is
+    # being written to, or has un-checkpointed WAL content
+    if os.path.exists(destination):
+        os.remove(destination)
+    source = sqlite3.connect("file:{}?mode=ro".format(path), uri=True)
+    target = sqlite3.connect(destination)
+    with target:
+        source.backup(target)
+    target.execute("PRAGMA journal_mode=delete")
+    source.close()
+    target.close()
+
+
+def page_size(path):
+    with open(path, "rb") as fp:
+        header = fp.read(100)
+    size = int.from_bytes(header[16:18], "big")
+    # A value of 1 means 65536 - see https://www.sqlite.org/fileformat.html
+    return 65536 if size == 1 else size
+
+
+def iter_pages(path, size):
+    with open(path, "rb") as fp:
+        for page in iter(lambda: fp.read(size), b""):
+            yield page
+
+
+def page_hashes(path):
+    if not os.path.exists(path) or not os.path.getsize(path):
+        return {"page_size": 0, "hashes": []}
+    size = page_size(path)
+    return {
+        "page_size": size,
+        "hashes": [
+            hashlib.sha1(page).hexdigest()[:16] for page in iter_pages(path, size)
+        ],
+    }
+
+
+def file_sha256(path):
+    hasher = hashlib.sha256()
+    with open(path, "rb") as fp:
+        for block in iter(lambda: fp.read(1024 * 1024), b""):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def make_delta(path, remote):
+    "Returns (delta_bytes, changed_page_count, total_page_count)"
+    size = page_size(path)
+    remote_hashes = remote["hashes"] if remote["page_size"] == size else []
+    changed = []
+    pages = []
+    page_count = 0
+    for i, page in enumerate(iter_pages(path, size)):
+        page_count += 1
+        if i >= len(remote_hashes) or (
+            hashlib.sha1(page).hexdigest()[:16] != remote_hashes[i]
+        ):
+            changed.append(i)
+            pages.append(page)
+    header = json.dumps(
+        {"page_size": size, "page_count": page_count, "pages": changed}
+    ).encode("utf-8")
+    delta = MAGIC + zlib.compress(header + b"\n" + b"".join(pages))
+    return delta, len(changed), page_count
+
+
+def apply_delta(path, delta):
+    assert delta.startswith(MAGIC), "Not a page delta"
+    body = zlib.decompress(delta[len(MAGIC) :])
+    header, pages = body.split(b"\n", 1)
+    header = json.loads(header)
+    size = header["page_size"]
+    mode = "r+b" if os.path.exists(path) else "w+b"
+    with open(path, mode) as fp:
+        for i, page_number in enumerate(header["pages"]):
+            fp.seek(page_number * size)
+            fp.write(pages[i * size : (i + 1) * size])
+        fp.truncate(header["page_count"] * size)
+
+
+def sync_path(path):
+    directory, name = os.path.split(path)
+    return os.path.join(directory, ".{}.sync".format(name))
+
+
+def database_hashes(path):
+    "Page hashes of a snapshot of path, which apply_to_database() then patches"
+    working = sync_path(path)
+    if os.path.exists(path):
+        snapshot(path, working)
+    return page_hashes(working)
+
+
+def apply_to_database(path, delta, expected_sha256):
+    working = sync_path(path)
+    apply_delta(working, delta)
+    if file_sha256(working) != expected_sha256:
+        os.remove(working)
+        raise ValueError("Patched database does not match, run the sync again")
+    conn = sqlite3.connect(working)
+    result = conn.execute("PRAGMA quick_check").fetchone()[0]
+    if result != "ok":
+        conn.close()
+        raise ValueError("Patched database failed quick_check: {}".format(result))
+    # Copy into the live database, respecting any locks held by Datasette
+    target = sqlite3.connect(path)
+    with target:
+        conn.backup(target)
+    target.close()
+    conn.close()
+    os.remove(working)
+
+
+def main(argv):
+    command, path = argv[1], argv[2]
+    if command == "hashes":
+        print(json.dumps(database_hashes(path)))
+    elif command == "apply":
+        delta_path, expected_sha256 = argv[3], argv[4]
+        with open(delta_path, "rb") as fp:
+            delta = fp.read()
+        os.remove(delta_path)
+        try:
+            apply_to_database(path, delta, expected_sha256)
+        except ValueError as e:
+            sys.exit(str(e))
+    else:
+        sys.exit("Unknown command: {}".format(command))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
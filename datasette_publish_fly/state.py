@@ -0,0 +1,116 @@
+"""
+Records the phases of a publish as they finish, so --resume can skip them
+
+State is kept in the cache directory, keyed by a hash of the app name, the
+options and the size and modification time of the files being published -
+change any of those and the publish starts again from the beginning.
+
+How long each phase took is kept too, for --plan to estimate from.
+"""
+from .utils import read_cache, write_cache
+import click
+import hashlib
+import json
+import os
+import statistics
+import time
+
+CACHE_FILE = "publish-state.json"
+TIMINGS_FILE = "timings.json"
+# Per phase, oldest first
+MAX_TIMINGS = 20
+
+
+def state_key(app, paths, options):
+    files = []
+    for path in paths:
+        stat = os.stat(path)
+        files.append([os.path.abspath(path), stat.st_size, stat.st_mtime_ns])
+    return hashlib.sha256(
+        json.dumps([app, options, files], sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()[:16]
+
+
+class PublishState:
+    def __init__(self, app, key, resume):
+        self.app = app
+        self.key = key
+        states = read_cache(CACHE_FILE)
+        if resume:
+            self.phases = states.get(key, {}).get("phases", {})
+            if self.phases:
+                click.echo(
+                    "Resuming publish of {}, skipping: {}".format(
+                        app, ", ".join(self.phases)
+                    ),
+                    err=True,
+                )
+            else:
+                click.echo("Nothing to resume, publishing from the start", err=True)
+        else:
+            self.phases = {}
+        self.phase_started = time.monotonic()
+
+    def done(self, phase):
+        return phase in self.phases
+
+    def get(self, phase):
+        return self.phases[phase]
+
+    def record(self, phase, value=True, size=None, timed=True):
+        """
+        size is the number of bytes the phase had to deal with, if that
+        matters. timed=False for a phase that was done somewhere else.
+        """
+        now = time.monotonic()
+        if timed:
+            # "sync data.db" is timed as "sync"
+            record_timing(phase.split()[0], now - self.phase_started, size)
+        self.phase_started = now
+        self.phases[phase] = value
+        states = read_cache(CACHE_FILE)
+        states[self.key] = {
+            "app": self.app,
+            "updated": int(time.time()),
+            "phases": self.phases,
+        }
+        write_cache(CACHE_FILE, states)
+
+    def finish(self):
+        states = read_cache(CACHE_FILE)
+        if states.pop(self.key, None) is not None:
+            write_cache(CACHE_FILE, states)
+
+
+def record_timing(phase, seconds, size=None):
+    timings = read_cache(TIMINGS_FILE)
+    records = timings.setdefault(phase, [])
+    records.append({"seconds": round(seconds, 3), "bytes": size})
+    del records[:-MAX_TIMINGS]
+    write_cache(TIMINGS_FILE, timings)
+
+
+def estimate_seconds(phase, size=None):
+    """
+    Estimate from previous timings of phase, or None if there aren't any.
+    Given a size, and timings for at least two different sizes, this fits
+    a straight line through them.
+    """
+    records = read_cache(TIMINGS_FILE).get(phase)
+    if not records:
+        return None
+    sized = [
+        (record["bytes"], record["seconds"])
+        for record in records
+        if record.get("bytes") is not None
+    ]
+    if size is not None and len({x for x, _ in sized}) > 1:
+        mean_x = statistics.mean(x for x, _ in sized)
+        mean_y = statistics.mean(y for _, y in sized)
+        slope = max(
+            0,
+            sum((x - mean_x) * (y - mean_y) for x, y in sized)
+            / sum((x - mean_x) ** 2 for x, _ in sized),
+        )
+        return max(0, mean_y - slope * mean_x) + slope * size
+    return statistics.median(record["seconds"] for record in records)
@@ -0,0 +1,32 @@
+import click
+import json
+import os
+import pathlib
+
+
+def cache_dir():
+    # DATASETTE_PUBLISH_FLY_CACHE_DIR is mainly useful for tests and CI
+    path = pathlib.Path(
+        os.environ.get("DATASETTE_PUBLISH_FLY_CACHE_DIR")
+        or click.get_app_dir("datasette-publish-fly")
+    )
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def read_cache(name):
+    path = cache_dir() / name
+    if not path.exists():
+        return {}
+    try:
+        return json.loads(path.read_text("utf-8"))
+    except ValueError:
+        # Corrupt cache files are treated as empty
+        return {}
+
+
+def write_cache(name, data):
+    path = cache_dir() / name
+    tmp_path = path.with_suffix(".tmp")
+    tmp_path.write_text(json.dumps(data, indent=2), "utf-8")
+    os.replace(str(tmp_path), str(path))
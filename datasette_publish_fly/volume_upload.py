@@ -0,0 +1,139 @@
+from .runner import run, PIPE
+from .utils import read_cache, write_cache
+import click
+import hashlib
+import json
+import os
+import shlex
+
+CHUNK_SIZE = 64 * 1024 * 1024
+MANIFEST = "/data/.datasette-publish-fly.json"
+CACHE_FILE = "uploads.json"
+
+
+def file_sha256(path):
+    hasher = hashlib.sha256()
+    with open(path, "rb") as fp:
+        for block in iter(lambda: fp.read(1024 * 1024), b""):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def ssh(app, command, input=None):
+    return run(
+        [
+            "flyctl",
+            "ssh",
+            "console",
+            "-a",
+            app,
+            "-C",
+            "sh -c {}".format(shlex.quote(command)),
+        ],
+        input=input,
+        stdout=PIPE,
+        stderr=PIPE,
+    )
+
+
+def ssh_or_fail(app, command, input=None):
+    result = ssh(app, command, input=input)
+    if result.returncode:
+        raise click.ClickException(
+            "Error calling 'flyctl ssh console':\n\n{}".format(
+                result.stderr.decode("utf-8").strip()
+            )
+        )
+    return result.stdout.decode("utf-8")
+
+
+def remote_manifest(app):
+    result = ssh(app, "cat {} 2>/dev/null || echo '{{}}'".format(MANIFEST))
+    if result.returncode:
+        return {}
+    try:
+        return json.loads(result.stdout)
+    except ValueError:
+        return {}
+
+
+def remote_size(app, path):
+    result = ssh(app, "stat -c %s {} 2>/dev/null || echo 0".format(shlex.quote(path)))
+    try:
+        return int(result.stdout.strip() or 0)
+    except ValueError:
+        return 0
+
+
+def upload_file(app, path, sha256, chunk_size=CHUNK_SIZE):
+    name = os.path.basename(path)
+    partial = "/data/.{}.partial".format(name)
+    pending = read_cache(CACHE_FILE)
+    offset = 0
+    if pending.get(app, {}).get(name) == sha256:
+        # An earlier upload of this exact file was interrupted - resume it
+        offset = remote_size(app, partial) // chunk_size * chunk_size
+    pending.setdefault(app, {})[name] = sha256
+    write_cache(CACHE_FILE, pending)
+    size = os.path.getsize(path)
+    if offset:
+        click.echo("Resuming upload of {} at byte {}".format(name, offset), err=True)
+    else:
+        ssh_or_fail(app, ": > {}".format(shlex.quote(partial)))
+    with open(path, "rb") as fp:
+        fp.seek(offset)
+        while offset < size:
+            chunk = fp.read(chunk_size)
+            ssh_or_fail(
+                app,
+                "dd of={} bs={} seek={} conv=notrunc status=none".format(
+                    shlex.quote(partial), chunk_size, offset // chunk_size
+                ),
+                input=chunk,
+            )
+            offset += len(chunk)
+            click.echo(
+                "Uploaded {} of {} bytes of {}".format(offset, size, name), err=True
+            )
+    remote_sha256 = ssh_or_fail(
+        app,
+        "truncate -s {} {} && sha256sum {}".format(
+            size, shlex.quote(partial), shlex.quote(partial)
+        ),
+    ).split()[0]
+    if remote_sha256 != sha256:
+        raise click.ClickException(
+            "Checksum mismatch uploading {}, run the command again".format(name)
+        )
+    destination = shlex.quote("/data/" + name)
+    # A -wal file left by the database being replaced would corrupt the new one
+    ssh_or_fail(
+        app,
+        "rm -f {0}-wal {0}-shm && mv {1} {0}".format(
+            destination, shlex.quote(partial)
+        ),
+    )
+    pending[app].pop(name)
+    write_cache(CACHE_FILE, pending)
+
+
+def upload_files_to_volume(app, paths, chunk_size=CHUNK_SIZE):
+    "Upload changed files to /data, returns list of uploaded file names"
+    manifest = remote_manifest(app)
+    uploaded = []
+    for path in paths:
+        name = os.path.basename(path)
+        sha256 = file_sha256(path)
+        if manifest.get(name) == sha256:
+            click.echo("{} is unchanged, skipping upload".format(name), err=True)
+            continue
+        upload_file(app, path, sha256, chunk_size)
+        manifest[name] = sha256
+        uploaded.append(name)
+        # Record progress after each file so a failure doesn't repeat work
+        ssh_or_fail(
+            app,
+            "cat > {}".format(MANIFEST),
+            input=json.dumps(manifest).encode("utf-8"),
+        )
+    return uploaded
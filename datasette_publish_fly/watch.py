@@ -0,0 +1,166 @@
+"""
+Republishes whenever the files being published change, for --watch
+
+Files are polled rather than watched with inotify and friends, and a
+republish waits until they have stopped changing, so a burst of writes -
+or one big file being copied into place - only deploys once.
+
+Republishes reuse the preflight result of the first publish and build from
+a context directory that stays in the same place, with a layer for each
+file or directory, so the builder only needs the parts that changed.
+"""
+from .context import is_ignored
+from .utils import cache_dir
+import click
+import filecmp
+import json
+import os
+import shutil
+import sqlite3
+import time
+
+POLL_INTERVAL = 1.0
+# How long files must stay the same before republishing
+DEBOUNCE = 5.0
+
+# Needed to build the image but not copied into it
+BUILD_FILES = ("Dockerfile", ".dockerignore", "fly.toml")
+
+
+def watched_paths(files, metadata, template_dir, plugins_dir, static, sync_db):
+    paths = list(files) + list(sync_db)
+    if metadata:
+        paths.append(metadata.name)
+    paths.extend(path for path in (template_dir, plugins_dir) if path)
+    paths.extend(path for _, path in static)
+    return paths
+
+
+def snapshot(paths):
+    "Size and modification time of every file in paths, walking directories"
+    stats = {}
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, filenames in os.walk(path):
+                for filename in filenames:
+                    file_path = os.path.join(root, filename)
+                    if not is_ignored(os.path.relpath(file_path, path)):
+                        stats[file_path] = file_stat(file_path)
+        else:
+            stats[path] = file_stat(path)
+    return stats
+
+
+def file_stat(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        # Mid-replace, or deleted - either way a change
+        return None
+    return (stat.st_size, stat.st_mtime_ns)
+
+
+def wait_for_change(paths, before, interval=POLL_INTERVAL, debounce=DEBOUNCE):
+    "Blocks until paths change and then settle, returns the new snapshot"
+    current = before
+    while current == before:
+        time.sleep(interval)
+        current = snapshot(paths)
+    settled_at = time.monotonic()
+    while time.monotonic() - settled_at < debounce:
+        time.sleep(interval)
+        latest = snapshot(paths)
+        if latest != current:
+            current = latest
+            settled_at = time.monotonic()
+    return current
+
+
+def watch_and_publish(paths, publish):
+    """
+    Publish, then publish again each time paths change. publish is called
+    with the (region, volume) result of the previous successful publish.
+    """
+    before = snapshot(paths)
+    preflight_result = publish(None)
+    try:
+        while True:
+            click.echo("Watching {} for changes".format(", ".join(paths)), err=True)
+            current = wait_for_change(paths, before)
+            changed = sorted(
+                path
+                for path in set(before) | set(current)
+                if before.get(path) != current.get(path)
+            )
+            click.echo(
+                "Changed: {} - republishing".format(", ".join(changed)), err=True
+            )
+            before = current
+            try:
+                preflight_result = publish(preflight_result)
+            except click.ClickException as e:
+                # Most likely a half-written file - the next change retries
+                e.show()
+            except (OSError, sqlite3.Error) as e:
+                click.ClickException(str(e)).show()
+    except KeyboardInterrupt:
+        click.echo("Stopped watching", err=True)
+
+
+def split_copy_layers(expand=(), exclude=()):
+    """
+    Replace COPY . /app with a COPY --link layer for each file and directory,
+    or for each file inside the directories in expand, leaving out exclude
+    """
+    names = []
+    for name in sorted(os.listdir(".")):
+        if name in BUILD_FILES or name in exclude or is_ignored(name):
+            continue
+        if name in expand:
+            names.extend(
+                "{}/{}".format(name, filename)
+                for filename in sorted(os.listdir(name))
+            )
+        else:
+            names.append(name)
+    lines = open("Dockerfile").read().split("\n")
+    index = lines.index("COPY . /app")
+    # --link layers don't depend on the ones before them, so changing one
+    # file leaves the cached layers of every other file alone
+    lines[index : index + 1] = [
+        "COPY --link {}".format(json.dumps([name, "/app/" + name])) for name in names
+    ]
+    open("Dockerfile", "w").write("\n".join(lines))
+
+
+def stable_context(app):
+    """
+    Mirror the current directory into the same directory for every publish
+    of app, leaving unchanged files untouched. Returns its path.
+    """
+    target = cache_dir() / "context" / app
+    wanted = set()
+    for root, _, filenames in os.walk("."):
+        for filename in filenames:
+            relative_path = os.path.relpath(os.path.join(root, filename), ".")
+            wanted.add(relative_path)
+            destination = target / relative_path
+            if destination.exists() and filecmp.cmp(
+                relative_path, str(destination), shallow=False
+            ):
+                continue
+            destination.parent.mkdir(parents=True, exist_ok=True)
+            if destination.exists():
+                destination.unlink()
+            try:
+                os.link(relative_path, str(destination))
+            except OSError:
+                shutil.copy2(relative_path, str(destination))
+    for root, _, filenames in os.walk(str(target), topdown=False):
+        for filename in filenames:
+            path = os.path.join(root, filename)
+            if os.path.relpath(path, str(target)) not in wanted:
+                os.remove(path)
+        if root != str(target) and not os.listdir(root):
+            os.rmdir(root)
+    return str(target)
@@ -26,9 +26,12 @@ setup(
     },
     license="Apache License, Version 2.0",
     version=VERSION,
-    packages=["datasette_publish_fly"],
+    packages=["datasette_publish_fly", "datasette_publish_fly.container_plugins"],
     entry_points={"datasette": ["publish_fly = datasette_publish_fly"]},
-    install_requires=["datasette>=0.60.2"],
-    extras_require={"test": ["pytest", "pytest-mock", "cogapp"]},
+    install_requires=["datasette>=0.61"],
+    extras_require={
+        "test": ["pytest", "pytest-mock", "cogapp"],
+        "zstd": ["zstandard"],
+    },
     tests_require=["datasette-publish-fly[test]"],
 )
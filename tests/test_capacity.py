@@ -0,0 +1,105 @@
+from datasette_publish_fly.capacity import choose_machines, run_benchmark, serve_args
+import click
+import pytest
+import sqlite3
+import sys
+
+DOCKERFILE = """FROM python:3.11.0-slim-bullseye
+COPY . /app
+WORKDIR /app
+RUN datasette inspect test.db --inspect-file inspect-data.json
+ENV PORT 8080
+EXPOSE 8080
+CMD datasette serve --host 0.0.0.0 -i test.db --cors --inspect-file inspect-data.json --setting num_sql_threads 2 --port $PORT"""
+
+
+def benchmark(rps=200, p95_ms=100):
+    return {
+        "paths": 5,
+        "concurrency": 25,
+        "requests": rps * 10,
+        "errors": 0,
+        "rps": rps,
+        "p50_ms": p95_ms / 2,
+        "p95_ms": p95_ms,
+    }
+
+
+def test_serve_args(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "Dockerfile").write_text(DOCKERFILE, "utf-8")
+    assert serve_args(8123) == [
+        sys.executable,
+        "-m",
+        "datasette",
+        "serve",
+        "--host",
+        "127.0.0.1",
+        "-i",
+        "test.db",
+        "--cors",
+        "--setting",
+        "num_sql_threads",
+        "2",
+        "--port",
+        "8123",
+    ]
+
+
+def test_choose_machines():
+    vm_size, count, reasons = choose_machines(benchmark(p95_ms=50), 100)
+    # 200 / 16 x 70% = 8.75 requests/second per machine
+    assert (vm_size, count) == ("shared-cpu-1x", 12)
+    assert reasons[-1] == "VM size: shared-cpu-1x, machines: 12"
+    # shared-cpu-1x would have a p95 of 1600ms - shared-cpu-2x and 4x cost
+    # the same, so the one with fewer machines wins
+    vm_size, count, reasons = choose_machines(benchmark(p95_ms=100), 100)
+    assert (vm_size, count) == ("shared-cpu-4x", 3)
+    assert reasons[1] == (
+        "shared-cpu-4x: about 35 requests/second per machine at 70% utilization,"
+        " p95 around 400ms"
+    )
+
+
+def test_choose_machines_single_machine():
+    assert choose_machines(benchmark(), 100, max_machines=1)[:2] == (
+        "performance-1x",
+        1,
+    )
+    vm_size, count, reasons = choose_machines(benchmark(), 1000, max_machines=1)
+    assert (vm_size, count) == ("performance-2x", 1)
+    assert reasons[1] == (
+        "Warning: no VM size can serve 1000 requests/second with a p95 under"
+        " 1000ms on 1 machine(s)"
+    )
+
+
+def test_run_benchmark(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "Dockerfile").write_text(DOCKERFILE, "utf-8")
+    conn = sqlite3.connect(str(tmp_path / "test.db"))
+    with conn:
+        conn.execute("create table small (id integer primary key)")
+        conn.execute("create table [big table] (id integer primary key)")
+        conn.executemany("insert into [big table] default values", [()] * 100)
+    conn.close()
+    result = run_benchmark(4, seconds=0.5)
+    # /, /test and three pages for each table
+    assert result["paths"] == 8
+    assert result["concurrency"] == 4
+    assert result["errors"] == 0
+    assert result["requests"] > 0
+    assert result["rps"] > 0
+    assert 0 < result["p50_ms"] <= result["p95_ms"]
+
+
+def test_run_benchmark_startup_failure(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    # No test.db for it to serve
+    (tmp_path / "Dockerfile").write_text(DOCKERFILE, "utf-8")
+    with pytest.raises(click.ClickException) as e:
+        run_benchmark(4, seconds=0.5)
+    assert e.value.message.startswith(
+        "Datasette exited while starting up for the benchmark:"
+    )
+    assert "does not exist" in e.value.message
@@ -0,0 +1,145 @@
+from click.testing import CliRunner
+from datasette import cli
+from datasette_publish_fly import chunks
+import json
+import os
+import pytest
+import sqlite3
+import subprocess
+import sys
+
+
+@pytest.mark.parametrize("size,expected_chunks", ((10, 4), (9, 3), (2, 1)))
+def test_split_and_assemble(tmp_path, size, expected_chunks):
+    data = bytes(range(size))
+    (tmp_path / "big.db").write_bytes(data)
+    (tmp_path / "chunks").mkdir()
+    entry = chunks.split_file(str(tmp_path / "big.db"), str(tmp_path / "chunks"), 3)
+    assert entry["name"] == "big.db"
+    assert entry["size"] == size
+    assert [chunk["file"] for chunk in entry["chunks"]] == [
+        "big.db.{:03d}".format(i) for i in range(expected_chunks)
+    ]
+    assert sorted(os.listdir(tmp_path / "chunks")) == [
+        chunk["file"] for chunk in entry["chunks"]
+    ]
+    destination = str(tmp_path / "assembled.db")
+    chunks.assemble(str(tmp_path / "chunks"), entry, destination)
+    assert open(destination, "rb").read() == data
+
+
+def test_assemble_checksum_mismatch(tmp_path):
+    (tmp_path / "big.db").write_bytes(b"0123456789")
+    entry = chunks.split_file(str(tmp_path / "big.db"), str(tmp_path), 4)
+    (tmp_path / "big.db.001").write_bytes(b"4X67")
+    with pytest.raises(ValueError, match="Checksum mismatch in chunk big.db.001"):
+        chunks.assemble(str(tmp_path), entry, str(tmp_path / "assembled.db"))
+    assert not (tmp_path / "assembled.db").exists()
+    assert not (tmp_path / "assembled.db.partial").exists()
+
+
+def test_assemble_all_onto_volume(tmp_path, monkeypatch):
+    volume = tmp_path / "data"
+    volume.mkdir()
+    monkeypatch.setattr(chunks, "VOLUME", str(volume))
+    monkeypatch.setattr(os.path, "ismount", lambda path: path == str(volume))
+    app = tmp_path / "app"
+    (app / "chunks").mkdir(parents=True)
+    (app / "big.db").write_bytes(b"0123456789")
+    entry = chunks.split_file(str(app / "big.db"), str(app / "chunks"), 4)
+    os.remove(str(app / "big.db"))
+    (app / "chunks" / "manifest.json").write_text(json.dumps([entry]), "utf-8")
+    # Left by an earlier deploy
+    (volume / ".chunked-databases").mkdir()
+    (volume / ".chunked-databases" / "old.db").write_bytes(b"old")
+
+    assert list(chunks.assemble_all(str(app / "chunks"))) == [("big.db", 3)]
+    assembled = volume / ".chunked-databases" / "big.db"
+    assert os.readlink(str(app / "big.db")) == str(assembled)
+    assert (app / "big.db").read_bytes() == b"0123456789"
+    assert sorted(os.listdir(str(volume / ".chunked-databases"))) == [
+        "big.db",
+        "big.db.sha256",
+    ]
+    # A restart finds it already there
+    os.remove(str(app / "big.db"))
+    assert list(chunks.assemble_all(str(app / "chunks"))) == [("big.db", None)]
+    assert (app / "big.db").read_bytes() == b"0123456789"
+
+
+def test_generate_directory_chunk_size(tmp_path):
+    runner = CliRunner()
+    with runner.isolated_filesystem(temp_dir=tmp_path):
+        conn = sqlite3.connect("big.db")
+        conn.execute("create table t (id integer primary key, data blob)")
+        conn.executemany("insert into t (data) values (randomblob(1000))", [()] * 2500)
+        conn.commit()
+        conn.close()
+        sqlite3.connect("small.db").execute("create table s (id integer)")
+        result = runner.invoke(
+            cli.cli,
+            ["publish", "fly", "big.db", "small.db", "-a", "app"]
+            + ["--generate-dir", "out", "--chunk-size", "1"],
+            catch_exceptions=False,
+        )
+        assert result.exit_code == 0, result.output
+        assert "Split big.db into 3 chunks" in result.output
+        assert "Warning: without a volume the chunked databases" in result.output
+        assert sorted(os.listdir("out/chunks")) == [
+            "assemble.py",
+            "big.db.000",
+            "big.db.001",
+            "big.db.002",
+            "manifest.json",
+        ]
+        assert not os.path.exists("out/big.db")
+        dockerfile = open("out/Dockerfile").read().split("\n")
+        assert 'COPY --link ["chunks/big.db.001", "/app/chunks/big.db.001"]' in (
+            dockerfile
+        )
+        assert 'COPY --link ["small.db", "/app/small.db"]' in dockerfile
+        assert "COPY . /app" not in dockerfile
+        assert (
+            "RUN datasette inspect small.db --inspect-file inspect-data.json"
+            in dockerfile
+        )
+        assert dockerfile[-1].startswith(
+            "CMD python3 chunks/assemble.py && datasette serve"
+        )
+
+        # The container reassembles it before Datasette starts
+        subprocess.check_call([sys.executable, "out/chunks/assemble.py"])
+        conn = sqlite3.connect("out/big.db")
+        assert conn.execute("select count(*) from t").fetchone()[0] == 2500
+        assert conn.execute("pragma integrity_check").fetchone()[0] == "ok"
+
+
+def test_chunk_size_create_volume_auto(tmp_path):
+    runner = CliRunner()
+    with runner.isolated_filesystem(temp_dir=tmp_path):
+        with open("big.db", "wb") as fp:
+            fp.write(b"x" * 3 * 1024 * 1024)
+        result = runner.invoke(
+            cli.cli,
+            ["publish", "fly", "big.db", "-a", "app", "--generate-dir", "out"]
+            + ["--chunk-size", "1", "--create-volume", "auto"],
+            catch_exceptions=False,
+        )
+        assert result.exit_code == 0, result.output
+        assert (
+            "+ 0.00GB of chunked databases reassembled on the volume" in result.output
+        )
+        assert "Warning: without a volume" not in result.output
+
+
+def test_chunk_size_with_compress(tmp_path):
+    runner = CliRunner()
+    with runner.isolated_filesystem(temp_dir=tmp_path):
+        open("test.db", "w").write("data")
+        result = runner.invoke(
+            cli.cli,
+            ["publish", "fly", "test.db", "-a", "app", "--generate-dir", "out"]
+            + ["--chunk-size", "1", "--compress", "gzip"],
+        )
+    assert result.exit_code == 1
+    assert "--chunk-size cannot be used with --compress" in result.output
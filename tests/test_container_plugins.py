@@ -0,0 +1,296 @@
+# Tests for the plugins that get copied into the generated application
+from datasette.app import Datasette
+from datasette.plugins import pm
+import asyncio
+import json
+import pathlib
+import pytest
+import shutil
+import sqlite3
+import time
+
+CONTAINER_PLUGINS = (
+    pathlib.Path(__file__).parent.parent / "datasette_publish_fly" / "container_plugins"
+)
+
+
+@pytest.fixture
+def plugins_dir(tmp_path):
+    "Returns function for copying container plugins into a Datasette plugins_dir"
+    directory = tmp_path / "plugins"
+    directory.mkdir()
+    names = []
+
+    def add(name):
+        filename = "datasette_publish_fly_{}.py".format(name)
+        shutil.copy(
+            str(CONTAINER_PLUGINS / "{}.py".format(name)), str(directory / filename)
+        )
+        names.append(filename)
+        return str(directory)
+
+    yield add
+    for name in names:
+        pm.unregister(name=name)
+
+
+@pytest.fixture
+def volume(tmp_path, monkeypatch):
+    directory = tmp_path / "data"
+    directory.mkdir()
+    monkeypatch.setenv("DATASETTE_PUBLISH_FLY_VOLUME", str(directory))
+    return directory
+
+
+def create_table(path, rows):
+    conn = sqlite3.connect(str(path))
+    with conn:
+        conn.execute("create table if not exists t (id integer primary key)")
+        conn.executemany("insert into t default values", [()] * rows)
+    conn.close()
+
+
+def wait_for(condition, timeout=5):
+    start = time.monotonic()
+    while not condition():
+        assert time.monotonic() - start < timeout, "Timed out"
+        time.sleep(0.01)
+
+
+def test_volume_inspect(plugins_dir, volume, monkeypatch):
+    monkeypatch.setenv("DATASETTE_PUBLISH_FLY_INSPECT_INTERVAL", "0.05")
+    create_table(volume / "one.db", 5)
+    cache_path = volume / ".datasette-inspect.json"
+
+    async def run():
+        datasette = Datasette(
+            [str(volume / "one.db")], plugins_dir=plugins_dir("volume_inspect")
+        )
+        await datasette.invoke_startup()
+        db = datasette.get_database("one")
+        wait_for(cache_path.exists)
+        assert json.loads(cache_path.read_text())["one.db"]["tables"] == {"t": 5}
+        # Counts come from the cache without running any SQL
+        execute = db.execute
+
+        async def no_counting(*args, **kwargs):
+            assert False, "Should not count"
+
+        db.execute = no_counting
+        assert await db.table_counts(limit=1) == {"t": 5}
+        db.execute = execute
+        # After a write the background thread recounts
+        create_table(volume / "one.db", 2)
+        wait_for(
+            lambda: json.loads(cache_path.read_text())["one.db"]["tables"] == {"t": 7}
+        )
+        assert await db.table_counts() == {"t": 7}
+        datasette._publish_fly_inspect_stop.set()
+
+    asyncio.run(run())
+
+
+@pytest.fixture
+def restore_database_execute():
+    from datasette.database import Database
+
+    original = Database.execute
+    yield
+    Database.execute = original
+
+
+def test_metrics(plugins_dir, tmp_path, restore_database_execute):
+    create_table(tmp_path / "one.db", 3)
+
+    async def run():
+        datasette = Datasette(
+            [str(tmp_path / "one.db")], plugins_dir=plugins_dir("metrics")
+        )
+        await datasette.invoke_startup()
+        assert (await datasette.client.get("/one/t.json")).status_code == 200
+        assert (await datasette.client.get("/one.json?sql=select+1")).status_code == 200
+        response = await datasette.client.get("/-/metrics")
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain")
+        return response.text
+
+    text = asyncio.run(run())
+    lines = text.split("\n")
+    assert "# TYPE datasette_request_duration_seconds histogram" in lines
+    assert 'datasette_request_duration_seconds_count{route="table"} 1' in lines
+    assert 'datasette_request_duration_seconds_count{route="query"} 1' in lines
+    assert any(
+        line.startswith('datasette_sql_duration_seconds_count{database="one"} ')
+        for line in lines
+    )
+    assert "datasette_sql_threads 3" in lines
+    assert "datasette_sql_queue_depth 0" in lines
+
+
+def test_metrics_and_slow_queries_instrument_once(restore_database_execute):
+    from datasette.database import Database
+    from datasette_publish_fly.container_plugins import metrics, slow_queries
+
+    # Startup runs again for each Datasette instance in the process
+    metrics.instrument_database_execute()
+    slow_queries.instrument_database_execute()
+    metrics.instrument_database_execute()
+    slow_queries.instrument_database_execute()
+    wrappers = []
+    execute = Database.execute
+    while execute is not None:
+        wrappers.append(execute)
+        execute = getattr(execute, "__wrapped__", None)
+    assert len(wrappers) == 3
+    assert sum(hasattr(w, "_publish_fly_metrics") for w in wrappers) == 1
+    assert sum(hasattr(w, "_publish_fly_slow_queries") for w in wrappers) == 1
+
+
+# Most the instrumentation may add to the time taken to serve a small
+# table page, documented in the README
+METRICS_OVERHEAD_BOUND = 0.1
+
+
+def test_metrics_overhead(plugins_dir, tmp_path, restore_database_execute):
+    from datasette.database import Database
+
+    create_table(tmp_path / "one.db", 3)
+    original_execute = Database.execute
+
+    async def run():
+        # Created first, so the plugin isn't registered for it
+        without = Datasette([str(tmp_path / "one.db")])
+        await without.invoke_startup()
+        with_metrics = Datasette(
+            [str(tmp_path / "one.db")], plugins_dir=plugins_dir("metrics")
+        )
+        await with_metrics.invoke_startup()
+        instrumented_execute = Database.execute
+
+        async def time_requests(datasette, execute, requests=50):
+            # Database.execute is instrumented for every instance
+            Database.execute = execute
+            start = time.perf_counter()
+            for _ in range(requests):
+                response = await datasette.client.get("/one/t.json?_size=10")
+                assert response.status_code == 200
+            return (time.perf_counter() - start) / requests
+
+        # Warm up, then take the best of rounds taken in turn, so a slow
+        # patch of the machine doesn't favour either
+        await time_requests(without, original_execute)
+        await time_requests(with_metrics, instrumented_execute)
+        baseline = instrumented = float("inf")
+        for _ in range(5):
+            baseline = min(baseline, await time_requests(without, original_execute))
+            instrumented = min(
+                instrumented, await time_requests(with_metrics, instrumented_execute)
+            )
+        return baseline, instrumented
+
+    baseline, instrumented = asyncio.run(run())
+    assert instrumented < baseline * (1 + METRICS_OVERHEAD_BOUND), (
+        "{:.0f}us per request with metrics, {:.0f}us without".format(
+            instrumented * 1000000, baseline * 1000000
+        )
+    )
+
+
+def test_slow_queries(plugins_dir, volume, monkeypatch, restore_database_execute):
+    # Threshold of 0 records every query
+    monkeypatch.setenv("DATASETTE_PUBLISH_FLY_SLOW_QUERY_MS", "0")
+    monkeypatch.setenv("DATASETTE_PUBLISH_FLY_SLOW_QUERY_BUFFER", "3")
+    create_table(volume / "one.db", 3)
+
+    async def run():
+        datasette = Datasette(
+            [str(volume / "one.db")], plugins_dir=plugins_dir("slow_queries")
+        )
+        await datasette.invoke_startup()
+        db = datasette.get_database("one")
+        for i in range(5):
+            await db.execute("select * from t where id > ?", [i])
+        response = await datasette.client.get("/-/slow-queries.json")
+        assert response.status_code == 200
+        return response.json()
+
+    data = asyncio.run(run())
+    assert data["threshold_ms"] == 0
+    # Only the most recent queries are kept, newest first
+    assert [query["params"] for query in data["queries"]] == [[4], [3], [2]]
+    query = data["queries"][0]
+    assert query["database"] == "one"
+    assert query["sql"] == "select * from t where id > ?"
+    assert query["duration_ms"] >= 0
+    assert "INTEGER PRIMARY KEY" in query["query_plan"][0]["detail"]
+    # All of them were also logged to the volume
+    lines = (volume / ".datasette-slow-queries.jsonl").read_text().splitlines()
+    assert [json.loads(line)["params"] for line in lines] == [[i] for i in range(5)]
+
+
+def test_slow_queries_threshold(
+    plugins_dir, tmp_path, monkeypatch, restore_database_execute
+):
+    monkeypatch.setenv("DATASETTE_PUBLISH_FLY_SLOW_QUERY_MS", "60000")
+    create_table(tmp_path / "one.db", 3)
+
+    async def run():
+        datasette = Datasette(
+            [str(tmp_path / "one.db")], plugins_dir=plugins_dir("slow_queries")
+        )
+        await datasette.invoke_startup()
+        await datasette.get_database("one").execute("select * from t")
+        return (await datasette.client.get("/-/slow-queries.json")).json()
+
+    assert asyncio.run(run())["queries"] == []
+
+
+def test_wal(plugins_dir, volume, tmp_path, monkeypatch):
+    monkeypatch.setenv("DATASETTE_PUBLISH_FLY_WAL_CHECKPOINT_INTERVAL", "0.05")
+    # Only the background thread checkpoints
+    monkeypatch.setenv("DATASETTE_PUBLISH_FLY_WAL_AUTOCHECKPOINT", "0")
+    create_table(volume / "one.db", 1)
+    create_table(tmp_path / "other.db", 1)
+
+    def journal_mode(path):
+        conn = sqlite3.connect(str(path))
+        try:
+            return conn.execute("pragma journal_mode").fetchone()[0]
+        finally:
+            conn.close()
+
+    def rows_in_main_file(path):
+        # immutable=1 ignores the -wal file
+        conn = sqlite3.connect("file:{}?immutable=1".format(path), uri=True)
+        try:
+            return conn.execute("select count(*) from t").fetchone()[0]
+        finally:
+            conn.close()
+
+    async def run():
+        datasette = Datasette(
+            [str(volume / "one.db"), str(tmp_path / "other.db")],
+            plugins_dir=plugins_dir("wal"),
+        )
+        await datasette.invoke_startup()
+        assert journal_mode(volume / "one.db") == "wal"
+        assert journal_mode(tmp_path / "other.db") == "delete"
+        db = datasette.get_database("one")
+
+        def settings(conn):
+            return [
+                conn.execute("pragma {}".format(name)).fetchone()[0]
+                for name in ("synchronous", "wal_autocheckpoint")
+            ]
+
+        # 1 is NORMAL
+        assert await db.execute_fn(settings) == [1, 0]
+        # 2 is FULL, the default
+        other = datasette.get_database("other")
+        assert await other.execute_fn(settings) == [2, 1000]
+        await db.execute_write("insert into t default values")
+        assert (volume / "one.db-wal").stat().st_size
+        wait_for(lambda: rows_in_main_file(volume / "one.db") == 2)
+        datasette._publish_fly_wal_stop.set()
+
+    asyncio.run(run())
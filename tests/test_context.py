@@ -0,0 +1,75 @@
+from click.testing import CliRunner
+from datasette import cli
+from datasette_publish_fly.context import context_sizes, is_ignored
+from unittest import mock
+import pytest
+
+from .test_publish_fly import FakeCompletedProcess
+
+
+@pytest.mark.parametrize(
+    "path,expected",
+    (
+        ("data.db", False),
+        ("data.db-wal", True),
+        ("plugins/__pycache__/foo.cpython-311.pyc", True),
+        ("static/.DS_Store", True),
+        ("static/.git/HEAD", True),
+        ("static/app.js", False),
+    ),
+)
+def test_is_ignored(path, expected):
+    assert is_ignored(path) is expected
+
+
+def test_context_sizes(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "data.db").write_bytes(b"x" * 1000)
+    (tmp_path / "Dockerfile").write_bytes(b"x" * 10)
+    (tmp_path / "assets").mkdir()
+    (tmp_path / "assets" / "app.js").write_bytes(b"x" * 20)
+    (tmp_path / "assets" / "video.mp4").write_bytes(b"x" * (11 * 1024 * 1024))
+    (tmp_path / "plugins").mkdir()
+    (tmp_path / "plugins" / "foo.py").write_bytes(b"x" * 30)
+    (tmp_path / "plugins" / "foo.pyc").write_bytes(b"x" * 40)
+    sizes, large_files = context_sizes(["assets"])
+    assert sizes == {
+        "databases": 1000,
+        "other": 10,
+        "static": 20 + 11 * 1024 * 1024,
+        "plugins": 30,
+    }
+    assert large_files == [("assets/video.mp4", 11 * 1024 * 1024)]
+
+
+@mock.patch("shutil.which")
+@mock.patch("datasette_publish_fly.publish.run")
+def test_publish_shows_context_report(mock_run, mock_which, tmp_path, monkeypatch):
+    mock_which.return_value = True
+    dockerignores = []
+
+    def run_side_effect(*args, **kwargs):
+        if args == (["flyctl", "auth", "token", "--json"],):
+            return FakeCompletedProcess(b'{"token": "TOKEN"}', b"")
+        elif args == (["flyctl", "apps", "list", "--json"],):
+            return FakeCompletedProcess(b'[{"Name": "app"}]', b"")
+        elif args == (["flyctl", "volumes", "list", "-a", "app", "--json"],):
+            return FakeCompletedProcess(b"[]", b"")
+        elif args[0][:2] == ["flyctl", "deploy"]:
+            dockerignores.append(open(".dockerignore").read())
+        return FakeCompletedProcess(b"", b"")
+
+    mock_run.side_effect = run_side_effect
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "test.db").write_bytes(b"x" * 2048)
+    (tmp_path / "static").mkdir()
+    (tmp_path / "static" / "dump.tar").write_bytes(b"x" * (11 * 1024 * 1024))
+    result = CliRunner().invoke(
+        cli.cli,
+        ["publish", "fly", "test.db", "-a", "app", "--region", "sjc"]
+        + ["--static", "assets:static"],
+    )
+    assert result.exit_code == 0, result.output
+    assert "Build context: static 11.0 MB, databases 2.0 KB, other" in result.output
+    assert "Warning: assets/dump.tar is 11.0 MB" in result.output
+    assert "**/__pycache__\n" in dockerignores[0]
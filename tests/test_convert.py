@@ -0,0 +1,271 @@
+from click.testing import CliRunner
+from datasette import cli
+from datasette_publish_fly.convert import convert_file, convert_files, infer_type
+import json
+import os
+import pytest
+import sqlite3
+import subprocess
+import sys
+import time
+
+# Rows for test_convert_benchmark, set this to millions for a real benchmark
+BENCHMARK_ROWS = int(os.environ.get("DATASETTE_PUBLISH_FLY_BENCHMARK_ROWS", 200000))
+# Peak memory of the whole conversion process, Python itself included
+BENCHMARK_MAX_RSS_MB = 100
+
+
+def rows(path, sql):
+    conn = sqlite3.connect(str(path))
+    try:
+        return conn.execute(sql).fetchall()
+    finally:
+        conn.close()
+
+
+@pytest.mark.parametrize(
+    "values,expected",
+    (
+        (["1", "-2", "", "30"], "INTEGER"),
+        (["1", "2.5", "1e3"], "REAL"),
+        # Identifiers, not numbers
+        (["02134", "10001"], "TEXT"),
+        (["9223372036854775808"], "REAL"),
+        (["1", "two"], "TEXT"),
+        ([1, 2, None], "INTEGER"),
+        ([1, 2.5], "REAL"),
+        ([], "TEXT"),
+    ),
+)
+def test_infer_type(values, expected):
+    assert infer_type(values) == expected
+
+
+def test_convert_csv(tmp_path):
+    csv_path = tmp_path / "places.csv"
+    csv_path.write_text(
+        "\ufeffid,zip,name,score\n1,02134,Boston,4.5\n2,10001,New York,\n3,94103\n",
+        "utf-8",
+    )
+    database_path = tmp_path / "places.db"
+    assert convert_file(str(csv_path), str(database_path)) == ("places", 3)
+    assert rows(database_path, "select * from places") == [
+        (1, "02134", "Boston", 4.5),
+        (2, "10001", "New York", None),
+        (3, "94103", None, None),
+    ]
+    assert [row[2] for row in rows(database_path, "pragma table_info(places)")] == [
+        "INTEGER",
+        "TEXT",
+        "TEXT",
+        "REAL",
+    ]
+    assert rows(database_path, "pragma journal_mode") == [("delete",)]
+
+
+def test_convert_value_that_does_not_match_sample(tmp_path, monkeypatch):
+    monkeypatch.setattr("datasette_publish_fly.convert.SAMPLE_SIZE", 2)
+    tsv_path = tmp_path / "counts.tsv"
+    tsv_path.write_text("n\n1\n2\nmany\n", "utf-8")
+    database_path = tmp_path / "counts.db"
+    convert_file(str(tsv_path), str(database_path))
+    assert rows(database_path, "select n from counts") == [(1,), (2,), ("many",)]
+
+
+def test_convert_ndjson_new_keys(tmp_path, monkeypatch):
+    monkeypatch.setattr("datasette_publish_fly.convert.SAMPLE_SIZE", 1)
+    monkeypatch.setattr("datasette_publish_fly.convert.BATCH_SIZE", 2)
+    ndjson_path = tmp_path / "events.ndjson"
+    ndjson_path.write_text(
+        "\n".join(
+            json.dumps(row)
+            for row in (
+                {"id": 1, "name": "one"},
+                {"id": 2, "tags": ["a", "b"]},
+                {"id": 3, "name": "three", "extra": True},
+            )
+        )
+        + "\n\n",
+        "utf-8",
+    )
+    database_path = tmp_path / "events.db"
+    assert convert_file(str(ndjson_path), str(database_path)) == ("events", 3)
+    assert rows(database_path, "select id, name, tags, extra from events") == [
+        (1, "one", None, None),
+        (2, None, '["a", "b"]', None),
+        (3, "three", None, 1),
+    ]
+
+
+def test_convert_indexes(tmp_path):
+    csv_path = tmp_path / "places.csv"
+    csv_path.write_text("id,name\n1,Boston\n", "utf-8")
+    database_path = tmp_path / "places.db"
+    convert_file(str(csv_path), str(database_path), ["name"])
+    assert rows(database_path, "select name from sqlite_master where type='index'") == [
+        ("idx_places_name",)
+    ]
+    # ANALYZE ran after the index was created
+    assert rows(database_path, "select idx from sqlite_stat1") == [("idx_places_name",)]
+
+
+def test_convert_files_parallel_and_cached(tmp_path, capsys):
+    paths = []
+    for name in ("one", "two", "three"):
+        path = tmp_path / "{}.csv".format(name)
+        path.write_text("id,name\n1,{}\n".format(name), "utf-8")
+        paths.append(str(path))
+    existing = tmp_path / "existing.db"
+    sqlite3.connect(str(existing)).execute("create table t (id integer)")
+    files = convert_files(paths + [str(existing)], ["two.name"])
+    assert [os.path.basename(path) for path in files] == [
+        "one.db",
+        "two.db",
+        "three.db",
+        "existing.db",
+    ]
+    assert files[3] == str(existing)
+    for path, name in zip(files, ("one", "two", "three")):
+        assert rows(path, "select name from {}".format(name)) == [(name,)]
+    assert rows(files[1], "select name from sqlite_master where type='index'") == [
+        ("idx_two_name",)
+    ]
+    assert capsys.readouterr().err.count("Converted ") == 3
+    # Unchanged files are not converted again
+    assert convert_files(paths) == files[:3]
+    err = capsys.readouterr().err
+    # ... unless the indexes changed
+    assert "Converted two.csv to two.db" in err
+    assert "Using previous conversion of one.csv" in err
+    time.sleep(0.01)
+    with open(paths[0], "a") as fp:
+        fp.write("2,uno\n")
+    convert_files(paths)
+    assert "Converted one.csv to one.db: 2 rows" in capsys.readouterr().err
+
+
+@pytest.mark.parametrize(
+    "files,indexes,expected",
+    (
+        (["places.csv", "places.tsv"], [], "same name: places"),
+        (["places.csv"], ["other.name"], "not being converted: other"),
+        (["places.csv"], ["places.missing"], "it has no column missing"),
+    ),
+)
+def test_convert_files_errors(tmp_path, files, indexes, expected):
+    runner = CliRunner()
+    with runner.isolated_filesystem(temp_dir=tmp_path):
+        for name in files:
+            with open(name, "w") as fp:
+                fp.write("id,name\n1,Boston\n")
+        result = runner.invoke(
+            cli.cli,
+            ["publish", "fly", "-a", "app", "--generate-dir", "out"]
+            + files
+            + [option for index in indexes for option in ("--index", index)],
+        )
+    assert result.exit_code == 1
+    assert expected in result.output
+
+
+@pytest.mark.parametrize(
+    "name,content,expected",
+    (
+        (
+            "bad.ndjson",
+            b'{"id": 1}\n\n{"id": 2\n',
+            "bad.ndjson line 3 is not valid JSON",
+        ),
+        (
+            "bad.ndjson",
+            b'{"id": 1}\n[1, 2]\n',
+            "bad.ndjson line 2 is not a JSON object",
+        ),
+        (
+            "bad.jsonl",
+            b'{"id": 1}\n{"name": "caf\xe9"}\n',
+            "bad.jsonl line 2 is not UTF-8 text",
+        ),
+        # Far enough in that it is decoded in a later block
+        (
+            "bad.csv",
+            b"id,name\n" + b"1,ok\n" * 5000 + b"2,caf\xe9\n",
+            "bad.csv line 5002 is not UTF-8 text",
+        ),
+    ),
+)
+def test_convert_invalid_files(tmp_path, name, content, expected):
+    runner = CliRunner()
+    with runner.isolated_filesystem(temp_dir=tmp_path):
+        with open(name, "wb") as fp:
+            fp.write(content)
+        result = runner.invoke(
+            cli.cli, ["publish", "fly", "-a", "app", "--generate-dir", "out", name]
+        )
+    assert result.exit_code == 1
+    assert "Error: {}".format(expected) in result.output
+
+
+def test_generate_directory_from_csv(tmp_path):
+    runner = CliRunner()
+    with runner.isolated_filesystem(temp_dir=tmp_path):
+        with open("places.csv", "w") as fp:
+            fp.write("id,name\n1,Boston\n")
+        result = runner.invoke(
+            cli.cli,
+            ["publish", "fly", "places.csv", "-a", "app", "--generate-dir", "out"]
+            + ["--index", "places.name"],
+            catch_exceptions=False,
+        )
+        assert result.exit_code == 0, result.output
+        assert rows("out/places.db", "select * from places") == [(1, "Boston")]
+        dockerfile = open("out/Dockerfile").read()
+        assert "-i places.db" in dockerfile
+        assert "places.csv" not in dockerfile
+
+
+BENCHMARK_SCRIPT = """
+import resource, sys, time
+from datasette_publish_fly.convert import convert_file
+start = time.perf_counter()
+table, count = convert_file(sys.argv[1], sys.argv[2], ["category"])
+duration = time.perf_counter() - start
+max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(count, duration, max_rss)
+"""
+
+
+def test_convert_benchmark(tmp_path):
+    # Run with -s to see the timings
+    pytest.importorskip("resource")
+    csv_path = tmp_path / "big.csv"
+    with open(csv_path, "w") as fp:
+        fp.write("id,category,value,description\n")
+        for i in range(BENCHMARK_ROWS):
+            fp.write(
+                "{},c{},{},row number {} of the benchmark\n".format(i, i % 50, i / 7, i)
+            )
+    # A separate process, so its peak memory is only the conversion's
+    output = subprocess.check_output(
+        [
+            sys.executable,
+            "-c",
+            BENCHMARK_SCRIPT,
+            str(csv_path),
+            str(tmp_path / "big.db"),
+        ]
+    )
+    count, duration, max_rss = output.split()
+    # ru_maxrss is in kilobytes on Linux but bytes on macOS
+    max_rss_mb = int(max_rss) / (1024 * 1024 if sys.platform == "darwin" else 1024)
+    print(
+        "\nConverted {:,} rows ({:.0f}MB) in {:.1f}s, {:,.0f} rows/s, peak RSS {:.0f}MB".format(
+            int(count),
+            csv_path.stat().st_size / 1024 / 1024,
+            float(duration),
+            int(count) / float(duration),
+            max_rss_mb,
+        )
+    )
+    assert int(count) == BENCHMARK_ROWS
+    assert max_rss_mb < BENCHMARK_MAX_RSS_MB
@@ -0,0 +1,50 @@
+# The plugin module is imported by every "datasette" command, including
+# "datasette serve" inside deployed containers, so it needs to stay cheap
+import subprocess
+import sys
+
+# Total self time in microseconds for datasette_publish_fly modules
+IMPORT_BUDGET_US = 10000
+
+LAZY_MODULES = (
+    "datasette_publish_fly.publish",
+    "datasette_publish_fly.regions",
+    "datasette_publish_fly.volume_upload",
+    "httpx",
+)
+
+
+def import_times():
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import datasette_publish_fly"],
+        stderr=subprocess.PIPE,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.decode("utf-8").splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        self_us, _, module = line[len("import time:") :].split("|")
+        times[module.strip()] = int(self_us)
+    return times
+
+
+def test_heavy_modules_are_imported_lazily():
+    times = import_times()
+    assert "datasette_publish_fly" in times
+    for module in LAZY_MODULES:
+        assert module not in times
+
+
+def test_import_time_budget():
+    # Best of three to smooth out noise on busy CI machines
+    own_time = min(
+        sum(
+            self_us
+            for module, self_us in import_times().items()
+            if module.startswith("datasette_publish_fly")
+        )
+        for _ in range(3)
+    )
+    assert own_time < IMPORT_BUDGET_US
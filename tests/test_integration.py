@@ -6,8 +6,10 @@ import httpx
 import json
 import pytest
 import secrets
+import shutil
 import sqlite3
 import subprocess
+import time
 
 # Mark all tests in this module with "integration":
 pytestmark = pytest.mark.integration
@@ -97,6 +99,41 @@ def test_with_volume():
     assert "FOO_BAR" in app_secrets
 
 
+@pytest.mark.skipif(not shutil.which("docker"), reason="requires docker")
+def test_build_benchmark(tmp_path):
+    # Run with -s to see the timings
+    runner = CliRunner()
+    app_name = APP_PREFIX + "b-" + secrets.token_hex(4)
+    build_cache = str(tmp_path / "build-cache")
+    local = ["--build", "local", "--build-cache", build_cache]
+    timings = []
+    with runner.isolated_filesystem():
+        for label, options in (
+            ("remote", []),
+            ("local, cold cache", local),
+            ("local, warm cache", local),
+        ):
+            # New data each time, as it would be for a real republish
+            conn = sqlite3.connect("test.db")
+            conn.execute("create table if not exists foo (id integer primary key)")
+            conn.execute("insert into foo default values")
+            conn.commit()
+            conn.close()
+            start = time.perf_counter()
+            result = runner.invoke(
+                cli.cli,
+                ["publish", "fly", "test.db", "-a", app_name]
+                + ["--install", "datasette-graphql", "--secret", "benchmark"]
+                + options,
+                catch_exceptions=False,
+            )
+            assert result.exit_code == 0, result.output
+            timings.append((label, time.perf_counter() - start))
+    for label, duration in timings:
+        print("{:<20} {:.1f}s".format(label, duration))
+    assert timings[2][1] < timings[1][1]
+
+
 def cleanup_any_resources():
     app_names = [app["Name"] for app in get_apps()]
     # Delete any starting with publish-fly-temp-
@@ -131,3 +168,4 @@ def get_secrets(app_name):
         stderr=subprocess.PIPE,
     )
     return process.stdout.decode("utf-8")
+
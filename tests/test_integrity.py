@@ -0,0 +1,68 @@
+from click.testing import CliRunner
+from datasette import cli
+from datasette_publish_fly.integrity import scan_database
+from unittest import mock
+import sqlite3
+
+
+def create_database(path):
+    conn = sqlite3.connect(str(path))
+    with conn:
+        conn.execute("create table t (id integer primary key, body text)")
+        conn.executemany(
+            "insert into t (body) values (?)", [("x" * 1000,) for _ in range(500)]
+        )
+    conn.close()
+
+
+def test_scan_database(tmp_path):
+    path = tmp_path / "one.db"
+    create_database(path)
+    result = scan_database(str(path))
+    assert result["errors"] == []
+    assert result["warnings"] == []
+    assert result["tables"] == {"t": 500}
+    assert result["page_count"] > 100
+    assert result["freelist_count"] == 0
+
+
+def test_scan_database_freelist_and_stats(tmp_path):
+    path = tmp_path / "one.db"
+    create_database(path)
+    conn = sqlite3.connect(str(path))
+    with conn:
+        conn.execute("create index idx_body on t(body)")
+        conn.execute("delete from t where id <= 400")
+    conn.execute("analyze")
+    conn.close()
+    result = scan_database(str(path), full=True)
+    assert result["errors"] == []
+    # From sqlite_stat1, not max(rowid)
+    assert result["tables"]["t"] == 100
+    assert "run VACUUM to shrink it" in result["warnings"][0]
+
+
+def test_scan_not_a_database(tmp_path):
+    path = tmp_path / "bad.db"
+    path.write_bytes(b"This is not a database" * 100)
+    result = scan_database(str(path))
+    assert result["errors"] == ["file is not a database"]
+
+
+@mock.patch("datasette_publish_fly.publish.run")
+def test_check_databases_fails_before_network_calls(mock_run, tmp_path):
+    good = tmp_path / "good.db"
+    create_database(good)
+    bad = tmp_path / "bad.db"
+    bad.write_bytes(b"This is not a database" * 100)
+    result = CliRunner().invoke(
+        cli.cli,
+        ["publish", "fly", str(good), str(bad), "-a", "app"]
+        + ["--check-databases", "quick"],
+    )
+    assert result.exit_code == 1
+    assert "good.db: " in result.output
+    assert "500 rows" in result.output
+    assert "Error: file is not a database" in result.output
+    assert "Database check failed, nothing was published" in result.output
+    assert not mock_run.called
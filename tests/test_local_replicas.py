@@ -0,0 +1,133 @@
+from datasette_publish_fly import local_replicas
+import http.client
+import itertools
+import json
+import socket
+import sqlite3
+import subprocess
+import sys
+import time
+import urllib.parse
+
+
+def create_database(path):
+    conn = sqlite3.connect(str(path))
+    with conn:
+        conn.execute("create table t (id integer primary key, name text)")
+        conn.execute("insert into t (name) values ('one')")
+    conn.close()
+
+
+def test_replicate(tmp_path):
+    primary = tmp_path / "primary.db"
+    replica = tmp_path / "replica.db"
+    create_database(primary)
+    assert local_replicas.replicate(str(primary), str(replica)) > 0
+    conn = sqlite3.connect(str(primary))
+    with conn:
+        conn.execute("insert into t (name) values ('two')")
+    conn.close()
+    # The replica is open while it is updated, as it would be in Datasette
+    reader = sqlite3.connect(str(replica))
+    assert reader.execute("select count(*) from t").fetchone()[0] == 1
+    assert local_replicas.replicate(str(primary), str(replica)) == 1
+    assert reader.execute("select name from t order by id").fetchall() == [
+        ("one",),
+        ("two",),
+    ]
+    assert local_replicas.replicate(str(primary), str(replica)) == 0
+    assert not (tmp_path / ".replica.db.sync").exists()
+
+
+def test_upstream_for():
+    replicas = itertools.cycle(["replica-1", "replica-2"])
+    assert [
+        local_replicas.upstream_for(method, replicas)
+        for method in ("GET", "POST", "GET", "HEAD", "DELETE", "GET")
+    ] == ["replica-1", "primary", "replica-2", "replica-1", "primary", "replica-2"]
+
+
+def request(port, method, path, body=None, headers=None):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    try:
+        conn.request(method, path, body=body, headers=headers or {})
+        response = conn.getresponse()
+        return response, response.read()
+    finally:
+        conn.close()
+
+
+def wait_for(condition, timeout=30):
+    start = time.monotonic()
+    while True:
+        try:
+            result = condition()
+        except OSError:
+            result = None
+        if result:
+            return result
+        assert time.monotonic() - start < timeout, "Timed out"
+        time.sleep(0.1)
+
+
+def test_local_replicas_routes_writes_to_primary(tmp_path):
+    create_database(tmp_path / "writes.db")
+    (tmp_path / "metadata.json").write_text(
+        json.dumps(
+            {
+                "databases": {
+                    "writes": {
+                        "queries": {
+                            "add": {
+                                "sql": "insert into t (name) values (:name)",
+                                "write": True,
+                            }
+                        }
+                    }
+                }
+            }
+        )
+    )
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    process = subprocess.Popen(
+        [sys.executable, "-m", "datasette_publish_fly.local_replicas"]
+        + [str(tmp_path / "writes.db"), "--replicas", "2", "--port", str(port)]
+        + ["--metadata", str(tmp_path / "metadata.json"), "--interval", "0.1"]
+        + ["--directory", str(tmp_path / "cluster")]
+    )
+    try:
+        wait_for(lambda: request(port, "GET", "/-/versions.json")[0].status == 200)
+        served_by = {
+            request(port, "GET", "/writes/t.json")[0].getheader("x-datasette-replica")
+            for _ in range(4)
+        }
+        assert served_by == {"replica-1", "replica-2"}
+
+        response, _ = request(
+            port,
+            "POST",
+            "/writes/add",
+            body=urllib.parse.urlencode({"name": "two"}),
+            headers={"content-type": "application/x-www-form-urlencoded"},
+        )
+        assert response.getheader("x-datasette-replica") == "primary"
+        assert response.status == 302
+
+        def names_on_every_replica():
+            results = set()
+            for _ in range(2):
+                response, body = request(
+                    port, "GET", "/writes/t.json?_shape=array&_col=name"
+                )
+                results.add(tuple(row["name"] for row in json.loads(body)))
+            return results == {("one", "two")}
+
+        wait_for(names_on_every_replica)
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+    # Every Datasette process was shut down with the proxy
+    for directory in ("primary", "replica-1", "replica-2"):
+        assert (tmp_path / "cluster" / directory / "writes.db").exists()
@@ -0,0 +1,99 @@
+from datasette_publish_fly import sqlite_pages
+from datasette_publish_fly.page_sync import sync_database
+import pytest
+import shlex
+import sqlite3
+import subprocess
+import sys
+
+
+def create_database(path, rows=2000):
+    conn = sqlite3.connect(str(path))
+    conn.execute("create table t (id integer primary key, body text)")
+    with conn:
+        conn.executemany(
+            "insert into t (body) values (?)",
+            [("row {} ".format(i) * 10,) for i in range(rows)],
+        )
+    conn.close()
+
+
+def update_row(path, id):
+    conn = sqlite3.connect(str(path))
+    with conn:
+        conn.execute("update t set body = 'changed' where id = ?", [id])
+    conn.close()
+
+
+def test_delta_round_trip(tmp_path):
+    local = tmp_path / "local.db"
+    create_database(local)
+    remote = tmp_path / "remote.db"
+    remote.write_bytes(local.read_bytes())
+    update_row(local, 5)
+    delta, changed, page_count = sqlite_pages.make_delta(
+        str(local), sqlite_pages.page_hashes(str(remote))
+    )
+    # Header page plus the page holding row 5
+    assert changed == 2
+    assert page_count > 40
+    assert len(delta) < local.stat().st_size / 10
+    sqlite_pages.apply_delta(str(remote), delta)
+    assert remote.read_bytes() == local.read_bytes()
+
+
+def test_delta_against_missing_remote(tmp_path):
+    local = tmp_path / "local.db"
+    create_database(local, rows=10)
+    remote = tmp_path / "remote.db"
+    delta, changed, page_count = sqlite_pages.make_delta(
+        str(local), sqlite_pages.page_hashes(str(remote))
+    )
+    assert changed == page_count
+    sqlite_pages.apply_delta(str(remote), delta)
+    assert remote.read_bytes() == local.read_bytes()
+
+
+@pytest.fixture
+def remote_data(tmp_path, mocker):
+    "Runs 'flyctl ssh console' commands locally with /data pointing at a directory"
+    data = tmp_path / "data"
+    data.mkdir()
+
+    def fake_run(args, input=None, stdout=None, stderr=None):
+        command = shlex.split(args[6])[2]
+        command = command.replace("/tmp/", str(tmp_path) + "/").replace(
+            " /data/", " " + str(data) + "/"
+        )
+        command = command.replace("python3 ", shlex.quote(sys.executable) + " ")
+        return subprocess.run(
+            ["sh", "-c", command], input=input, stdout=stdout, stderr=stderr
+        )
+
+    mocker.patch("datasette_publish_fly.volume_upload.run", side_effect=fake_run)
+    return data
+
+
+def test_sync_database(remote_data, tmp_path):
+    local = tmp_path / "reference.db"
+    create_database(local)
+    # First sync sends everything
+    result = sync_database("app", str(local))
+    assert result["created"]
+    assert result["changed_pages"] > 40
+    assert result["sent"] < result["full_size"]
+    conn = sqlite3.connect(str(remote_data / "reference.db"))
+    assert conn.execute("select count(*) from t").fetchone()[0] == 2000
+    # Second sync only sends the changed pages
+    update_row(local, 1000)
+    result = sync_database("app", str(local))
+    assert not result["created"]
+    assert result["changed_pages"] <= 2
+    assert result["sent"] < result["full_size"] / 50
+    assert conn.execute("select body from t where id = 1000").fetchone()[0] == (
+        "changed"
+    )
+    # Nothing changed, nothing sent and nothing left behind
+    result = sync_database("app", str(local))
+    assert result["sent"] == 0
+    assert sorted(p.name for p in remote_data.iterdir()) == ["reference.db"]
@@ -0,0 +1,229 @@
+from click.testing import CliRunner
+from datasette import cli
+from datasette_publish_fly import plan
+from datasette_publish_fly.plan import cached_layers, layer_keys, record_layers
+from datasette_publish_fly.state import PublishState, estimate_seconds, record_timing
+from unittest import mock
+from .test_publish_fly import FakeCompletedProcess
+import json
+import os
+import pytest
+import shutil
+
+
+def test_estimate_seconds():
+    assert estimate_seconds("deploy") is None
+    record_timing("preflight", 4)
+    record_timing("preflight", 2)
+    record_timing("preflight", 30)
+    assert estimate_seconds("preflight") == 4
+    # Only one size so far, so there is nothing to fit a line through
+    record_timing("deploy", 20, 1000)
+    assert estimate_seconds("deploy", 5000) == 20
+    record_timing("deploy", 40, 3000)
+    assert estimate_seconds("deploy", 5000) == pytest.approx(60)
+    assert estimate_seconds("deploy") == 30
+
+
+def test_layer_keys(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "Dockerfile").write_text(
+        "\n".join(
+            [
+                "FROM python:3.11.0-slim-bullseye",
+                'COPY --link ["one.db", "/app/one.db"]',
+                "COPY . /app",
+                "WORKDIR /app",
+                "RUN pip install -U datasette \\",
+                "    datasette-cluster-map",
+                'CMD datasette serve --host 0.0.0.0 one.db two.db --port "$PORT"',
+            ]
+        ),
+        "utf-8",
+    )
+    (tmp_path / "one.db").write_bytes(b"one")
+    (tmp_path / "two.db").write_bytes(b"two")
+    layers = layer_keys()
+    assert [(layer["step"], layer["bytes"]) for layer in layers] == [
+        ('COPY --link ["one.db", "/app/one.db"]', 3),
+        ("COPY . /app", 3 + 3 + len((tmp_path / "Dockerfile").read_bytes())),
+        ("RUN pip install -U datasette \\", 0),
+    ]
+    record_layers("app", layers)
+    assert [cached for _, cached in cached_layers("app", layer_keys())] == [
+        True,
+        True,
+        True,
+    ]
+    assert not any(cached for _, cached in cached_layers("other", layers))
+
+    # Every layer after a change is rebuilt, apart from COPY --link ones
+    (tmp_path / "two.db").write_bytes(b"two, updated")
+    assert [cached for _, cached in cached_layers("app", layer_keys())] == [
+        True,
+        False,
+        False,
+    ]
+
+
+def test_layer_keys_copy_from_stage(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "Dockerfile").write_text(
+        "\n".join(
+            [
+                "FROM debian:bullseye-slim AS decompress",
+                "WORKDIR /decompress",
+                'COPY ["one.db.gz", "./"]',
+                "RUN gunzip one.db.gz",
+                "",
+                "FROM python:3.11.0-slim-bullseye",
+                'COPY --link ["metadata.json", "/app/metadata.json"]',
+                "WORKDIR /app",
+                "COPY --from=decompress /decompress/ /app/",
+                "RUN datasette inspect one.db --inspect-file inspect-data.json",
+            ]
+        ),
+        "utf-8",
+    )
+    (tmp_path / "one.db.gz").write_bytes(b"one")
+    (tmp_path / "metadata.json").write_text("{}")
+    layers = layer_keys()
+    assert [(layer["step"], layer["bytes"]) for layer in layers] == [
+        ('COPY ["one.db.gz", "./"]', 3),
+        ("RUN gunzip one.db.gz", 0),
+        ('COPY --link ["metadata.json", "/app/metadata.json"]', 2),
+        ("COPY --from=decompress /decompress/ /app/", 0),
+        ("RUN datasette inspect one.db --inspect-file inspect-data.json", 0),
+    ]
+    record_layers("app", layers)
+    # What the final stage copies from the decompress stage has changed
+    (tmp_path / "one.db.gz").write_bytes(b"one, updated")
+    assert [cached for _, cached in cached_layers("app", layer_keys())] == [
+        False,
+        False,
+        True,
+        False,
+        False,
+    ]
+
+
+def test_context_digests_keyed_on_source(tmp_path, monkeypatch):
+    source = tmp_path / "source"
+    source.mkdir()
+    (source / "big.db").write_bytes(b"x" * 10)
+    context = tmp_path / "context"
+    context.mkdir()
+    monkeypatch.chdir(context)
+    hashed = []
+
+    def file_sha256(path):
+        hashed.append(path)
+        return "digest of " + path
+
+    monkeypatch.setattr(plan, "file_sha256", file_sha256)
+    keys = plan.source_keys([str(source / "big.db")])
+    for _ in range(2):
+        # A fresh copy each time, like each publish's build context
+        shutil.copy(str(source / "big.db"), "big.db")
+        assert plan.context_digests(keys) == {"big.db": ("digest of big.db", 10)}
+    assert hashed == ["big.db"]
+
+
+def test_derived_keys(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    keys = {"big.db": "1:2:3:4", "small.db": "5:6:7:8"}
+    assert plan.derived_keys(keys, "gzip") == {
+        "big.db.gz": "1:2:3:4:gzip",
+        "small.db.gz": "5:6:7:8:gzip",
+    }
+    os.mkdir("chunks")
+    for name in ("big.db.000", "big.db.001", "manifest.json", "assemble.py"):
+        (tmp_path / "chunks" / name).write_text("")
+    assert plan.derived_keys(keys, chunked=["big.db"], chunk_size=500) == {
+        os.path.join("chunks", "big.db.000"): "1:2:3:4:500:big.db.000",
+        os.path.join("chunks", "big.db.001"): "1:2:3:4:500:big.db.001",
+        "small.db": "5:6:7:8",
+    }
+
+
+def test_record_untimed_phase(cache_dir):
+    state = PublishState("app", "key", resume=False)
+    state.record("preflight", ["sjc", None], timed=False)
+    state.record("secrets")
+    assert state.get("preflight") == ["sjc", None]
+    assert estimate_seconds("preflight") is None
+    assert estimate_seconds("secrets") is not None
+
+
+def plan_run_side_effect(*args, **kwargs):
+    if args == (["flyctl", "auth", "token", "--json"],):
+        return FakeCompletedProcess(b'{"token": "TOKEN"}', b"")
+    elif args == (["flyctl", "apps", "list", "--json"],):
+        return FakeCompletedProcess(b'[{"Name": "app"}]', b"")
+    elif args == (["flyctl", "volumes", "list", "-a", "app", "--json"],):
+        return FakeCompletedProcess(b'[{"Name": "datasette"}]', b"")
+    elif args == (["flyctl", "secrets", "list", "-a", "app", "--json"],):
+        return FakeCompletedProcess(b"[]", b"")
+    return FakeCompletedProcess(b"", b"")
+
+
+@mock.patch("shutil.which")
+@mock.patch("datasette_publish_fly.publish.run")
+def test_publish_fly_plan(mock_run, mock_which, tmp_path, cache_dir):
+    mock_which.return_value = True
+    mock_run.side_effect = plan_run_side_effect
+    database = tmp_path / "test.db"
+    database.write_text("data", "utf-8")
+    command = ["publish", "fly", str(database), "-a", "app", "--region", "sjc"]
+    command += ["--vm-memory", "512", "--plugin-secret", "a", "b", "c"]
+    # Otherwise a new random secret would change the Dockerfile every time
+    command += ["--secret", "not-random"]
+
+    result = CliRunner().invoke(cli.cli, command)
+    assert result.exit_code == 0, result.output
+    timings = json.loads((cache_dir / "timings.json").read_text())
+    assert list(timings) == ["preflight", "secrets", "deploy", "memory"]
+    assert timings["deploy"][0]["bytes"] > 0
+
+    mock_run.reset_mock()
+    result = CliRunner().invoke(cli.cli, command + ["--plan"])
+    assert result.exit_code == 0, result.output
+    # Only reads
+    assert [call[0][0][:3] for call in mock_run.call_args_list] == [
+        ["flyctl", "auth", "token"],
+        ["flyctl", "apps", "list"],
+        ["flyctl", "volumes", "list"],
+        ["flyctl", "secrets", "list"],
+    ]
+    output = result.output
+    assert 'Plan for publishing "app" - nothing has been changed' in output
+    assert "preflight (about 0s)\n  Use existing app app\n" in output
+    assert "  Mount existing volume datasette\n" in output
+    assert "secrets (about 0s)\n  Stage A_B\n" in output
+    assert "  Build on Fly's remote builder\n" in output
+    assert "  Layers: 3 of 3 expected to be cached\n" in output
+    assert "    cached COPY . /app (" in output
+    assert "memory (about 0s)\n  Set memory to 512MB\n" in output
+    assert "Estimated duration: 0s\n" in output
+    # The plan didn't record anything for --resume either
+    assert json.loads((cache_dir / "publish-state.json").read_text()) == {}
+
+    # Changing the data rebuilds COPY . /app and every layer after it
+    database.write_text("new data", "utf-8")
+    result = CliRunner().invoke(cli.cli, command + ["--plan"])
+    assert "  Layers: 0 of 3 expected to be cached\n" in result.output
+    assert "    build  COPY . /app (" in result.output
+
+
+@pytest.mark.parametrize("option", ("--generate-dir", "--resume", "--watch"))
+def test_plan_errors(tmp_path, option):
+    runner = CliRunner()
+    with runner.isolated_filesystem(temp_dir=tmp_path):
+        open("test.db", "w").write("data")
+        result = runner.invoke(
+            cli.cli,
+            ["publish", "fly", "test.db", "-a", "app", "--plan", option]
+            + (["out"] if option == "--generate-dir" else []),
+        )
+    assert result.exit_code == 1
+    assert "--plan cannot be used with {}".format(option) in result.output
@@ -1,10 +1,17 @@
 from click.testing import CliRunner
 from datasette import cli
+from datasette_publish_fly import watch
+from datasette_publish_fly.runner import RETRIES
+import gzip
+import hashlib
 import json
+import os
 from unittest import mock
 from subprocess import PIPE
+import click
 import pathlib
 import pytest
+import threading
 
 
 class FakeCompletedProcess:
@@ -16,7 +23,7 @@ class FakeCompletedProcess:
 
 @pytest.fixture
 def mock_graphql_region(mocker):
-    m = mocker.patch("datasette_publish_fly.httpx")
+    m = mocker.patch("datasette_publish_fly.publish.httpx")
     m.post.return_value = mocker.Mock()
     m.post.return_value.status_code = 200
     m.post.return_value.json.return_value = {"data": {"nearestRegion": {"code": "sjc"}}}
@@ -34,7 +41,7 @@ def test_publish_fly_requires_flyctl(mock_which):
 
 
 @mock.patch("shutil.which")
-@mock.patch("datasette_publish_fly.run")
+@mock.patch("datasette_publish_fly.publish.run")
 def test_publish_fly_app_name_not_available(mock_run, mock_which, mock_graphql_region):
     mock_which.return_value = True
     runner = CliRunner()
@@ -83,7 +90,7 @@ def test_publish_fly_app_name_not_available(mock_run, mock_which, mock_graphql_r
 
 
 @mock.patch("shutil.which")
-@mock.patch("datasette_publish_fly.run")
+@mock.patch("datasette_publish_fly.publish.run")
 @pytest.mark.parametrize(
     "extra_options,expected_create_args",
     (
@@ -155,7 +162,7 @@ def test_publish_fly(
 
 
 @mock.patch("shutil.which")
-@mock.patch("datasette_publish_fly.run")
+@mock.patch("datasette_publish_fly.publish.run")
 @pytest.mark.parametrize(
     "app_name,opts,expected_cmd,expected_mount,expected_files",
     (
@@ -230,7 +237,7 @@ def test_generate_directory(
     mock_which.return_value = True
 
     expected_files = expected_files or []
-    expected_files += ["fly.toml", "Dockerfile"]
+    expected_files += ["fly.toml", "Dockerfile", ".dockerignore"]
 
     input_directory = tmp_path_factory.mktemp("input")
     output_directory = tmp_path_factory.mktemp("output")
@@ -330,7 +337,7 @@ def test_publish_fly_create_db_no_spaces(mock_which):
 
 
 @mock.patch("shutil.which")
-@mock.patch("datasette_publish_fly.run")
+@mock.patch("datasette_publish_fly.publish.run")
 def test_publish_fly_create_plugin_secret(mock_run, mock_which):
     mock_which.return_value = True
 
@@ -354,11 +361,14 @@ def test_publish_fly_create_plugin_secret(mock_run, mock_which):
             return FakeCompletedProcess(b"[]", b"")
         elif args == (["flyctl", "auth", "token", "--json"],):
             return FakeCompletedProcess(b'{"token": "TOKEN"}', b"")
+        elif args == (["flyctl", "secrets", "list", "-a", "app", "--json"],):
+            return FakeCompletedProcess(b"[]", b"")
         elif args == (
             [
                 "flyctl",
                 "secrets",
                 "set",
+                "--stage",
                 "DATASETTE_AUTH_PASSWORDS_ROOT_PASSWORD_HASH=root",
                 "-a",
                 "app",
@@ -424,11 +434,15 @@ def test_publish_fly_create_plugin_secret(mock_run, mock_which):
         mock.call(
             ["flyctl", "volumes", "list", "-a", "app", "--json"], stdout=-1, stderr=-1
         ),
+        mock.call(
+            ["flyctl", "secrets", "list", "-a", "app", "--json"], stdout=-1, stderr=-1
+        ),
         mock.call(
             [
                 "flyctl",
                 "secrets",
                 "set",
+                "--stage",
                 "DATASETTE_AUTH_PASSWORDS_ROOT_PASSWORD_HASH=root",
                 "-a",
                 "app",
@@ -452,7 +466,7 @@ def test_publish_fly_create_plugin_secret(mock_run, mock_which):
 
 
 @mock.patch("shutil.which")
-@mock.patch("datasette_publish_fly.run")
+@mock.patch("datasette_publish_fly.publish.run")
 @pytest.mark.parametrize("volume_exists", (False, True))
 def test_publish_fly_create_volume_ignored_if_volume_exists(
     mock_run, mock_which, volume_exists
@@ -584,6 +598,8 @@ def test_publish_fly_create_volume_ignored_if_volume_exists(
                 ],
                 stderr=-1,
                 stdout=-1,
+                retries=RETRIES,
+                retry_if=mock.ANY,
             )
         )
     expected.extend(
@@ -603,3 +619,978 @@ def test_publish_fly_create_volume_ignored_if_volume_exists(
         ]
     )
     assert mock_run.call_args_list == expected
+
+
+@pytest.mark.parametrize(
+    "method,extension,expected_step",
+    (
+        ("gzip", ".gz", "RUN gunzip database.db.gz"),
+        ("zstd", ".zst", "RUN zstd -d --rm -q database.db.zst"),
+    ),
+)
+def test_generate_directory_compress(tmp_path, method, extension, expected_step):
+    if method == "zstd":
+        zstandard = pytest.importorskip("zstandard")
+    database = tmp_path / "database.db"
+    database.write_bytes(b"SQLite format 3\x00" + b"\x00" * 100000)
+    output_directory = tmp_path / "output"
+    runner = CliRunner()
+    result = runner.invoke(
+        cli.cli,
+        ["publish", "fly", str(database), "-a", "app", "--compress", method]
+        + ["--generate-dir", str(output_directory)],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0, result.output
+    assert "Compressed database.db with {}".format(method) in result.output
+    assert {p.name for p in output_directory.iterdir()} == {
+        "database.db" + extension,
+        "Dockerfile",
+        "fly.toml",
+        ".dockerignore",
+    }
+    compressed = (output_directory / ("database.db" + extension)).read_bytes()
+    assert len(compressed) < 1000
+    if method == "gzip":
+        assert gzip.decompress(compressed) == database.read_bytes()
+    else:
+        decompressed = (
+            zstandard.ZstdDecompressor().decompressobj().decompress(compressed)
+        )
+        assert decompressed == database.read_bytes()
+    lines = (output_directory / "Dockerfile").read_text("utf-8").split("\n")
+    # Decompressed in a stage of its own, so the compressed copy isn't in
+    # the image
+    stage = lines[: lines.index("")]
+    assert stage[0] == "FROM debian:bullseye-slim AS decompress"
+    assert stage[-2:] == [
+        'COPY ["database.db{}", "./"]'.format(extension),
+        expected_step,
+    ]
+    if method == "zstd":
+        assert "apt-get install -y --no-install-recommends zstd &&" in stage[2]
+    assert "COPY . /app" not in lines
+    assert not any(
+        "database.db" in line for line in lines if line.startswith("COPY --link")
+    )
+    # Before the "datasette inspect" step needs it
+    assert lines[lines.index("WORKDIR /app") + 1] == (
+        "COPY --from=decompress /decompress/ /app/"
+    )
+
+
+def pipeline_run_side_effect(*args, **kwargs):
+    if args == (["flyctl", "auth", "token", "--json"],):
+        return FakeCompletedProcess(b'{"token": "TOKEN"}', b"")
+    elif args == (["flyctl", "apps", "list", "--json"],):
+        return FakeCompletedProcess(b"[]", b"")
+    elif args == (["flyctl", "volumes", "list", "-a", "app", "--json"],):
+        return FakeCompletedProcess(b"[]", b"")
+    elif args[0][:3] == ["flyctl", "apps", "create"]:
+        return FakeCompletedProcess(b"", b"That app name is not available", 1)
+    return FakeCompletedProcess(b"", b"")
+
+
+@mock.patch("shutil.which")
+@mock.patch("datasette_publish_fly.publish.run")
+def test_publish_fly_pipeline(mock_run, mock_which, mocker, tmp_path):
+    mock_which.return_value = True
+    mock_run.side_effect = lambda *args, **kwargs: (
+        FakeCompletedProcess(b"", b"")
+        if args[0][:3] == ["flyctl", "apps", "create"]
+        else pipeline_run_side_effect(*args, **kwargs)
+    )
+    database = tmp_path / "test.db"
+    database.write_text("data", "utf-8")
+    result = CliRunner().invoke(
+        cli.cli,
+        ["publish", "fly", str(database), "-a", "app", "--region", "sjc"]
+        + ["--create-volume", "1", "--create-db", "writes", "--pipeline"],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0, result.output
+    commands = [call[0][0][:3] for call in mock_run.call_args_list]
+    assert commands == [
+        ["flyctl", "auth", "token"],
+        ["flyctl", "apps", "list"],
+        ["flyctl", "apps", "create"],
+        ["flyctl", "volumes", "list"],
+        ["flyctl", "volumes", "create"],
+        ["flyctl", "deploy", "."],
+    ]
+
+
+@pytest.mark.parametrize("created", (False, True))
+@mock.patch("shutil.which")
+@mock.patch("datasette_publish_fly.publish.run")
+def test_publish_fly_volume_created_despite_error(
+    mock_run, mock_which, tmp_path, created
+):
+    mock_which.return_value = True
+    volumes = []
+
+    def run_side_effect(*args, **kwargs):
+        if args[0][:3] == ["flyctl", "volumes", "list"]:
+            return FakeCompletedProcess(json.dumps(volumes).encode("utf-8"), b"")
+        elif args[0][:3] == ["flyctl", "volumes", "create"]:
+            if created:
+                volumes.append({"Name": "datasette"})
+            return FakeCompletedProcess(b"", b"Error: 503 Service Unavailable", 1)
+        elif args[0][:3] == ["flyctl", "apps", "create"]:
+            return FakeCompletedProcess(b"", b"")
+        return pipeline_run_side_effect(*args, **kwargs)
+
+    mock_run.side_effect = run_side_effect
+    database = tmp_path / "test.db"
+    database.write_text("data", "utf-8")
+    result = CliRunner().invoke(
+        cli.cli,
+        ["publish", "fly", str(database), "-a", "app", "--region", "sjc"]
+        + ["--create-volume", "1"],
+    )
+    create_calls = [
+        call
+        for call in mock_run.call_args_list
+        if call[0][0][:3] == ["flyctl", "volumes", "create"]
+    ]
+    assert create_calls[0][1]["retries"] == RETRIES
+    if created:
+        assert "503 Service Unavailable" not in result.output
+        assert any(call[0][0][1] == "deploy" for call in mock_run.call_args_list)
+    else:
+        assert result.exit_code == 1
+        assert "503 Service Unavailable" in result.output
+
+
+@mock.patch("shutil.which")
+@mock.patch("datasette_publish_fly.publish.run")
+def test_publish_fly_pipeline_preflight_failure(mock_run, mock_which, mocker, tmp_path):
+    mock_which.return_value = True
+    mock_run.side_effect = pipeline_run_side_effect
+    temp_directory = tmp_path / "tmp"
+    temp_directory.mkdir()
+    mocker.patch("tempfile.tempdir", str(temp_directory))
+    database = tmp_path / "test.db"
+    database.write_text("data", "utf-8")
+    result = CliRunner().invoke(
+        cli.cli,
+        ["publish", "fly", str(database), "-a", "app", "--region", "sjc"]
+        + ["--pipeline"],
+    )
+    assert result.exit_code == 1
+    assert "That app name is not available" in result.output
+    assert not any(call[0][0][1] == "deploy" for call in mock_run.call_args_list)
+    # Temporary directory was cleaned up
+    assert list(temp_directory.iterdir()) == []
+
+
+@mock.patch("shutil.which")
+@mock.patch("datasette_publish_fly.publish.run")
+def test_publish_fly_pipeline_context_failure(mock_run, mock_which, mocker, tmp_path):
+    mock_which.return_value = True
+    events = []
+
+    class RecordingEvent(threading.Event):
+        def __init__(self):
+            super().__init__()
+            events.append(self)
+
+    def run_side_effect(*args, **kwargs):
+        if args == (["flyctl", "auth", "token", "--json"],):
+            # Block until the failed context preparation cancels us
+            assert events[0].wait(5)
+        return pipeline_run_side_effect(*args, **kwargs)
+
+    mocker.patch("datasette_publish_fly.publish.threading.Event", RecordingEvent)
+    killed = []
+    mocker.patch(
+        "datasette_publish_fly.publish.kill_running",
+        side_effect=lambda: killed.append(events[0].is_set()),
+    )
+    mocker.patch(
+        "datasette_publish_fly.publish.compress_databases",
+        side_effect=click.ClickException("Disk full"),
+    )
+    mock_run.side_effect = run_side_effect
+    database = tmp_path / "test.db"
+    database.write_text("data", "utf-8")
+    result = CliRunner().invoke(
+        cli.cli,
+        ["publish", "fly", str(database), "-a", "app", "--region", "sjc"]
+        + ["--pipeline", "--compress", "gzip"],
+    )
+    assert result.exit_code == 1
+    assert "Disk full" in result.output
+    # Preflight stopped after the step that was already running
+    assert mock_run.call_args_list == [
+        mock.call(["flyctl", "auth", "token", "--json"], stderr=PIPE, stdout=PIPE)
+    ]
+    # Told to stop before what it was running was killed, so it can't
+    # start another command in between
+    assert killed == [True]
+
+
+@mock.patch("shutil.which")
+@mock.patch("datasette_publish_fly.publish.run")
+def test_publish_fly_skips_unchanged_secrets(mock_run, mock_which):
+    mock_which.return_value = True
+    unchanged_digest = hashlib.sha256(b"same").hexdigest()[:16]
+
+    def run_side_effect(*args, **kwargs):
+        if args == (["flyctl", "auth", "token", "--json"],):
+            return FakeCompletedProcess(b'{"token": "TOKEN"}', b"")
+        elif args == (["flyctl", "apps", "list", "--json"],):
+            return FakeCompletedProcess(b'[{"Name": "app"}]', b"")
+        elif args == (["flyctl", "volumes", "list", "-a", "app", "--json"],):
+            return FakeCompletedProcess(b"[]", b"")
+        elif args == (["flyctl", "secrets", "list", "-a", "app", "--json"],):
+            return FakeCompletedProcess(
+                json.dumps(
+                    [
+                        {"Name": "PLUGIN_SAME", "Digest": unchanged_digest},
+                        {"Name": "PLUGIN_CHANGED", "Digest": "0000000000000000"},
+                    ]
+                ).encode("utf-8"),
+                b"",
+            )
+        return FakeCompletedProcess(b"", b"")
+
+    mock_run.side_effect = run_side_effect
+    result = CliRunner().invoke(
+        cli.cli,
+        ["publish", "fly", "-a", "app", "--region", "sjc"]
+        + ["--plugin-secret", "plugin", "same", "same"]
+        + ["--plugin-secret", "plugin", "changed", "new-value"]
+        + ["--plugin-secret", "plugin", "added", "added-value"],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0, result.output
+    assert "Skipped 1 unchanged secret" in result.output
+    secrets_set_calls = [
+        call[0][0]
+        for call in mock_run.call_args_list
+        if call[0][0][:3] == ["flyctl", "secrets", "set"]
+    ]
+    assert secrets_set_calls == [
+        [
+            "flyctl",
+            "secrets",
+            "set",
+            "--stage",
+            "PLUGIN_CHANGED=new-value",
+            "PLUGIN_ADDED=added-value",
+            "-a",
+            "app",
+        ]
+    ]
+    # Only one release - the deploy
+    assert mock_run.call_args_list[-1][0][0][:2] == ["flyctl", "deploy"]
+
+
+@pytest.mark.parametrize(
+    "opts,expected_deploy",
+    (
+        (["--strategy", "bluegreen"], '[deploy]\n  strategy = "bluegreen"\n'),
+        (
+            ["--strategy", "rolling", "--max-unavailable", "0.5"],
+            '[deploy]\n  strategy = "rolling"\n  max_unavailable = 0.5\n',
+        ),
+        (["--max-unavailable", "2"], "[deploy]\n  max_unavailable = 2\n"),
+    ),
+)
+def test_generate_directory_deploy_strategy(tmp_path, opts, expected_deploy):
+    output_directory = tmp_path / "output"
+    result = CliRunner().invoke(
+        cli.cli,
+        ["publish", "fly", "-a", "app", "--generate-dir", str(output_directory)] + opts,
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0, result.output
+    fly_toml = (output_directory / "fly.toml").read_text("utf-8")
+    assert ('app = "app"\n\n' + expected_deploy + "\n[[services]]\n") in fly_toml
+    assert fly_toml.endswith(
+        "  [[services.http_checks]]\n"
+        "    interval = 10000\n"
+        '    grace_period = "5s"\n'
+        '    method = "get"\n'
+        '    path = "/-/versions.json"\n'
+        '    protocol = "http"\n'
+        "    timeout = 2000\n"
+    )
+
+
+@pytest.mark.parametrize(
+    "opts,exit_code,expected_error",
+    (
+        (
+            ["--strategy", "canary", "--max-unavailable", "1"],
+            1,
+            "--max-unavailable can only be used with the rolling strategy",
+        ),
+        (["--max-unavailable", "0"], 2, "Must be a fraction between 0 and 1"),
+        (["--max-unavailable", "1.5"], 2, "Must be a fraction between 0 and 1"),
+    ),
+)
+def test_deploy_strategy_errors(tmp_path, opts, exit_code, expected_error):
+    result = CliRunner().invoke(
+        cli.cli,
+        ["publish", "fly", "-a", "app", "--generate-dir", str(tmp_path / "out")] + opts,
+    )
+    assert result.exit_code == exit_code
+    assert expected_error in result.output
+
+
+def test_generate_directory_inspect_volume(tmp_path):
+    output_directory = tmp_path / "output"
+    result = CliRunner().invoke(
+        cli.cli,
+        ["publish", "fly", "-a", "app", "--generate-dir", str(output_directory)]
+        + ["--create-volume", "1", "--create-db", "writes", "--inspect-volume"],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0, result.output
+    assert (
+        output_directory / "plugins" / "datasette_publish_fly_volume_inspect.py"
+    ).exists()
+    dockerfile_cmd = (
+        (output_directory / "Dockerfile").read_text("utf-8").strip().split("\n")[-1]
+    )
+    assert dockerfile_cmd == (
+        'CMD ["/bin/bash", "-c", "shopt -s nullglob && datasette serve --host 0.0.0.0 '
+        "--cors --inspect-file inspect-data.json --plugins-dir plugins/ /data/writes.db "
+        '--create --port $PORT /data/*.db"]'
+    )
+
+
+def test_inspect_volume_requires_volume(tmp_path):
+    result = CliRunner().invoke(
+        cli.cli,
+        ["publish", "fly", "-a", "app", "--generate-dir", str(tmp_path / "out")]
+        + ["--inspect-volume"],
+    )
+    assert result.exit_code == 1
+    assert "--inspect-volume requires a volume" in result.output
+
+
+def test_generate_directory_metrics(tmp_path):
+    output_directory = tmp_path / "output"
+    result = CliRunner().invoke(
+        cli.cli,
+        ["publish", "fly", "-a", "app", "--generate-dir", str(output_directory)]
+        + ["--metrics"],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0, result.output
+    assert (output_directory / "plugins" / "datasette_publish_fly_metrics.py").exists()
+    fly_toml = (output_directory / "fly.toml").read_text("utf-8")
+    assert '\n[metrics]\n  port = 8080\n  path = "/-/metrics"\n' in fly_toml
+    dockerfile = (output_directory / "Dockerfile").read_text("utf-8")
+    assert "--plugins-dir plugins/ --port $PORT" in dockerfile
+
+
+def test_generate_directory_slow_query_ms(tmp_path):
+    output_directory = tmp_path / "output"
+    result = CliRunner().invoke(
+        cli.cli,
+        ["publish", "fly", "-a", "app", "--generate-dir", str(output_directory)]
+        + ["--slow-query-ms", "250"],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0, result.output
+    assert (
+        output_directory / "plugins" / "datasette_publish_fly_slow_queries.py"
+    ).exists()
+    dockerfile = (output_directory / "Dockerfile").read_text("utf-8")
+    assert "ENV DATASETTE_PUBLISH_FLY_SLOW_QUERY_MS '250'" in dockerfile
+    assert "--plugins-dir plugins/ --port $PORT" in dockerfile
+
+
+def test_generate_directory_replicas(tmp_path):
+    output_directory = tmp_path / "output"
+    result = CliRunner().invoke(
+        cli.cli,
+        ["publish", "fly", "-a", "app", "--generate-dir", str(output_directory)]
+        + ["--create-volume", "1", "--create-db", "writes", "--region", "lhr"]
+        + ["--replicas", "2"],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0, result.output
+    dockerfile = (output_directory / "Dockerfile").read_text("utf-8")
+    lines = dockerfile.strip().split("\n")
+    assert lines[lines.index("WORKDIR /app") + 2] == (
+        "COPY --from=flyio/litefs:0.5 /usr/local/bin/litefs /usr/local/bin/litefs"
+    )
+    assert lines[-1] == 'ENTRYPOINT ["litefs", "mount"]'
+    assert "CMD" not in dockerfile
+    litefs_yml = (output_directory / "litefs.yml").read_text("utf-8")
+    assert '  db: "writes.db"\n' in litefs_yml
+    assert (
+        "  - cmd: \"/bin/bash -c 'shopt -s nullglob && datasette serve --host 0.0.0.0 "
+        "--cors --inspect-file inspect-data.json /litefs/writes.db --create "
+        "--port 8081 "
+        "/litefs/*.db'\"\n"
+    ) in litefs_yml
+    assert "candidate: ${FLY_REGION == PRIMARY_REGION}" in litefs_yml
+    fly_toml = (output_directory / "fly.toml").read_text("utf-8")
+    assert fly_toml.startswith('\napp = "app"\nprimary_region = "lhr"\n')
+    assert 'destination = "/data"' in fly_toml
+
+
+@pytest.mark.parametrize(
+    "options,error",
+    (
+        (["--create-db", "writes"], "--replicas requires a volume"),
+        (["--create-volume", "1"], "--replicas requires at least one --create-db"),
+        (
+            ["--create-volume", "1", "--create-db", "writes", "--inspect-volume"],
+            "--replicas cannot be used with --inspect-volume",
+        ),
+        (
+            ["--create-volume", "1", "--create-db", "writes"],
+            "--replicas requires --region when used with --generate-dir",
+        ),
+    ),
+)
+def test_replicas_errors(tmp_path, options, error):
+    result = CliRunner().invoke(
+        cli.cli,
+        ["publish", "fly", "-a", "app", "--generate-dir", str(tmp_path / "output")]
+        + ["--replicas", "1"]
+        + options,
+    )
+    assert result.exit_code == 1
+    assert error in result.output
+
+
+@mock.patch("shutil.which")
+@mock.patch("datasette_publish_fly.publish.run")
+def test_publish_fly_replicas(mock_run, mock_which):
+    mock_which.return_value = True
+    mock_run.side_effect = lambda *args, **kwargs: (
+        FakeCompletedProcess(b"", b"Error: Consul is already attached to app", 1)
+        if args[0][:3] == ["flyctl", "consul", "attach"]
+        else FakeCompletedProcess(b"", b"")
+        if args[0][:3] == ["flyctl", "apps", "create"]
+        else pipeline_run_side_effect(*args, **kwargs)
+    )
+    result = CliRunner().invoke(
+        cli.cli,
+        ["publish", "fly", "-a", "app", "--region", "sjc"]
+        + ["--create-volume", "1", "--create-db", "writes", "--replicas", "2"],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0, result.output
+    commands = [call[0][0] for call in mock_run.call_args_list]
+    assert commands[-3:] == [
+        ["flyctl", "consul", "attach", "--app", "app"],
+        ["flyctl", "deploy", ".", "--app", "app", "--config", "fly.toml"]
+        + ["--remote-only"],
+        ["flyctl", "scale", "count", "3", "--app", "app", "--yes"],
+    ]
+
+
+def generate_with_base_image(tmp_path, name, options):
+    output_directory = tmp_path / name
+    result = CliRunner().invoke(
+        cli.cli,
+        ["publish", "fly", "-a", "app", "--generate-dir", str(output_directory)]
+        + ["--base-image-app", "bases"]
+        + options,
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0, result.output
+    return (
+        (output_directory / "Dockerfile").read_text("utf-8"),
+        (output_directory / "base.Dockerfile").read_text("utf-8"),
+    )
+
+
+def test_generate_directory_base_image(tmp_path):
+    from datasette.version import __version__
+
+    dockerfile, base_dockerfile = generate_with_base_image(
+        tmp_path, "one", ["--install", "datasette-cluster-map", "--spatialite"]
+    )
+    assert base_dockerfile == (
+        "FROM python:3.11.0-slim-bullseye\n"
+        "RUN apt-get update && \\\n"
+        "    apt-get install -y python3-dev gcc libsqlite3-mod-spatialite && \\\n"
+        "    rm -rf /var/lib/apt/lists/*\n"
+        "RUN pip install -U datasette=={} datasette-cluster-map\n".format(
+            __version__
+        )
+    )
+    lines = dockerfile.split("\n")
+    assert lines[0].startswith("FROM registry.fly.io/bases:base-")
+    assert "apt-get" not in dockerfile
+    assert "pip install" not in dockerfile
+    assert "ENV SQLITE_EXTENSIONS" in dockerfile
+    assert "RUN datasette inspect" in dockerfile
+    assert lines[-1].startswith("CMD datasette serve")
+
+    # Same plugins, same image - different plugins, different image
+    same, _ = generate_with_base_image(
+        tmp_path, "two", ["--spatialite", "--install", "datasette-cluster-map"]
+    )
+    different, _ = generate_with_base_image(
+        tmp_path, "three", ["--install", "datasette-vega", "--spatialite"]
+    )
+    assert same.split("\n")[0] == lines[0]
+    assert different.split("\n")[0] != lines[0]
+
+
+@mock.patch("shutil.which")
+@mock.patch("datasette_publish_fly.publish.run")
+@pytest.mark.parametrize("exists", (True, False))
+def test_publish_fly_base_image(mock_run, mock_which, mocker, exists):
+    mock_which.return_value = True
+    mock_httpx = mocker.patch("datasette_publish_fly.base_image.httpx")
+    mock_httpx.head.return_value.status_code = 200 if exists else 404
+    mock_run.side_effect = lambda *args, **kwargs: (
+        FakeCompletedProcess(b"", b"")
+        if args[0][:3] == ["flyctl", "apps", "create"]
+        else pipeline_run_side_effect(*args, **kwargs)
+    )
+    result = CliRunner().invoke(
+        cli.cli,
+        ["publish", "fly", "-a", "app", "--region", "sjc"]
+        + ["--install", "datasette-cluster-map", "--base-image-app", "bases"],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0, result.output
+    url = mock_httpx.head.call_args[0][0]
+    assert url.startswith("https://registry.fly.io/v2/bases/manifests/base-")
+    assert mock_httpx.head.call_args[1]["auth"] == ("x", "TOKEN")
+    tag = url.split("/")[-1]
+    commands = [call[0][0] for call in mock_run.call_args_list]
+    builds = [command for command in commands if "--build-only" in command]
+    if exists:
+        assert "Using base image registry.fly.io/bases:{}".format(tag) in result.output
+        assert builds == []
+    else:
+        assert "Building base image" in result.output
+        assert ["flyctl", "apps", "create", "--name", "bases"] == commands[-3][:5]
+        (build,) = builds
+        assert build[:2] == ["flyctl", "deploy"]
+        assert build[3:5] == ["--app", "bases"]
+        assert build[-5:] == ["--build-only", "--push", "--image-label", tag] + [
+            "--remote-only"
+        ]
+    assert commands[-1][:5] == ["flyctl", "deploy", ".", "--app", "app"]
+
+
+def test_build_cache_requires_local_build():
+    result = CliRunner().invoke(
+        cli.cli, ["publish", "fly", "-a", "app", "--build-cache", "/tmp/cache"]
+    )
+    assert result.exit_code == 1
+    assert "--build-cache requires --build local" in result.output
+
+
+@mock.patch("shutil.which")
+@mock.patch("datasette_publish_fly.publish.run")
+@mock.patch("datasette_publish_fly.local_build.run")
+@pytest.mark.parametrize("registry_cache", (False, True))
+def test_publish_fly_build_local(
+    mock_build_run, mock_run, mock_which, tmp_path, registry_cache
+):
+    mock_which.return_value = True
+    mock_run.side_effect = lambda *args, **kwargs: (
+        FakeCompletedProcess(b"", b"")
+        if args[0][:3] == ["flyctl", "apps", "create"]
+        else pipeline_run_side_effect(*args, **kwargs)
+    )
+    cache = tmp_path / "cache"
+    cache.mkdir()
+    (cache / "old").write_text("old")
+    if registry_cache:
+        build_cache = "type=registry,ref=registry.example.com/app:cache"
+    else:
+        build_cache = str(cache)
+
+    def build_run(args, **kwargs):
+        if args[:2] == ["docker", "buildx"] and not registry_cache:
+            (tmp_path / "cache-new").mkdir()
+            (tmp_path / "cache-new" / "index.json").write_text("{}")
+        return FakeCompletedProcess(b"", b"")
+
+    mock_build_run.side_effect = build_run
+    result = CliRunner().invoke(
+        cli.cli,
+        ["publish", "fly", "-a", "app", "--region", "sjc"]
+        + ["--build", "local", "--build-cache", build_cache],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0, result.output
+    auth_call, build_call = [call[0][0] for call in mock_build_run.call_args_list]
+    assert auth_call == ["flyctl", "auth", "docker"]
+    image = build_call[build_call.index("--tag") + 1]
+    assert image.startswith("registry.fly.io/app:deployment-")
+    assert "--push" in build_call
+    if registry_cache:
+        assert build_call[-5:] == [
+            "--cache-from",
+            build_cache,
+            "--cache-to",
+            build_cache + ",mode=max",
+            ".",
+        ]
+    else:
+        assert build_call[-5:] == [
+            "--cache-from",
+            "type=local,src={}".format(cache),
+            "--cache-to",
+            "type=local,dest={}-new,mode=max".format(cache),
+            ".",
+        ]
+        # The new cache replaces the old one
+        assert [p.name for p in cache.iterdir()] == ["index.json"]
+        assert not (tmp_path / "cache-new").exists()
+    assert mock_run.call_args_list[-1][0][0] == [
+        "flyctl",
+        "deploy",
+        ".",
+        "--app",
+        "app",
+        "--config",
+        "fly.toml",
+        "--image",
+        image,
+    ]
+
+
+def test_generate_directory_build_local_installs_before_copy(tmp_path):
+    output_directory = tmp_path / "output"
+    result = CliRunner().invoke(
+        cli.cli,
+        ["publish", "fly", "-a", "app", "--generate-dir", str(output_directory)]
+        + ["--install", "datasette-cluster-map", "--spatialite", "--build", "local"],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0, result.output
+    lines = (output_directory / "Dockerfile").read_text("utf-8").split("\n")
+    assert lines[:6] == [
+        "FROM python:3.11.0-slim-bullseye",
+        "RUN apt-get update && \\",
+        "    apt-get install -y python3-dev gcc libsqlite3-mod-spatialite && \\",
+        "    rm -rf /var/lib/apt/lists/*",
+        "RUN pip install -U datasette datasette-cluster-map",
+        "COPY . /app",
+    ]
+
+
+@mock.patch("shutil.which")
+@mock.patch("datasette_publish_fly.publish.run")
+def test_publish_fly_resume(mock_run, mock_which, tmp_path, cache_dir):
+    mock_which.return_value = True
+    failing = {"deploy", "memory"}
+
+    def run_side_effect(*args, **kwargs):
+        if args[0][:2] == ["flyctl", "deploy"] and "deploy" in failing:
+            return FakeCompletedProcess(b"", b"", 1)
+        if args[0][:3] == ["flyctl", "scale", "memory"] and "memory" in failing:
+            return FakeCompletedProcess(b"", b"Error: out of capacity", 1)
+        if args[0][:3] == ["flyctl", "apps", "create"]:
+            return FakeCompletedProcess(b"", b"")
+        return pipeline_run_side_effect(*args, **kwargs)
+
+    mock_run.side_effect = run_side_effect
+    database = tmp_path / "test.db"
+    database.write_text("data", "utf-8")
+    command = ["publish", "fly", str(database), "-a", "app", "--region", "sjc"]
+    command += ["--vm-memory", "512", "--plugin-secret", "a", "b", "c"]
+
+    def publish(*extra):
+        mock_run.reset_mock()
+        result = CliRunner().invoke(cli.cli, command + list(extra))
+        return result, [call[0][0][:3] for call in mock_run.call_args_list]
+
+    result, commands = publish()
+    assert result.exit_code == 1
+    assert "Error calling 'flyctl deploy'" in result.output
+    state = json.loads((cache_dir / "publish-state.json").read_text())
+    assert list(list(state.values())[0]["phases"]) == ["preflight", "secrets"]
+
+    # Resuming skips preflight and secrets
+    failing.remove("deploy")
+    result, commands = publish("--resume")
+    assert result.exit_code == 1
+    assert "Resuming publish of app, skipping: preflight, secrets" in result.output
+    assert commands == [
+        ["flyctl", "deploy", "."],
+        ["flyctl", "scale", "memory"],
+    ]
+
+    # Resuming after the deploy doesn't build or deploy again
+    failing.remove("memory")
+    result, commands = publish("--resume")
+    assert result.exit_code == 0, result.output
+    assert commands == [["flyctl", "scale", "memory"]]
+    # A finished publish has nothing left to resume
+    assert json.loads((cache_dir / "publish-state.json").read_text()) == {}
+    result, commands = publish("--resume")
+    assert "Nothing to resume, publishing from the start" in result.output
+    assert commands[0] == ["flyctl", "auth", "token"]
+
+
+@mock.patch("shutil.which")
+@mock.patch("datasette_publish_fly.publish.run")
+def test_publish_fly_resume_changed_file(mock_run, mock_which, tmp_path):
+    mock_which.return_value = True
+    mock_run.side_effect = lambda *args, **kwargs: (
+        FakeCompletedProcess(b"", b"", 1)
+        if args[0][:2] == ["flyctl", "deploy"]
+        else FakeCompletedProcess(b"", b"")
+        if args[0][:3] == ["flyctl", "apps", "create"]
+        else pipeline_run_side_effect(*args, **kwargs)
+    )
+    database = tmp_path / "test.db"
+    database.write_text("data", "utf-8")
+    command = ["publish", "fly", str(database), "-a", "app", "--region", "sjc"]
+    assert CliRunner().invoke(cli.cli, command).exit_code == 1
+    database.write_text("new data", "utf-8")
+    result = CliRunner().invoke(cli.cli, command + ["--resume"])
+    assert "Nothing to resume, publishing from the start" in result.output
+
+
+@mock.patch("shutil.which")
+@mock.patch("datasette_publish_fly.publish.run")
+def test_publish_fly_volumes_list_error(mock_run, mock_which):
+    mock_which.return_value = True
+    mock_run.side_effect = lambda *args, **kwargs: (
+        FakeCompletedProcess(b"", b"Error: unauthorized", 1)
+        if args[0][:3] == ["flyctl", "volumes", "list"]
+        else FakeCompletedProcess(b"", b"")
+        if args[0][:3] == ["flyctl", "apps", "create"]
+        else pipeline_run_side_effect(*args, **kwargs)
+    )
+    result = CliRunner().invoke(
+        cli.cli,
+        ["publish", "fly", "-a", "app", "--region", "sjc", "--create-volume", "1"],
+    )
+    assert result.exit_code == 1
+    assert "Error calling 'flyctl volumes list':\n\nError: unauthorized" in (
+        result.output
+    )
+
+
+@mock.patch("shutil.which")
+@mock.patch("datasette_publish_fly.publish.run")
+def test_publish_fly_watch(mock_run, mock_which, tmp_path, cache_dir, monkeypatch):
+    mock_which.return_value = True
+    deploys = []
+
+    def run_side_effect(*args, **kwargs):
+        if args[0][:2] == ["flyctl", "deploy"]:
+            deploys.append((os.getcwd(), open("Dockerfile").read()))
+            return FakeCompletedProcess(b"", b"")
+        if args[0][:3] == ["flyctl", "apps", "create"]:
+            return FakeCompletedProcess(b"", b"")
+        return pipeline_run_side_effect(*args, **kwargs)
+
+    mock_run.side_effect = run_side_effect
+    database = tmp_path / "test.db"
+    database.write_text("data", "utf-8")
+    changes = iter(["new data"])
+
+    def wait_for_change(paths, before):
+        try:
+            database.write_text(next(changes), "utf-8")
+        except StopIteration:
+            raise KeyboardInterrupt
+        return watch.snapshot(paths)
+
+    monkeypatch.setattr(watch, "wait_for_change", wait_for_change)
+    result = CliRunner().invoke(
+        cli.cli,
+        ["publish", "fly", str(database), "-a", "app", "--region", "sjc", "--watch"],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0, result.output
+    assert "Changed: {} - republishing".format(database) in result.output
+    commands = [call[0][0][:3] for call in mock_run.call_args_list]
+    # Preflight only ran for the first publish
+    assert commands.count(["flyctl", "apps", "list"]) == 1
+    assert len(deploys) == 2
+    context, dockerfile = deploys[1]
+    assert context == deploys[0][0] == str(cache_dir / "context" / "app")
+    assert 'COPY --link ["test.db", "/app/test.db"]' in dockerfile
+    assert "COPY . /app" not in dockerfile
+
+
+def test_publish_fly_watch_generate_dir(tmp_path):
+    result = CliRunner().invoke(
+        cli.cli,
+        ["publish", "fly", "-a", "app", "--generate-dir", str(tmp_path), "--watch"],
+    )
+    assert result.exit_code == 1
+    assert "--watch cannot be used with --generate-dir" in result.output
+
+
+def test_generate_directory_wal(tmp_path):
+    output_directory = tmp_path / "output"
+    result = CliRunner().invoke(
+        cli.cli,
+        ["publish", "fly", "-a", "app", "--generate-dir", str(output_directory)]
+        + ["--create-volume", "1", "--create-db", "writes"]
+        + ["--wal", "--wal-checkpoint-interval", "30"],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0, result.output
+    assert (output_directory / "plugins" / "datasette_publish_fly_wal.py").exists()
+    dockerfile = (output_directory / "Dockerfile").read_text("utf-8")
+    assert "ENV DATASETTE_PUBLISH_FLY_WAL_CHECKPOINT_INTERVAL '30'" in dockerfile
+    # -wal and -shm files don't match the glob
+    assert (
+        "--plugins-dir plugins/ /data/writes.db --create --port $PORT /data/*.db"
+        in dockerfile
+    )
+
+
+@pytest.mark.parametrize(
+    "options,error",
+    (
+        (["--wal"], "--wal requires a volume, use --create-volume"),
+        (
+            ["--wal-checkpoint-interval", "10"],
+            "--wal-checkpoint-interval requires --wal",
+        ),
+        (
+            ["--wal", "--create-volume", "1", "--create-db", "writes"]
+            + ["--region", "lhr", "--replicas", "1"],
+            "--replicas cannot be used with --wal",
+        ),
+    ),
+)
+def test_generate_directory_wal_errors(tmp_path, options, error):
+    result = CliRunner().invoke(
+        cli.cli,
+        ["publish", "fly", "-a", "app", "--generate-dir", str(tmp_path / "output")]
+        + options,
+    )
+    assert result.exit_code == 1
+    assert error in result.output
+
+
+@mock.patch("shutil.which")
+@mock.patch("datasette_publish_fly.publish.run_benchmark")
+@mock.patch("datasette_publish_fly.publish.run")
+def test_publish_fly_target_rps(mock_run, mock_benchmark, mock_which, tmp_path):
+    mock_which.return_value = True
+    mock_run.side_effect = lambda *args, **kwargs: (
+        FakeCompletedProcess(b"", b"")
+        if args[0][:3] == ["flyctl", "apps", "create"]
+        else pipeline_run_side_effect(*args, **kwargs)
+    )
+    mock_benchmark.return_value = {
+        "paths": 5,
+        "concurrency": 25,
+        "requests": 2000,
+        "errors": 0,
+        "rps": 200,
+        "p50_ms": 50,
+        "p95_ms": 100,
+    }
+    database = tmp_path / "test.db"
+    database.write_text("data", "utf-8")
+    result = CliRunner().invoke(
+        cli.cli,
+        ["publish", "fly", str(database), "-a", "app", "--region", "sjc"]
+        + ["--target-rps", "100", "--vm-memory", "512", "--show-files"],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0, result.output
+    mock_benchmark.assert_called_once_with(25)
+    assert (
+        "Capacity plan\n"
+        "----\n"
+        "Local benchmark: 200 requests/second across 5 URLs with 25 concurrent"
+        " requests, p50 50ms, p95 100ms, 0 errors\n"
+    ) in result.output
+    assert "VM size: shared-cpu-4x, machines: 3\n----" in result.output
+    commands = [call[0][0] for call in mock_run.call_args_list]
+    scale_commands = [command for command in commands if command[1] == "scale"]
+    # VM size first, as it resets the memory
+    assert scale_commands == [
+        ["flyctl", "scale", "vm", "shared-cpu-4x", "--app", "app"],
+        ["flyctl", "scale", "count", "3", "--app", "app", "--yes"],
+        ["flyctl", "scale", "memory", "512", "-a", "app"],
+    ]
+
+
+@mock.patch("datasette_publish_fly.publish.run_benchmark")
+def test_generate_directory_target_rps_with_volume(mock_benchmark, tmp_path):
+    mock_benchmark.return_value = {
+        "paths": 5,
+        "concurrency": 25,
+        "requests": 2000,
+        "errors": 0,
+        "rps": 200,
+        "p50_ms": 50,
+        "p95_ms": 100,
+    }
+    result = CliRunner().invoke(
+        cli.cli,
+        ["publish", "fly", "-a", "app", "--generate-dir", str(tmp_path / "out")]
+        + ["--create-volume", "1", "--target-rps", "100", "--vm-memory", "512"],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0, result.output
+    # The volume can only be attached to one machine
+    assert "VM size: performance-1x, machines: 1" in result.output
+    assert "VM memory: 2048MB, the minimum for performance-1x" in result.output
+    assert "    flyctl scale vm performance-1x --app app\n" in result.output
+    assert "    flyctl scale count 1 --app app" in result.output
+
+
+@pytest.mark.parametrize("value", ("0", "-5"))
+def test_target_rps_must_be_positive(value):
+    result = CliRunner().invoke(
+        cli.cli, ["publish", "fly", "-a", "app", "--plan", "--target-rps", value]
+    )
+    assert result.exit_code == 2
+    assert "Must be greater than 0" in result.output
+
+
+@pytest.mark.parametrize("created", (True, False))
+@mock.patch("shutil.which")
+@mock.patch("datasette_publish_fly.publish.sync_database")
+@mock.patch("datasette_publish_fly.publish.run")
+def test_publish_fly_sync_db_restarts_for_new_database(
+    mock_run, mock_sync, mock_which, tmp_path, created
+):
+    mock_which.return_value = True
+
+    def run_side_effect(*args, **kwargs):
+        if args == (["flyctl", "auth", "token", "--json"],):
+            return FakeCompletedProcess(b'{"token": "TOKEN"}', b"")
+        elif args == (["flyctl", "apps", "list", "--json"],):
+            return FakeCompletedProcess(b'[{"Name": "app"}]', b"")
+        elif args == (["flyctl", "volumes", "list", "-a", "app", "--json"],):
+            return FakeCompletedProcess(b'[{"Name": "datasette"}]', b"")
+        return FakeCompletedProcess(b"", b"")
+
+    mock_run.side_effect = run_side_effect
+    mock_sync.return_value = {
+        "changed_pages": 3,
+        "sent": 100,
+        "full_size": 1000,
+        "created": created,
+    }
+    reference = tmp_path / "reference.db"
+    reference.write_text("data", "utf-8")
+    result = CliRunner().invoke(
+        cli.cli,
+        ["publish", "fly", "-a", "app", "--region", "sjc", "--create-volume", "1"]
+        + ["--sync-db", str(reference)],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0, result.output
+    mock_sync.assert_called_once_with("app", str(reference))
+    restarts = [
+        call
+        for call in mock_run.call_args_list
+        if call[0][0] == ["flyctl", "apps", "restart", "app"]
+    ]
+    # The volume's databases are found when Datasette starts
+    assert len(restarts) == (1 if created else 0)
@@ -0,0 +1,140 @@
+from click.testing import CliRunner
+from datasette import cli
+from datasette_publish_fly.regions import (
+    estimate_latency_ms,
+    latency_matrix,
+    load_probes,
+    score_regions,
+)
+from unittest import mock
+import click
+import json
+import pytest
+
+from .test_publish_fly import FakeCompletedProcess
+
+SAN_FRANCISCO = (37.77, -122.42)
+LONDON = (51.51, -0.13)
+BERLIN = (52.52, 13.40)
+
+
+def test_estimate_latency_prefers_nearby_region():
+    assert estimate_latency_ms(*SAN_FRANCISCO, "sjc") < estimate_latency_ms(
+        *SAN_FRANCISCO, "iad"
+    )
+
+
+def test_score_regions_single():
+    regions, mean = score_regions(latency_matrix([LONDON, BERLIN], []))
+    assert regions[0] in ("lhr", "ams", "fra", "cdg")
+    assert mean < 30
+
+
+def test_score_regions_multiple_covers_both_continents():
+    regions, _ = score_regions(latency_matrix([SAN_FRANCISCO, LONDON], []), count=2)
+    assert set(regions) == {"sjc", "lhr"}
+
+
+def test_probes_override_estimates(tmp_path):
+    probes = tmp_path / "probes.csv"
+    probes.write_text(
+        "client,region,latency_ms\n"
+        "office,iad,12\n"
+        "office,sjc,80\n"
+        "phone,iad,40\n"
+        "phone,sjc,30\n"
+        # Only measured for one client, so not a candidate
+        "phone,lhr,1\n",
+        "utf-8",
+    )
+    matrix = latency_matrix([], load_probes(str(probes)))
+    assert score_regions(matrix) == (["iad"], 26)
+
+
+def test_probes_json(tmp_path):
+    probes = tmp_path / "probes.json"
+    probes.write_text(
+        json.dumps([{"client": "a", "region": "ams", "latency_ms": 3}]), "utf-8"
+    )
+    assert load_probes(str(probes)) == [["a", "ams", 3.0]]
+
+
+def test_invalid_probes(tmp_path):
+    probes = tmp_path / "probes.csv"
+    probes.write_text("client,region\na,ams\n", "utf-8")
+    with pytest.raises(click.ClickException):
+        load_probes(str(probes))
+
+
+@mock.patch("shutil.which")
+@mock.patch("datasette_publish_fly.publish.run")
+def test_region_auto(mock_run, mock_which, cache_dir):
+    mock_which.return_value = True
+
+    def run_side_effect(*args, **kwargs):
+        if args == (["flyctl", "auth", "token", "--json"],):
+            return FakeCompletedProcess(b'{"token": "TOKEN"}', b"")
+        elif args == (["flyctl", "apps", "list", "--json"],):
+            return FakeCompletedProcess(b'[{"Name": "app"}]', b"")
+        elif args == (["flyctl", "volumes", "list", "-a", "app", "--json"],):
+            return FakeCompletedProcess(b"[]", b"")
+        return FakeCompletedProcess(b"", b"")
+
+    mock_run.side_effect = run_side_effect
+    runner = CliRunner()
+    args = ["publish", "fly", "-a", "app", "--region", "auto"]
+    result = runner.invoke(
+        cli.cli,
+        args
+        + ["--client-location", "37.77,-122.42", "--client-location", "37.4,-122.1"]
+        + ["--client-location", "51.51,-0.13"]
+        + ["--region-count", "2"],
+    )
+    assert result.exit_code == 0, result.output
+    assert "Selected regions sjc, lhr" in result.output
+    assert mock_run.call_args_list[-1] == mock.call(
+        ["flyctl", "regions", "set", "sjc", "lhr", "-a", "app"],
+        stderr=-1,
+        stdout=-1,
+    )
+    assert json.loads((cache_dir / "regions.json").read_text("utf-8"))["app"][
+        "regions"
+    ] == ["sjc", "lhr"]
+
+    # Second run re-uses the cached client locations
+    mock_run.reset_mock()
+    result = runner.invoke(cli.cli, args)
+    assert result.exit_code == 0, result.output
+    assert "Using cached client locations for app" in result.output
+    # Without a count only the best region is used
+    assert "Selected region sjc " in result.output
+    assert mock_run.call_args_list[-1][0][0][:2] == ["flyctl", "deploy"]
+
+
+def test_region_auto_requires_locations():
+    runner = CliRunner()
+    result = runner.invoke(
+        cli.cli,
+        ["publish", "fly", "-a", "app", "--region", "auto", "--generate-dir", "out"],
+    )
+    assert result.exit_code == 1
+    assert "--region auto needs --client-location or --region-probes" in result.output
+
+
+@pytest.mark.parametrize(
+    "options,message",
+    (
+        (["--client-location", "37.77,-122.42"], "--client-location"),
+        (["--region-count", "2"], "--region-count"),
+        (
+            ["--region", "sjc", "--client-location", "1,2", "--region-count", "2"],
+            "--client-location, --region-count",
+        ),
+    ),
+)
+def test_region_options_require_region_auto(options, message):
+    result = CliRunner().invoke(
+        cli.cli, ["publish", "fly", "-a", "app", "--generate-dir", "out"] + options
+    )
+    assert result.exit_code == 1
+    assert "{} requires --region auto".format(message) in result.output
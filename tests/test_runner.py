@@ -0,0 +1,286 @@
+from datasette_publish_fly import runner
+from datasette_publish_fly.runner import Result
+from subprocess import PIPE
+import asyncio
+import click
+import os
+import pytest
+import sys
+import threading
+import time
+
+
+@pytest.fixture
+def sleeps(mocker):
+    sleeps = []
+    mocker.patch("datasette_publish_fly.runner.time.sleep", side_effect=sleeps.append)
+    return sleeps
+
+
+def fake_results(mocker, *results):
+    return mocker.patch(
+        "datasette_publish_fly.runner.run_once", side_effect=list(results)
+    )
+
+
+def test_retries_transient_errors(mocker, sleeps):
+    args = ["flyctl", "volumes", "list", "-a", "app", "--json"]
+    mock_run = fake_results(
+        mocker,
+        Result(args, 1, b"", b"", b"Error: 503 Service Unavailable"),
+        Result(args, 1, b"", b"", b"Error: read tcp: i/o timeout"),
+        Result(args, 0, b"{}", b""),
+    )
+    result = runner.run(args, stdout=PIPE, stderr=PIPE)
+    assert result.returncode == 0
+    assert result.attempts == 3
+    assert sleeps == [2.0, 4.0]
+    assert mock_run.call_count == 3
+    # args, input, stdout, stderr, timeout
+    assert mock_run.call_args[0][4] == runner.SHORT_TIMEOUT
+
+
+@pytest.mark.parametrize(
+    "args",
+    (
+        ["flyctl", "volumes", "create", "datasette"],
+        ["flyctl", "apps", "create", "app"],
+        ["flyctl", "deploy", "--remote-only"],
+    ),
+)
+def test_does_not_retry_commands_that_change_things(mocker, sleeps, args):
+    mock_run = fake_results(
+        mocker, Result(args, 1, b"", b"", b"Error: context deadline exceeded")
+    )
+    assert runner.run(args, stdout=PIPE, stderr=PIPE).returncode == 1
+    assert mock_run.call_count == 1
+    assert sleeps == []
+
+
+def test_retries_secrets_set_stage(mocker, sleeps):
+    args = ["flyctl", "secrets", "set", "--stage", "-a", "app", "-"]
+    mock_run = fake_results(
+        mocker,
+        Result(args, 1, b"", b"", b"Error: 502 Bad Gateway"),
+        Result(args, 0, b"", b""),
+    )
+    assert runner.run(args, stdout=PIPE, stderr=PIPE).returncode == 0
+    assert mock_run.call_count == 2
+    assert sleeps == [2.0]
+
+
+@pytest.mark.parametrize("took_effect", (False, True))
+def test_retry_if(mocker, sleeps, took_effect):
+    args = ["flyctl", "volumes", "create", "datasette"]
+    mock_run = fake_results(
+        mocker,
+        Result(args, 1, b"", b"", b"Error: 503 Service Unavailable"),
+        Result(args, 0, b"", b""),
+    )
+    checks = []
+
+    def retry_if():
+        checks.append(True)
+        return not took_effect
+
+    result = runner.run(
+        args, stdout=PIPE, stderr=PIPE, retries=runner.RETRIES, retry_if=retry_if
+    )
+    assert checks == [True]
+    if took_effect:
+        assert result.returncode == 1
+        assert mock_run.call_count == 1
+        assert sleeps == []
+    else:
+        assert result.returncode == 0
+        assert mock_run.call_count == 2
+        assert sleeps == [2.0]
+
+
+def test_does_not_retry_other_errors(mocker, sleeps):
+    args = ["flyctl", "apps", "create"]
+    fake_results(
+        mocker,
+        Result(args, 1, b"", b"", b"Error: Name has already been taken"),
+    )
+    assert runner.run(args, stdout=PIPE, stderr=PIPE).returncode == 1
+    assert sleeps == []
+
+
+def test_gives_up_after_retries(mocker, sleeps):
+    args = ["flyctl", "secrets", "list"]
+    fake_results(mocker, *[Result(args, -9, timed_out=True) for _ in range(4)])
+    with pytest.raises(click.ClickException) as e:
+        runner.run(args, stdout=PIPE, stderr=PIPE)
+    assert e.value.message == "'flyctl secrets list' timed out after 60s"
+    assert sleeps == [2.0, 4.0, 8.0]
+
+
+def test_default_timeout():
+    assert runner.default_timeout(["flyctl", "deploy", "."]) == runner.LONG_TIMEOUT
+    assert runner.default_timeout(["docker", "buildx", "build"]) == runner.LONG_TIMEOUT
+    assert runner.default_timeout(["flyctl", "apps", "list"]) == runner.SHORT_TIMEOUT
+    assert runner.default_timeout(["flyctl", "ssh", "console"]) == runner.TIMEOUT
+
+
+def test_streams_output(capsys, monkeypatch):
+    monkeypatch.setattr(runner, "BACKOFF", 0.01)
+    script = "import sys; print('one'); print('503 Service Unavailable'); sys.exit(1)"
+    result = runner.run([sys.executable, "-c", script], retries=1)
+    assert result.returncode == 1
+    assert result.stdout is None
+    # Streamed output is checked for transient errors too
+    captured = capsys.readouterr()
+    assert captured.out.count("one\n") == 2
+    assert "failed (503 Service Unavailable), retrying" in captured.err
+
+
+def test_streaming_timeout():
+    with pytest.raises(click.ClickException) as e:
+        runner.run(
+            [sys.executable, "-c", "import time; time.sleep(30)"],
+            timeout=0.2,
+            retries=0,
+        )
+    assert "timed out after 0.2s" in e.value.message
+
+
+FAKE_FLYCTL = """#!{python}
+import os, subprocess, sys, time
+
+command = sys.argv[1]
+if command == "hang":
+    # Something it started, which must be killed too
+    child = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(60)"])
+    with open(sys.argv[2], "w") as fp:
+        fp.write(str(child.pid))
+    print("started", flush=True)
+    time.sleep(60)
+elif command == "flood":
+    block = b"x" * 1023 + b"\\n"
+    for i in range(int(sys.argv[2])):
+        sys.stdout.buffer.write(block)
+        sys.stderr.buffer.write(block)
+    sys.stderr.buffer.write(b"Error: 503 Service Unavailable\\n")
+    sys.exit(1)
+elif command == "echo":
+    sys.stdout.buffer.write(sys.stdin.buffer.read())
+"""
+
+
+@pytest.fixture
+def fake_flyctl(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    flyctl = bin_dir / "flyctl"
+    flyctl.write_text(FAKE_FLYCTL.format(python=sys.executable), "utf-8")
+    flyctl.chmod(0o755)
+    monkeypatch.setenv("PATH", str(bin_dir) + os.pathsep + os.environ["PATH"])
+    return flyctl
+
+
+@pytest.fixture(params=["asyncio", "threads"])
+def implementation(request, monkeypatch):
+    if request.param == "threads":
+        # What threads other than the main one use on Python 3.7
+        monkeypatch.setattr(runner, "run_once", runner.run_threaded)
+
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    # Killed, but not yet reaped by init
+    with open("/proc/{}/stat".format(pid)) as fp:
+        return fp.read().split(") ")[-1][0] != "Z"
+
+
+def wait_until_gone(pid, seconds=5):
+    deadline = time.monotonic() + seconds
+    while is_running(pid) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    return not is_running(pid)
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="uses /proc")
+def test_timeout_kills_process_tree(fake_flyctl, implementation, tmp_path, capsys):
+    pid_file = tmp_path / "child.pid"
+    start = time.monotonic()
+    with pytest.raises(click.ClickException) as e:
+        runner.run(["flyctl", "hang", str(pid_file)], timeout=1, retries=0)
+    assert time.monotonic() - start < 10
+    assert e.value.message == "'flyctl hang {}' timed out after 1s".format(pid_file)
+    # Shown as it arrived, before the timeout
+    assert capsys.readouterr().out == "started\n"
+    assert wait_until_gone(int(pid_file.read_text()))
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="uses /proc")
+def test_cancelling_kills_process_tree(fake_flyctl, tmp_path):
+    pid_file = tmp_path / "child.pid"
+
+    async def run_then_cancel():
+        task = asyncio.ensure_future(
+            runner.run_async(
+                ["flyctl", "hang", str(pid_file)], stdout=PIPE, stderr=PIPE
+            )
+        )
+        while not pid_file.exists() or not pid_file.read_text():
+            await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(asyncio.wait_for(run_then_cancel(), 10))
+    assert wait_until_gone(int(pid_file.read_text()))
+
+
+def test_captures_flood_of_output(fake_flyctl, implementation, sleeps):
+    # Far more than a pipe holds, on both streams at once
+    result = runner.run(
+        ["flyctl", "flood", "5000"], stdout=PIPE, stderr=PIPE, retries=runner.RETRIES
+    )
+    assert result.returncode == 1
+    assert len(result.stdout) == 5000 * 1024
+    assert result.stderr.endswith(b"x\nError: 503 Service Unavailable\n")
+    assert len(result.tail) == 2 * runner.TAIL_BYTES
+    # The transient error at the end of the flood was spotted
+    assert result.attempts == 4
+    assert sleeps == [2.0, 4.0, 8.0]
+
+
+def test_streams_flood_of_output(fake_flyctl, implementation, capfd, sleeps):
+    result = runner.run(["flyctl", "flood", "2000"], retries=0)
+    assert result.returncode == 1
+    assert result.stdout is None and result.stderr is None
+    assert result.duration > 0
+    captured = capfd.readouterr()
+    assert len(captured.out) == 2000 * 1024
+    assert captured.err.endswith("Error: 503 Service Unavailable\n")
+
+
+def test_input(fake_flyctl, implementation):
+    data = os.urandom(5 * 1024 * 1024)
+    result = runner.run(["flyctl", "echo"], input=data, stdout=PIPE, stderr=PIPE)
+    assert result.returncode == 0
+    assert result.stdout == data
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="uses /proc")
+def test_kill_running(fake_flyctl, implementation, tmp_path):
+    pid_file = tmp_path / "child.pid"
+    results = []
+    thread = threading.Thread(
+        target=lambda: results.append(
+            runner.run(["flyctl", "hang", str(pid_file)], stdout=PIPE, stderr=PIPE)
+        )
+    )
+    thread.start()
+    while not pid_file.exists() or not pid_file.read_text():
+        time.sleep(0.05)
+    runner.kill_running()
+    thread.join(10)
+    assert results[0].returncode == -9
+    assert not runner.RUNNING
+    assert wait_until_gone(int(pid_file.read_text()))
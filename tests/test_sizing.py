@@ -0,0 +1,118 @@
+from click.testing import CliRunner
+from datasette import cli
+from datasette_publish_fly.sizing import GB, MB, choose_volume_gb, choose_vm_memory_mb
+from unittest import mock
+import pytest
+
+from .test_publish_fly import FakeCompletedProcess
+
+
+@pytest.mark.parametrize(
+    "volume_bytes,growth,expected",
+    ((0, 2, 1), (int(0.4 * GB), 2, 1), (int(1.2 * GB), 2, 3), (3 * GB, 1.5, 5)),
+)
+def test_choose_volume_gb(volume_bytes, growth, expected):
+    size, reasons = choose_volume_gb(volume_bytes, growth)
+    assert size == expected
+    assert reasons[-1] == "Volume size: {}GB".format(expected)
+
+
+def test_choose_volume_gb_chunked():
+    size, reasons = choose_volume_gb(int(0.5 * GB), 2, int(1.5 * GB))
+    assert size == 3
+    assert reasons == [
+        "0.50GB of databases on the volume x 2 expected growth = 1.00GB",
+        "+ 1.50GB of chunked databases reassembled on the volume = 2.50GB",
+        "Volume size: 3GB",
+    ]
+
+
+@pytest.mark.parametrize(
+    "database_bytes,database_count,settings,expected",
+    (
+        (0, 1, [], 256),
+        (100 * MB, 1, [], 512),
+        (100 * MB, 2, [("cache_size_kb", 100000)], 2048),
+        (600 * MB, 1, [("num_sql_threads", 10)], 1024),
+        (int(1.2 * GB), 1, [], 2048),
+    ),
+)
+def test_choose_vm_memory_mb(database_bytes, database_count, settings, expected):
+    memory_mb, reasons = choose_vm_memory_mb(database_bytes, database_count, settings)
+    assert memory_mb == expected
+    assert reasons[-1] == "VM memory: {}MB".format(expected)
+    assert not any(reason.startswith("Warning") for reason in reasons)
+
+
+def test_choose_vm_memory_mb_capped():
+    memory_mb, reasons = choose_vm_memory_mb(3 * GB, 1, [])
+    # The most a shared-cpu-1x VM can have
+    assert memory_mb == 2048
+    assert reasons[1].startswith(
+        "Warning: the databases will not fit in the page cache of a shared-cpu-1x VM"
+    )
+    assert reasons[-1] == "VM memory: 2048MB"
+
+
+def test_choose_vm_memory_mb_too_big():
+    _, reasons = choose_vm_memory_mb(20 * GB, 1, [])
+    assert "will not fit" in reasons[1]
+
+
+@mock.patch("shutil.which")
+@mock.patch("datasette_publish_fly.publish.run")
+def test_publish_auto_volume_and_memory(mock_run, mock_which, tmp_path):
+    mock_which.return_value = True
+
+    def run_side_effect(*args, **kwargs):
+        if args == (["flyctl", "auth", "token", "--json"],):
+            return FakeCompletedProcess(b'{"token": "TOKEN"}', b"")
+        elif args == (["flyctl", "apps", "list", "--json"],):
+            return FakeCompletedProcess(b'[{"Name": "app"}]', b"")
+        elif args == (["flyctl", "volumes", "list", "-a", "app", "--json"],):
+            return FakeCompletedProcess(b"[]", b"")
+        return FakeCompletedProcess(b"", b"")
+
+    mock_run.side_effect = run_side_effect
+    database = tmp_path / "big.db"
+    with open(database, "wb") as fp:
+        fp.truncate(300 * MB)
+    result = CliRunner().invoke(
+        cli.cli,
+        ["publish", "fly", str(database), "-a", "app", "--region", "sjc"]
+        + ["--create-volume", "auto", "--create-db", "writes"]
+        + ["--vm-memory", "auto"],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0, result.output
+    assert "Volume size:\n" in result.output
+    assert "VM memory: 1024MB" in result.output
+    commands = [call[0][0] for call in mock_run.call_args_list]
+    assert [
+        "flyctl",
+        "volumes",
+        "create",
+        "datasette",
+        "--region",
+        "sjc",
+        "--size",
+        "1",
+        "-a",
+        "app",
+        "--json",
+    ] in commands
+    assert ["flyctl", "scale", "memory", "1024", "-a", "app"] in commands
+
+
+@pytest.mark.parametrize(
+    "opts,expected_error",
+    (
+        (["--create-volume", "big"], "'big' should be an integer or 'auto'"),
+        (["--create-volume", "0"], "0 is less than 1"),
+        (["--vm-memory", "128"], "128 is less than 256"),
+    ),
+)
+def test_integer_or_auto_errors(opts, expected_error):
+    result = CliRunner().invoke(cli.cli, ["publish", "fly", "-a", "app"] + opts)
+    assert result.exit_code == 2
+    assert expected_error in result.output
@@ -0,0 +1,179 @@
+from click.testing import CliRunner
+from datasette import cli
+from datasette_publish_fly.volume_upload import upload_files_to_volume
+from unittest import mock
+import hashlib
+import json
+import pytest
+import re
+import shlex
+
+from .test_publish_fly import FakeCompletedProcess
+
+
+class FakeVolume:
+    "Pretends to be the /data volume on the other end of 'flyctl ssh console'"
+
+    def __init__(self):
+        self.files = {}
+        self.commands = []
+        self.fail_after_dd = None
+
+    def __call__(self, args, input=None, stdout=None, stderr=None):
+        assert args[:5] == ["flyctl", "ssh", "console", "-a", "app"]
+        assert args[5] == "-C"
+        sh, dash_c, command = shlex.split(args[6])
+        assert (sh, dash_c) == ("sh", "-c")
+        self.commands.append(command.split()[0])
+        if command.startswith("cat /data/.datasette-publish-fly.json"):
+            return self.ok(self.files.get("/data/.datasette-publish-fly.json", b"{}"))
+        if command.startswith("cat > "):
+            self.files[command.split()[-1]] = input
+            return self.ok()
+        if command.startswith(": > "):
+            self.files[command.split()[-1]] = b""
+            return self.ok()
+        if command.startswith("stat "):
+            return self.ok(str(len(self.files.get(command.split()[3], b""))).encode())
+        if command.startswith("dd "):
+            if self.fail_after_dd is not None:
+                if self.fail_after_dd == 0:
+                    return FakeCompletedProcess(b"", b"Connection reset", 1)
+                self.fail_after_dd -= 1
+            path = re.search(r"of=(\S+)", command).group(1)
+            bs = int(re.search(r"bs=(\d+)", command).group(1))
+            seek = int(re.search(r"seek=(\d+)", command).group(1))
+            existing = self.files.get(path, b"")
+            self.files[path] = existing[: seek * bs] + input
+            return self.ok()
+        if command.startswith("truncate "):
+            bits = command.split()
+            size, path = int(bits[2]), bits[3]
+            self.files[path] = self.files[path][:size]
+            return self.ok(
+                "{}  {}".format(
+                    hashlib.sha256(self.files[path]).hexdigest(), path
+                ).encode()
+            )
+        if command.startswith("rm -f "):
+            removes, move = command.split(" && ")
+            for path in removes.split()[2:]:
+                self.files.pop(path, None)
+            _, source, destination = move.split()
+            self.files[destination] = self.files.pop(source)
+            return self.ok()
+        assert False, command
+
+    def ok(self, stdout=b""):
+        return FakeCompletedProcess(stdout, b"")
+
+
+@pytest.fixture
+def volume(mocker):
+    volume = FakeVolume()
+    mocker.patch("datasette_publish_fly.volume_upload.run", side_effect=volume)
+    return volume
+
+
+def test_upload_files_to_volume(volume, tmp_path):
+    one = tmp_path / "one.db"
+    one.write_bytes(b"1" * 25)
+    two = tmp_path / "two.db"
+    two.write_bytes(b"2" * 5)
+    assert upload_files_to_volume("app", [str(one), str(two)], chunk_size=10) == [
+        "one.db",
+        "two.db",
+    ]
+    assert volume.files["/data/one.db"] == b"1" * 25
+    assert volume.files["/data/two.db"] == b"2" * 5
+    assert volume.commands.count("dd") == 4
+    # Second time round nothing has changed
+    volume.commands.clear()
+    assert upload_files_to_volume("app", [str(one), str(two)], chunk_size=10) == []
+    assert volume.commands == ["cat"]
+    # Only the changed file is uploaded
+    two.write_bytes(b"3" * 5)
+    volume.files["/data/two.db-wal"] = b"stale"
+    assert upload_files_to_volume("app", [str(one), str(two)], chunk_size=10) == [
+        "two.db"
+    ]
+    assert volume.files["/data/two.db"] == b"3" * 5
+    # The replaced database's -wal file was removed with it
+    assert "/data/two.db-wal" not in volume.files
+
+
+def test_upload_resumes_after_failure(volume, tmp_path):
+    one = tmp_path / "one.db"
+    one.write_bytes(b"0123456789" * 3)
+    volume.fail_after_dd = 2
+    with pytest.raises(Exception) as ex:
+        upload_files_to_volume("app", [str(one)], chunk_size=10)
+    assert "Connection reset" in str(ex.value)
+    assert volume.files["/data/.one.db.partial"] == b"0123456789" * 2
+    volume.fail_after_dd = None
+    volume.commands.clear()
+    assert upload_files_to_volume("app", [str(one)], chunk_size=10) == ["one.db"]
+    # Only the final chunk was sent
+    assert volume.commands.count("dd") == 1
+    assert volume.files["/data/one.db"] == b"0123456789" * 3
+    assert json.loads(volume.files["/data/.datasette-publish-fly.json"]) == {
+        "one.db": hashlib.sha256(b"0123456789" * 3).hexdigest()
+    }
+
+
+def test_upload_to_volume_requires_volume():
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        open("test.db", "w").write("data")
+        result = runner.invoke(
+            cli.cli,
+            [
+                "publish",
+                "fly",
+                "test.db",
+                "-a",
+                "app",
+                "--upload-to-volume",
+                "--generate-dir",
+                "out",
+            ],
+        )
+    assert result.exit_code == 1
+    assert "--upload-to-volume cannot be used with --generate-dir" in result.output
+
+
+@mock.patch("shutil.which")
+@mock.patch("datasette_publish_fly.publish.upload_files_to_volume")
+@mock.patch("datasette_publish_fly.publish.run")
+def test_publish_upload_to_volume(mock_run, mock_upload, mock_which):
+    mock_which.return_value = True
+    mock_upload.return_value = ["test.db"]
+    dockerfiles = []
+
+    def run_side_effect(*args, **kwargs):
+        if args == (["flyctl", "auth", "token", "--json"],):
+            return FakeCompletedProcess(b'{"token": "TOKEN"}', b"")
+        elif args == (["flyctl", "apps", "list", "--json"],):
+            return FakeCompletedProcess(b'[{"Name": "app"}]', b"")
+        elif args == (["flyctl", "volumes", "list", "-a", "app", "--json"],):
+            return FakeCompletedProcess(b'[{"Name": "datasette"}]', b"")
+        elif args[0][:2] == ["flyctl", "deploy"]:
+            dockerfiles.append(open("Dockerfile").read())
+        return FakeCompletedProcess(b"", b"")
+
+    mock_run.side_effect = run_side_effect
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        open("test.db", "w").write("data")
+        result = runner.invoke(
+            cli.cli,
+            ["publish", "fly", "test.db", "-a", "app", "--region", "sjc"]
+            + ["--upload-to-volume"],
+        )
+        assert result.exit_code == 0, result.output
+    assert "-i test.db" not in dockerfiles[0]
+    assert "/data/*.db" in dockerfiles[0]
+    assert mock_upload.call_args == mock.call("app", ("test.db",))
+    assert mock_run.call_args_list[-1] == mock.call(
+        ["flyctl", "apps", "restart", "app"], stderr=-1, stdout=-1
+    )
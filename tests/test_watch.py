@@ -0,0 +1,174 @@
+from click.testing import CliRunner
+from datasette import cli
+from datasette_publish_fly import publish, watch
+import click
+import os
+import pytest
+import sqlite3
+import threading
+import time
+
+
+def test_watched_paths(tmp_path):
+    metadata = tmp_path / "metadata.json"
+    metadata.write_text("{}", "utf-8")
+    with open(metadata) as fp:
+        assert watch.watched_paths(
+            ["one.db", "places.csv"],
+            fp,
+            "templates",
+            None,
+            [("static", "assets")],
+            ["writes.db"],
+        ) == ["one.db", "places.csv", "writes.db", str(metadata), "templates", "assets"]
+
+
+def test_snapshot(tmp_path):
+    (tmp_path / "one.db").write_bytes(b"one")
+    (tmp_path / "templates").mkdir()
+    (tmp_path / "templates" / "index.html").write_text("index", "utf-8")
+    (tmp_path / "templates" / ".DS_Store").write_text("ignored", "utf-8")
+    paths = [str(tmp_path / "one.db"), str(tmp_path / "templates")]
+    stats = watch.snapshot(paths + [str(tmp_path / "missing.db")])
+    assert sorted(stats) == sorted(
+        [
+            str(tmp_path / "one.db"),
+            str(tmp_path / "templates" / "index.html"),
+            str(tmp_path / "missing.db"),
+        ]
+    )
+    assert stats[str(tmp_path / "one.db")][0] == 3
+    assert stats[str(tmp_path / "missing.db")] is None
+
+
+def test_wait_for_change_debounces(tmp_path):
+    path = tmp_path / "one.db"
+    path.write_bytes(b"")
+    before = watch.snapshot([str(path)])
+
+    def write_in_bursts():
+        for i in range(1, 4):
+            time.sleep(0.05)
+            with open(path, "ab") as fp:
+                fp.write(b"x" * i)
+
+    writer = threading.Thread(target=write_in_bursts)
+    writer.start()
+    after = watch.wait_for_change([str(path)], before, interval=0.01, debounce=0.2)
+    writer.join()
+    # Only returns once the last write has settled
+    assert after[str(path)][0] == 6
+
+
+@pytest.mark.parametrize(
+    "exception", (click.ClickException, sqlite3.DatabaseError, OSError)
+)
+def test_watch_and_publish(monkeypatch, capsys, exception):
+    snapshots = iter([{"one.db": (2, 2)}, {"one.db": (3, 3), "two.db": (1, 1)}])
+
+    def wait_for_change(paths, before):
+        try:
+            return next(snapshots)
+        except StopIteration:
+            raise KeyboardInterrupt
+
+    monkeypatch.setattr(watch, "snapshot", lambda paths: {"one.db": (1, 1)})
+    monkeypatch.setattr(watch, "wait_for_change", wait_for_change)
+    calls = []
+
+    def publish(preflight_result):
+        calls.append(preflight_result)
+        if len(calls) == 2:
+            raise exception("database disk image is malformed")
+        return ("sjc", "datasette")
+
+    watch.watch_and_publish(["one.db", "two.db"], publish)
+    # The failed republish doesn't stop the watching
+    assert calls == [None, ("sjc", "datasette"), ("sjc", "datasette")]
+    err = capsys.readouterr().err
+    assert "Changed: one.db - republishing" in err
+    assert "Error: database disk image is malformed" in err
+    assert "Changed: one.db, two.db - republishing" in err
+    assert err.endswith("Stopped watching\n")
+
+
+def test_watch_reopens_metadata(tmp_path, mocker):
+    publish_to_fly = publish.publish_to_fly
+    published = []
+
+    def fake_publish_to_fly(**kwargs):
+        if kwargs["watch"]:
+            return publish_to_fly(**kwargs)
+        published.append((kwargs["metadata"].read(), kwargs["metadata"]))
+        return ("sjc", None)
+
+    mocker.patch(
+        "datasette_publish_fly.publish.publish_to_fly",
+        side_effect=fake_publish_to_fly,
+    )
+    mocker.patch(
+        "datasette_publish_fly.publish.watch_and_publish",
+        side_effect=lambda paths, publish: publish(publish(None)),
+    )
+    runner = CliRunner()
+    with runner.isolated_filesystem(temp_dir=tmp_path):
+        open("test.db", "w").write("data")
+        open("metadata.json", "w").write('{"title": "Watched"}')
+        result = runner.invoke(
+            cli.cli,
+            ["publish", "fly", "test.db", "-a", "app", "--watch"]
+            + ["--metadata", "metadata.json"],
+            catch_exceptions=False,
+        )
+    assert result.exit_code == 0, result.output
+    # Read from the start each time, and closed afterwards
+    assert [content for content, _ in published] == ['{"title": "Watched"}'] * 2
+    assert all(fp.closed for _, fp in published)
+
+
+def test_split_copy_layers(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "Dockerfile").write_text(
+        "FROM python:3.11.0-slim-bullseye\nCOPY . /app\nWORKDIR /app", "utf-8"
+    )
+    (tmp_path / ".dockerignore").write_text("", "utf-8")
+    (tmp_path / "one.db").write_bytes(b"one")
+    (tmp_path / "my data.db").write_bytes(b"two")
+    (tmp_path / "templates").mkdir()
+    watch.split_copy_layers()
+    assert (tmp_path / "Dockerfile").read_text("utf-8").split("\n") == [
+        "FROM python:3.11.0-slim-bullseye",
+        'COPY --link ["my data.db", "/app/my data.db"]',
+        'COPY --link ["one.db", "/app/one.db"]',
+        'COPY --link ["templates", "/app/templates"]',
+        "WORKDIR /app",
+    ]
+
+
+def test_stable_context(tmp_path, monkeypatch, cache_dir):
+    first = tmp_path / "first"
+    (first / "templates").mkdir(parents=True)
+    (first / "one.db").write_bytes(b"one")
+    (first / "metadata.json").write_text("{}", "utf-8")
+    (first / "templates" / "index.html").write_text("index", "utf-8")
+    monkeypatch.chdir(first)
+    target = watch.stable_context("app")
+    assert target == str(cache_dir / "context" / "app")
+    metadata_mtime = os.stat(os.path.join(target, "metadata.json")).st_mtime_ns
+
+    # As if from a new temporary directory: one file changed, one rewritten
+    # with the same content and the templates removed
+    second = tmp_path / "second"
+    second.mkdir()
+    (second / "one.db").write_bytes(b"one, updated")
+    time.sleep(0.01)
+    (second / "metadata.json").write_text("{}", "utf-8")
+    monkeypatch.chdir(second)
+    assert watch.stable_context("app") == target
+    assert sorted(os.listdir(target)) == ["metadata.json", "one.db"]
+    with open(os.path.join(target, "one.db"), "rb") as fp:
+        assert fp.read() == b"one, updated"
+    # Unchanged files are left alone, so the builder sees no change
+    assert os.stat(os.path.join(target, "metadata.json")).st_mtime_ns == (
+        metadata_mtime
+    )